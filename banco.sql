@@ -81,3 +81,308 @@ CREATE TABLE filiais (
   pais TEXT,
   created_at TIMESTAMP DEFAULT now()
 );
+
+-- sales_rollup_hourly (agregado de vendas por empresa/filial/dia/hora)
+-- Mantido na ingestão por apply_sales_rollup_deltas; lido pelo resumo de IA
+CREATE TABLE sales_rollup_hourly (
+  company_id TEXT NOT NULL,
+  filial TEXT NOT NULL DEFAULT '',
+  sale_date DATE NOT NULL,
+  sale_hour SMALLINT NOT NULL,
+  total NUMERIC(14,2) NOT NULL DEFAULT 0,
+  receipts INTEGER NOT NULL DEFAULT 0,
+  items NUMERIC(14,2) NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ DEFAULT now(),
+  PRIMARY KEY (company_id, filial, sale_date, sale_hour)
+);
+
+CREATE INDEX IF NOT EXISTS idx_invoices_company_filial_date ON invoices (company_id, filial, invoice_date);
+CREATE INDEX IF NOT EXISTS idx_invoice_lines_invoice_id ON invoice_lines (invoice_id);
+
+-- Contribuição atual de cada fatura para sales_rollup_hourly. Cada atualização aplica
+-- só a diferença (nova - anterior) das faturas tocadas, com upserts aditivos: reprocessar
+-- um ficheiro, desativar uma FR (NC) ou reativá-la (upsert) custa O(faturas tocadas),
+-- não O(faturas do dia), e é idempotente.
+CREATE TABLE sales_rollup_contrib (
+  invoice_id UUID PRIMARY KEY,
+  company_id TEXT NOT NULL,
+  filial TEXT NOT NULL,
+  sale_date DATE NOT NULL,
+  sale_hour SMALLINT NOT NULL,
+  total NUMERIC(14,2) NOT NULL,
+  items NUMERIC(14,2) NOT NULL
+);
+
+-- Contribuição que as faturas indicadas deviam ter agora.
+-- Fonte: as tabelas gravadas por esta ingestão (invoices/invoice_lines). A hora é a de
+-- InvoiceStatusDate (invoice_status_time). O resumo antigo lia faturas_fatura.hora, uma tabela
+-- preenchida fora deste serviço, por isso as horas só coincidem se esse sistema usar o mesmo campo.
+-- NCs não contam como venda (o efeito delas é a desativação da FR referenciada).
+CREATE OR REPLACE FUNCTION sales_rollup_contrib_of(p_invoice_ids UUID[])
+RETURNS SETOF sales_rollup_contrib
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT i.id,
+         i.company_id,
+         COALESCE(i.filial, ''),
+         i.invoice_date,
+         COALESCE(EXTRACT(HOUR FROM i.invoice_status_time), 0)::SMALLINT,
+         COALESCE(i.gross_total, 0),
+         COALESCE((SELECT SUM(quantity) FROM invoice_lines WHERE invoice_id = i.id), 0)
+    FROM invoices i
+   WHERE i.id = ANY(p_invoice_ids)
+     AND i.company_id IS NOT NULL
+     AND i.invoice_date IS NOT NULL
+     AND COALESCE(i.active, TRUE)
+     AND i.invoice_no NOT LIKE 'NC%';
+$$;
+
+CREATE OR REPLACE FUNCTION apply_sales_rollup_deltas(p_invoice_ids UUID[])
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  affected INTEGER;
+BEGIN
+  -- Serializar atualizações concorrentes da mesma fatura (ordem fixa evita deadlocks)
+  PERFORM pg_advisory_xact_lock(hashtext('sales_rollup|' || ids.id::text))
+     FROM (SELECT DISTINCT unnest(p_invoice_ids) AS id ORDER BY 1) ids;
+
+  WITH previous AS (
+    DELETE FROM sales_rollup_contrib
+     WHERE invoice_id = ANY(p_invoice_ids)
+    RETURNING company_id, filial, sale_date, sale_hour, -total AS total, -1 AS receipts, -items AS items
+  ),
+  deltas AS (
+    SELECT company_id, filial, sale_date, sale_hour,
+           SUM(total) AS total, SUM(receipts) AS receipts, SUM(items) AS items
+      FROM (
+        SELECT * FROM previous
+        UNION ALL
+        SELECT company_id, filial, sale_date, sale_hour, total, 1, items
+          FROM sales_rollup_contrib_of(p_invoice_ids)
+      ) d
+     GROUP BY 1, 2, 3, 4
+    HAVING SUM(total) <> 0 OR SUM(receipts) <> 0 OR SUM(items) <> 0
+  )
+  INSERT INTO sales_rollup_hourly (company_id, filial, sale_date, sale_hour, total, receipts, items)
+  SELECT * FROM deltas ORDER BY 1, 2, 3, 4
+  ON CONFLICT (company_id, filial, sale_date, sale_hour) DO UPDATE
+     SET total = sales_rollup_hourly.total + EXCLUDED.total,
+         receipts = sales_rollup_hourly.receipts + EXCLUDED.receipts,
+         items = sales_rollup_hourly.items + EXCLUDED.items,
+         updated_at = now();
+  GET DIAGNOSTICS affected = ROW_COUNT;
+
+  INSERT INTO sales_rollup_contrib SELECT * FROM sales_rollup_contrib_of(p_invoice_ids);
+  RETURN affected;
+END;
+$$;
+
+-- Backfill inicial (e migração a partir do antigo refresh_sales_rollups, que recalculava o dia inteiro):
+-- TRUNCATE sales_rollup_hourly, sales_rollup_contrib;
+-- SELECT apply_sales_rollup_deltas(array_agg(id))
+--   FROM invoices WHERE invoice_date IS NOT NULL GROUP BY company_id, filial;
+-- DROP FUNCTION IF EXISTS refresh_sales_rollups(TEXT, TEXT, DATE[]);
+
+-- product_rollup_daily (agregado de produtos por empresa/filial/dia/produto)
+-- Mantido na ingestão por apply_product_rollup_deltas; lido pelo top de produtos do resumo de IA
+CREATE TABLE product_rollup_daily (
+  company_id TEXT NOT NULL,
+  filial TEXT NOT NULL DEFAULT '',
+  sale_date DATE NOT NULL,
+  product_code TEXT NOT NULL,
+  description TEXT,
+  quantity NUMERIC(14,2) NOT NULL DEFAULT 0,
+  revenue NUMERIC(14,2) NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ DEFAULT now(),
+  PRIMARY KEY (company_id, filial, sale_date, product_code)
+);
+
+CREATE INDEX IF NOT EXISTS idx_product_rollup_company_date ON product_rollup_daily (company_id, sale_date);
+
+-- Contribuição atual de cada fatura/produto para product_rollup_daily (mesmo esquema de
+-- diferenças que sales_rollup_contrib)
+CREATE TABLE product_rollup_contrib (
+  invoice_id UUID NOT NULL,
+  product_code TEXT NOT NULL,
+  company_id TEXT NOT NULL,
+  filial TEXT NOT NULL,
+  sale_date DATE NOT NULL,
+  description TEXT,
+  quantity NUMERIC(14,2) NOT NULL,
+  revenue NUMERIC(14,2) NOT NULL,
+  PRIMARY KEY (invoice_id, product_code)
+);
+
+CREATE OR REPLACE FUNCTION product_rollup_contrib_of(p_invoice_ids UUID[])
+RETURNS SETOF product_rollup_contrib
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT i.id,
+         COALESCE(l.product_code, ''),
+         i.company_id,
+         COALESCE(i.filial, ''),
+         i.invoice_date,
+         MAX(l.description),
+         COALESCE(SUM(l.quantity), 0),
+         COALESCE(SUM(l.price_with_iva), 0)
+    FROM invoices i
+    JOIN invoice_lines l ON l.invoice_id = i.id
+   WHERE i.id = ANY(p_invoice_ids)
+     AND i.company_id IS NOT NULL
+     AND i.invoice_date IS NOT NULL
+     AND COALESCE(i.active, TRUE)
+     AND i.invoice_no NOT LIKE 'NC%'
+   GROUP BY i.id, COALESCE(l.product_code, '');
+$$;
+
+CREATE OR REPLACE FUNCTION apply_product_rollup_deltas(p_invoice_ids UUID[])
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  affected INTEGER;
+  zero_company TEXT[];
+  zero_filial TEXT[];
+  zero_date DATE[];
+  zero_code TEXT[];
+BEGIN
+  PERFORM pg_advisory_xact_lock(hashtext('product_rollup|' || ids.id::text))
+     FROM (SELECT DISTINCT unnest(p_invoice_ids) AS id ORDER BY 1) ids;
+
+  WITH previous AS (
+    DELETE FROM product_rollup_contrib
+     WHERE invoice_id = ANY(p_invoice_ids)
+    RETURNING company_id, filial, sale_date, product_code, NULL::TEXT AS description,
+              -quantity AS quantity, -revenue AS revenue
+  ),
+  deltas AS (
+    SELECT company_id, filial, sale_date, product_code, MAX(description) AS description,
+           SUM(quantity) AS quantity, SUM(revenue) AS revenue
+      FROM (
+        SELECT * FROM previous
+        UNION ALL
+        SELECT company_id, filial, sale_date, product_code, description, quantity, revenue
+          FROM product_rollup_contrib_of(p_invoice_ids)
+      ) d
+     GROUP BY 1, 2, 3, 4
+    HAVING SUM(quantity) <> 0 OR SUM(revenue) <> 0
+  ),
+  upserted AS (
+    INSERT INTO product_rollup_daily (company_id, filial, sale_date, product_code, description, quantity, revenue)
+    SELECT * FROM deltas ORDER BY 1, 2, 3, 4
+    ON CONFLICT (company_id, filial, sale_date, product_code) DO UPDATE
+       SET description = COALESCE(EXCLUDED.description, product_rollup_daily.description),
+           quantity = product_rollup_daily.quantity + EXCLUDED.quantity,
+           revenue = product_rollup_daily.revenue + EXCLUDED.revenue,
+           updated_at = now()
+    RETURNING company_id, filial, sale_date, product_code, quantity, revenue
+  )
+  SELECT COUNT(*),
+         array_agg(company_id) FILTER (WHERE quantity = 0 AND revenue = 0),
+         array_agg(filial) FILTER (WHERE quantity = 0 AND revenue = 0),
+         array_agg(sale_date) FILTER (WHERE quantity = 0 AND revenue = 0),
+         array_agg(product_code) FILTER (WHERE quantity = 0 AND revenue = 0)
+    INTO affected, zero_company, zero_filial, zero_date, zero_code
+    FROM upserted;
+
+  INSERT INTO product_rollup_contrib SELECT * FROM product_rollup_contrib_of(p_invoice_ids);
+
+  -- Produtos sem vendas no dia (ex.: única fatura desativada) saem do top e da contagem
+  IF zero_code IS NOT NULL THEN
+    DELETE FROM product_rollup_daily r
+     USING unnest(zero_company, zero_filial, zero_date, zero_code) AS z(company_id, filial, sale_date, product_code)
+     WHERE r.company_id = z.company_id AND r.filial = z.filial
+       AND r.sale_date = z.sale_date AND r.product_code = z.product_code
+       AND r.quantity = 0 AND r.revenue = 0;
+  END IF;
+  RETURN affected;
+END;
+$$;
+
+-- Agregados de vendas e de produtos numa só chamada (uma RPC por ficheiro/lote)
+CREATE OR REPLACE FUNCTION apply_rollup_deltas(p_invoice_ids UUID[])
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  RETURN apply_sales_rollup_deltas(p_invoice_ids) + apply_product_rollup_deltas(p_invoice_ids);
+END;
+$$;
+
+-- Top-N de produtos de um período, agregado e ordenado no servidor
+CREATE OR REPLACE FUNCTION top_produtos_periodo(
+  p_company_id TEXT,
+  p_filial TEXT,
+  p_inicio DATE,
+  p_fim DATE,
+  p_limite INTEGER DEFAULT 10
+)
+RETURNS TABLE (product_code TEXT, description TEXT, quantidade NUMERIC, faturamento NUMERIC, total_produtos BIGINT)
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT r.product_code,
+         MAX(r.description),
+         SUM(r.quantity),
+         SUM(r.revenue),
+         COUNT(*) OVER ()
+    FROM product_rollup_daily r
+   WHERE r.company_id = p_company_id
+     AND (p_filial IS NULL OR r.filial = p_filial)
+     AND r.sale_date BETWEEN p_inicio AND p_fim
+   GROUP BY r.product_code
+   ORDER BY SUM(r.revenue) DESC
+   LIMIT p_limite;
+$$;
+
+-- Backfill inicial (e migração a partir do antigo refresh_product_rollups):
+-- TRUNCATE product_rollup_daily, product_rollup_contrib;
+-- SELECT apply_product_rollup_deltas(array_agg(id))
+--   FROM invoices WHERE invoice_date IS NOT NULL GROUP BY company_id, filial;
+-- DROP FUNCTION IF EXISTS refresh_product_rollups(UUID[]);
+
+-- Caminho de leitura analítica (SUPABASE_READ_URL/SUPABASE_READ_KEY):
+-- um papel próprio com statement_timeout garante que o servidor também
+-- cancela consultas de dashboard demasiado longas, sem afetar a ingestão.
+-- O cliente abandona a consulta ao fim de READ_QUERY_TIMEOUT mas não a consegue
+-- interromper; este timeout deve ser igual ou menor.
+-- SUPABASE_READ_KEY deve ser um JWT com "role": "analytics_reader".
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'analytics_reader') THEN
+    CREATE ROLE analytics_reader NOLOGIN;
+  END IF;
+END
+$$;
+GRANT analytics_reader TO authenticator;
+GRANT USAGE ON SCHEMA public TO analytics_reader;
+GRANT SELECT ON ALL TABLES IN SCHEMA public TO analytics_reader;
+ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT SELECT ON TABLES TO analytics_reader;
+GRANT EXECUTE ON FUNCTION top_produtos_periodo(TEXT, TEXT, DATE, DATE, INTEGER) TO analytics_reader;
+ALTER ROLE analytics_reader SET statement_timeout = '15s';
+-- O PostgREST lê as definições do papel ao recarregar a configuração
+NOTIFY pgrst, 'reload config';
+
+-- pending_deactivations (ledger de referências de NCs)
+-- Cada referência de uma NC fica registada; se a FR ainda não existir a desativação
+-- é aplicada quando a FR for gravada, por isso FRs e NCs podem chegar em qualquer ordem.
+CREATE TABLE pending_deactivations (
+  invoice_no TEXT NOT NULL,
+  company_id TEXT NOT NULL DEFAULT '',
+  nc_file TEXT,
+  reference TEXT,
+  created_at TIMESTAMPTZ DEFAULT now(),
+  applied_at TIMESTAMPTZ,
+  -- Última tentativa da reconciliação: cada ronda começa pelas entradas há mais tempo sem tentativa
+  last_attempt_at TIMESTAMPTZ,
+  PRIMARY KEY (invoice_no, company_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_pending_deactivations_open ON pending_deactivations (invoice_no) WHERE applied_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_pending_deactivations_retry ON pending_deactivations (last_attempt_at NULLS FIRST, created_at) WHERE applied_at IS NULL;
+-- Em bases já criadas:
+-- ALTER TABLE pending_deactivations ADD COLUMN IF NOT EXISTS last_attempt_at TIMESTAMPTZ;
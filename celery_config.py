@@ -1,5 +1,8 @@
 import os
+import time
+import shutil
 from celery import Celery
+from celery.signals import worker_init, worker_process_shutdown, before_task_publish, task_prerun
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -8,6 +11,25 @@ load_dotenv()
 CELERY_BROKER_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 
+# Filas dedicadas (cada uma com workers, concorrência e prefetch próprios)
+QUEUE_SCAN = 'scan'
+QUEUE_INGEST_FR = 'ingest-fr'
+QUEUE_INGEST_NC = 'ingest-nc'
+QUEUE_SFTP_UPLOAD = 'sftp-upload'
+QUEUE_OPENGCS = 'opengcs'
+# Ficheiros recebidos em tempo real (/receive-file), consumidos antes de ingest-fr
+QUEUE_INGEST_LIVE = 'ingest-live'
+
+def route_ingest_task(name, args, kwargs, options, task=None, **kw):
+    """Encaminha process_single_xml_file para ingest-fr ou ingest-nc conforme o tipo do ficheiro"""
+    if name != 'tasks.process_single_xml_file':
+        return None
+    from utils.file_utils import invoice_fr_or_nc
+    xml_file_path = args[0] if args else (kwargs or {}).get('xml_file_path', '')
+    if invoice_fr_or_nc(os.path.basename(xml_file_path or '')) == 'NC':
+        return {'queue': QUEUE_INGEST_NC}
+    return {'queue': QUEUE_INGEST_FR}
+
 # Criar instância do Celery
 celery_app = Celery(
     'saft_processor',
@@ -30,9 +52,71 @@ celery_app.conf.update(
     task_acks_late=True,
     worker_max_tasks_per_child=1000,
     result_expires = 3600,
-
+    task_default_queue=QUEUE_SCAN,
+    # Um worker com '-Q ingest-live,ingest-fr' esvazia sempre a primeira fila antes da segunda
+    broker_transport_options={'queue_order_strategy': 'priority'},
+    # Uploads SFTP nunca esperam atrás de um lote de ingestão e OpenGCs não compete com faturas
+    task_routes=(
+        route_ingest_task,
+        {
+            'tasks.download_and_queue_sftp_files': {'queue': QUEUE_SCAN},
+            'tasks.process_xml_micro_batch': {'queue': QUEUE_INGEST_FR},
+            'tasks.collect_ingest_results': {'queue': QUEUE_SCAN},
+            'tasks.abort_scan_cycle': {'queue': QUEUE_SCAN},
+            'tasks.cleanup_files_task': {'queue': QUEUE_SCAN},
+            'tasks.download_all': {'queue': QUEUE_SCAN},
+            'tasks.reconcile_pending_deactivations_task': {'queue': QUEUE_INGEST_NC},
+            'tasks.autoscale_workers': {'queue': QUEUE_SCAN},
+            'tasks.gc_blob_spool': {'queue': QUEUE_SCAN},
+            'tasks.async_upload_xml_to_sftp': {'queue': QUEUE_SFTP_UPLOAD},
+            'tasks.flush_upload_batch': {'queue': QUEUE_SFTP_UPLOAD},
+            'tasks.download_and_queue_opengcs_files': {'queue': QUEUE_OPENGCS},
+        },
+    ),
 )
 
+# Métricas Prometheus do worker (db_operation_*, db_round_trips_per_file)
+WORKER_METRICS_PORT = os.getenv('WORKER_METRICS_PORT')
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    """Expõe as métricas dos processos filhos quando WORKER_METRICS_PORT está definido"""
+    if not WORKER_METRICS_PORT:
+        return
+    multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        # Ficheiros de execuções anteriores distorcem os contadores
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+    from utils.db_metrics import start_worker_metrics_server
+    start_worker_metrics_server(int(WORKER_METRICS_PORT))
+
+@worker_process_shutdown.connect
+def release_process_metrics(pid=None, **kwargs):
+    from utils.db_metrics import mark_process_dead
+    mark_process_dead(pid or os.getpid())
+
+# Latência de espera em fila por fila (entrada do autoscaler)
+@before_task_publish.connect
+def stamp_publish_time(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault('published_at', time.time())
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    request = getattr(task, 'request', None)
+    published_at = getattr(request, 'published_at', None) or (getattr(request, 'headers', None) or {}).get('published_at')
+    queue = (getattr(request, 'delivery_info', None) or {}).get('routing_key')
+    if not published_at or not queue:
+        return
+    try:
+        from utils.redisUtil import get_redis
+        from services.autoscaler import record_queue_wait as record
+        record(get_redis(), queue, time.time() - float(published_at))
+    except Exception:
+        # Métrica auxiliar: nunca impedir a execução da tarefa
+        pass
+
 # Importar tarefas para garantir registro
 import tasks
 
@@ -42,8 +126,23 @@ celery_app.conf.beat_schedule = {
         'task': 'tasks.download_and_queue_sftp_files',
         'schedule': 180.0,  # 3 minutos
     },
-    # 'download-opengcs-and-queue-files-every-5-minutes': {
-    #     'task': 'tasks.download_and_queue_opengcs_files',
-    #     'schedule': 30.0,  # 1 minuto
-    # },
+    'reconcile-pending-deactivations-every-hour': {
+        'task': 'tasks.reconcile_pending_deactivations_task',
+        'schedule': 3600.0,
+    },
+    'autoscale-workers': {
+        'task': 'tasks.autoscale_workers',
+        'schedule': float(os.getenv('AUTOSCALE_INTERVAL', '30')),
+        'options': {'expires': float(os.getenv('AUTOSCALE_INTERVAL', '30'))},
+    },
+    'gc-blob-spool': {
+        'task': 'tasks.gc_blob_spool',
+        'schedule': float(os.getenv('BLOB_SPOOL_GC_INTERVAL', '3600')),
+    },
+    'download-opengcs-and-process-files': {
+        'task': 'tasks.download_and_queue_opengcs_files',
+        'schedule': float(os.getenv('OPENGCS_BEAT_INTERVAL', '30')),
+        # Execuções atrasadas não se acumulam: expiram antes do próximo ciclo
+        'options': {'queue': QUEUE_OPENGCS, 'expires': float(os.getenv('OPENGCS_BEAT_INTERVAL', '30'))},
+    },
 } 
\ No newline at end of file
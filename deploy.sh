@@ -69,7 +69,7 @@ elif [ "$1" = "manual" ]; then
     # Criar configuração do supervisor
     sudo tee /etc/supervisor/conf.d/celery.conf > /dev/null <<EOF
 [program:celery-worker]
-command=$(pwd)/venv/bin/celery -A celery.celery_config.celery_app worker --loglevel=info --concurrency=4
+command=$(pwd)/venv/bin/celery -A celery.celery_config.celery_app worker -Q ingest-live,scan,sftp-upload,opengcs,ingest-nc,ingest-fr --loglevel=info --concurrency=4
 directory=$(pwd)
 user=$USER
 numprocs=1
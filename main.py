@@ -13,7 +13,7 @@ from flask_caching import Cache
 # Importar Celery
 
 from celery_config import celery_app
-from tasks import download_and_queue_sftp_files, process_single_opengcs_file, download_and_queue_opengcs_files_sync
+from tasks import download_and_queue_sftp_files, process_single_opengcs_file, download_and_queue_opengcs_files
 from sftp_upload import upload_xml_to_sftp
 
 from utils.supabaseUtil import get_supabase
@@ -127,6 +127,10 @@ def get_task_status(task_id):
             }
             if 'result' in task.info:
                 response['result'] = task.info['result']
+            # Detalhe publicado pelas tarefas durante o estado PROGRESS
+            for key in ('stage', 'files_scanned', 'invoices_parsed', 'rows_written'):
+                if key in task.info:
+                    response[key] = task.info[key]
         else:
             # something went wrong in the background job
             response = {
@@ -264,6 +268,71 @@ def manual_cleanup():
             "message": f"Erro na limpeza manual: {str(e)}"
         }), 500
 
+@app.route('/api/upload-status/<upload_id>', methods=['GET'])
+def get_upload_status(upload_id):
+    """Resultado individual de um upload agrupado (queued, retrying, uploaded ou error)"""
+    try:
+        from utils.redisUtil import get_redis
+        from services.upload_batcher import upload_status
+
+        status = upload_status(get_redis(), upload_id)
+        if not status:
+            return jsonify({"status": "error", "message": "Upload não encontrado (ou expirado)"}), 404
+        return jsonify({"upload_id": upload_id, **status})
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Erro ao consultar upload: {str(e)}"
+        }), 500
+
+# Endpoints da quarentena de ficheiros que falham repetidamente
+@app.route('/api/quarantine', methods=['GET'])
+def list_quarantine():
+    """Lista ficheiros em quarentena (ou todo o ledger de falhas com ?all=true)"""
+    try:
+        from utils.redisUtil import get_redis
+        from services.quarantine import list_failures
+
+        quarantined_only = request.args.get('all', 'false').lower() != 'true'
+        entries = list_failures(get_redis(), quarantined_only=quarantined_only)
+        return jsonify({"status": "success", "total": len(entries), "files": entries})
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Erro ao listar quarentena: {str(e)}"
+        }), 500
+
+@app.route('/api/quarantine/requeue', methods=['POST'])
+def requeue_quarantine():
+    """Devolve ficheiros da quarentena à pasta do NIF para o próximo scan.
+    Body: {"remote_path": ..., "hash": ...} ou {"all": true}"""
+    try:
+        from utils.redisUtil import get_redis
+        from services.quarantine import list_failures, requeue
+        from sftp_connection import move_file_on_sftp
+
+        data = request.get_json(silent=True) or {}
+        redis_client = get_redis()
+        if data.get('all'):
+            targets = [(entry['remote_path'], entry['hash']) for entry in list_failures(redis_client, quarantined_only=True)]
+        elif data.get('remote_path') and data.get('hash'):
+            targets = [(data['remote_path'], data['hash'])]
+        else:
+            return jsonify({"status": "error", "message": "Indique remote_path e hash, ou all=true"}), 400
+
+        requeued = [remote_path for remote_path, content_hash in targets
+                    if requeue(redis_client, remote_path, content_hash, move_file_on_sftp)]
+        return jsonify({
+            "status": "success",
+            "requeued": requeued,
+            "failed": [remote_path for remote_path, _ in targets if remote_path not in requeued]
+        })
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Erro ao reenviar ficheiros da quarentena: {str(e)}"
+        }), 500
+
 # Endpoint para verificar saúde do sistema
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -287,7 +356,8 @@ def health_check():
                 "redis": "connected",
                 "supabase": "connected",
                 "celery": "available"
-            }
+            },
+            "blob_spool": get_blob_spool().usage()
         }), 200
         
     except Exception as e:
@@ -298,6 +368,16 @@ def health_check():
         }), 500
 
 
+# Endpoint de métricas Prometheus (latência e round trips da DB)
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Endpoint para exportar métricas Prometheus"""
+    from flask import Response
+    from utils.db_metrics import metrics_payload
+    payload, content_type = metrics_payload()
+    return Response(payload, mimetype=content_type)
+
+
 @app.route('/home', methods=['GET'])
 def get():
     return jsonify({
@@ -310,7 +390,9 @@ def get():
             }
         }), 200
 
-from tasks import async_upload_xml_to_sftp
+from tasks import queue_sftp_upload, dispatch_live_ingest
+from services.priority_lane import DIRECT_INGEST_ENABLED
+from utils.spool import get_blob_spool, BlobSpoolFull
 
 @app.route("/receive-file", methods=["POST"])
 def receive_file():
@@ -370,15 +452,42 @@ def receive_file():
                 return jsonify({"status": "error", "message": "CompanyID (NIF) não encontrado no XML"}), 422
             nif = company_id_el.text
 
+        # Ingestão direta (opt-in): FR/NC vão logo para a ingestão; o SFTP fica como arquivo
+        # em background depois da DB, ou como retorno para o scan se a ingestão falhar
+        if DIRECT_INGEST_ENABLED and not is_opengcs:
+            try:
+                ingest = dispatch_live_ingest(content, nif, filename)
+            except Exception as ingest_err:
+                print(f"⚠️ Erro na ingestão direta de {filename}, a seguir pelo SFTP: {str(ingest_err)}")
+                ingest = None
+            if ingest:
+                return jsonify({
+                    "status": "success",
+                    "message": "Ficheiro recebido na API e enviado para ingestão direta",
+                    "nif": nif,
+                    "size_mb": round(size_mb, 4),
+                    "ingest": ingest,
+                    "sftp_info": "Arquivo no SFTP após a ingestão"
+                }), 200
+
+        # Guardar o XML comprimido no spool de blobs: a mensagem no Redis leva só a chave
+        try:
+            blob_key = get_blob_spool().put(content)
+        except BlobSpoolFull as full_err:
+            return jsonify({"status": "error", "message": str(full_err)}), 503
+
         # Enviar XML para o SFTP na pasta do NIF
         sftp_result = None
         sftp_error = None
+        upload = None
         try:
-            # Enviamos a string limpa para não ter problemas de serialização
-            async_upload_xml_to_sftp.delay(
-                xml_string=xml_string, 
-                nif=nif, 
-                filename=filename or f"upload_{nif}_assincrono.xml"
+            # Uploads do mesmo NIF são agrupados e enviados numa só sessão SFTP
+            upload = queue_sftp_upload(
+                blob_key,
+                nif,
+                filename or f"upload_{nif}_assincrono.xml",
+                # Ficheiro em tempo real: ingestão pela via rápida logo após o upload
+                ingest_now=True
             )
             print("Ficheiro enviado para fila em background")   
             sftp_status_msg = "Enviado para fila em background"
@@ -389,7 +498,9 @@ def receive_file():
             "message": "Ficheiro recebido na API e na fila de processamento",
             "nif": nif,
             "size_mb": round(size_mb, 4),
-            "sftp_info": sftp_status_msg
+            "sftp_info": sftp_status_msg,
+            # upload_id: consultar o resultado em /api/upload-status/<upload_id>
+            "upload": upload
         }
         
         return jsonify(response), 200
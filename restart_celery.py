@@ -41,7 +41,8 @@ def start_celery_worker():
         # Comando para iniciar o worker
         cmd = [
             "celery", "-A", "celery_config.celery_app", 
-            "worker", "--loglevel=info", "--concurrency=2"
+            "worker", "-Q", "ingest-live,scan,sftp-upload,opengcs,ingest-nc,ingest-fr",
+            "--loglevel=info", "--concurrency=2"
         ]
         
         process = subprocess.Popen(cmd)
@@ -0,0 +1,140 @@
+import os
+import math
+import time
+import logging
+
+from services.drain_controller import queue_depth, ewma
+
+logger = logging.getLogger(__name__)
+
+# Autoscaling dos workers Celery a partir da profundidade das filas (LLEN no Redis)
+# e da latência de espera das tarefas (publicação -> início, medida nos workers).
+# Ajusta o pool de cada worker com pool_grow/pool_shrink entre mínimo e máximo e
+# publica em Redis o número de réplicas desejado para um orquestrador externo.
+
+AUTOSCALE_ENABLED = os.getenv("AUTOSCALE_ENABLED", "true").lower() == "true"
+AUTOSCALE_INTERVAL = float(os.getenv("AUTOSCALE_INTERVAL", "30"))
+# Mensagens em espera por processo acima das quais o pool cresce
+AUTOSCALE_UP_BACKLOG_PER_PROCESS = float(os.getenv("AUTOSCALE_UP_BACKLOG_PER_PROCESS", "5"))
+# Latência de espera alvo (segundos); acima cresce. Só conta com mensagens na fila
+AUTOSCALE_TARGET_WAIT = float(os.getenv("AUTOSCALE_TARGET_WAIT", "30"))
+# Avaliações seguidas sem carga antes de encolher (histerese)
+AUTOSCALE_DOWN_AFTER = int(os.getenv("AUTOSCALE_DOWN_AFTER", "6"))
+AUTOSCALE_MAX_REPLICAS = int(os.getenv("AUTOSCALE_MAX_REPLICAS", "4"))
+# EWMA da espera sem amostras novas há mais de N segundos deixa de contar (sem tarefas a
+# arrancar não há espera a medir; o último pico não pode manter o pool no máximo)
+AUTOSCALE_WAIT_STALE = float(os.getenv("AUTOSCALE_WAIT_STALE", str(AUTOSCALE_INTERVAL * 2)))
+
+LATENCY_KEY = "autoscale:wait"
+STATE_KEY = "autoscale:state"
+REPLICAS_KEY = "autoscale:replicas"
+
+
+def _bounds(queue: str, default_min: int, default_max: int):
+    prefix = f"AUTOSCALE_{queue.upper().replace('-', '_')}"
+    return int(os.getenv(f"{prefix}_MIN", default_min)), int(os.getenv(f"{prefix}_MAX", default_max))
+
+
+# Fila do worker -> filas que contam para a sua carga e limites do pool por worker
+SCALED_QUEUES = {
+    "ingest-fr": {"queues": ("ingest-live", "ingest-fr"), "bounds": _bounds("ingest-fr", 1, 8)},
+    "ingest-nc": {"queues": ("ingest-live", "ingest-nc"), "bounds": _bounds("ingest-nc", 1, 4)},
+    "sftp-upload": {"queues": ("sftp-upload",), "bounds": _bounds("sftp-upload", 1, 8)},
+}
+
+
+def record_queue_wait(redis_client, queue: str, seconds: float, now: float = None):
+    """Atualiza a EWMA da espera em fila (chamado no task_prerun dos workers)"""
+    now = now or time.time()
+    previous = current_wait(redis_client.hmget(LATENCY_KEY, queue, f"{queue}:at"), now)
+    redis_client.hset(LATENCY_KEY, mapping={queue: ewma(previous, max(0.0, seconds)), f"{queue}:at": now})
+
+
+def current_wait(sample, now: float):
+    """EWMA guardada ([valor, instante]) ou None se não existe ou está desatualizada"""
+    value, updated_at = sample
+    if not value or not updated_at or now - float(updated_at) > AUTOSCALE_WAIT_STALE:
+        return None
+    return float(value)
+
+
+def decide(current: int, depth: int, wait: float, idle_rounds: int, min_size: int, max_size: int):
+    """Novo tamanho do pool e contador de folga.
+    Cresce logo que há pressão; só encolhe após AUTOSCALE_DOWN_AFTER avaliações sem carga."""
+    # Fila vazia: nenhuma mensagem está à espera, qualquer que seja a última EWMA medida
+    wait = (wait or 0) if depth else 0
+    pressure = depth > AUTOSCALE_UP_BACKLOG_PER_PROCESS * max(1, current) or wait > AUTOSCALE_TARGET_WAIT
+    idle = depth == 0
+
+    if pressure:
+        # Crescer em proporção ao backlog, limitado ao dobro por avaliação
+        wanted = math.ceil(depth / AUTOSCALE_UP_BACKLOG_PER_PROCESS) if depth else current + 1
+        return max(min_size, min(max_size, max(current + 1, min(wanted, current * 2)))), 0
+    if idle:
+        idle_rounds += 1
+        if idle_rounds >= AUTOSCALE_DOWN_AFTER:
+            return max(min_size, current - 1), 0
+        return max(min_size, min(max_size, current)), idle_rounds
+    return max(min_size, min(max_size, current)), 0
+
+
+def desired_replicas(replicas: int, size: int, max_size: int, min_size: int, pressure_at_max: bool) -> int:
+    if pressure_at_max and size >= max_size:
+        return min(AUTOSCALE_MAX_REPLICAS, replicas + 1)
+    if size <= min_size and replicas > 1:
+        return replicas - 1
+    return max(1, replicas)
+
+
+def _pool_sizes(celery_app, worker_queue: str) -> dict:
+    """Tamanho atual do pool de cada worker '<fila>@host'"""
+    stats = celery_app.control.inspect(timeout=2.0).stats() or {}
+    sizes = {}
+    for node, info in stats.items():
+        if not node.startswith(f"{worker_queue}@"):
+            continue
+        pool = info.get("pool", {})
+        processes = pool.get("processes")
+        sizes[node] = len(processes) if isinstance(processes, list) else int(pool.get("max-concurrency", 1))
+    return sizes
+
+
+def run_autoscaler(celery_app, redis_client) -> dict:
+    """Uma avaliação para todas as filas escaláveis; devolve as decisões tomadas"""
+    decisions = {}
+    for worker_queue, config in SCALED_QUEUES.items():
+        min_size, max_size = config["bounds"]
+        depth = queue_depth(redis_client, config["queues"])
+        now = time.time()
+        samples = redis_client.hmget(LATENCY_KEY, *[field for queue in config["queues"] for field in (queue, f"{queue}:at")])
+        waits = [current_wait(samples[i:i + 2], now) for i in range(0, len(samples), 2)]
+        wait = max((w for w in waits if w is not None), default=0.0)
+
+        sizes = _pool_sizes(celery_app, worker_queue)
+        if not sizes:
+            decisions[worker_queue] = {"depth": depth, "wait": wait, "workers": 0}
+            continue
+
+        idle_rounds = int(redis_client.hget(STATE_KEY, f"{worker_queue}:idle") or 0)
+        # Profundidade repartida pelos workers da fila; todos seguem o mesmo tamanho
+        current = round(sum(sizes.values()) / len(sizes))
+        target, idle_rounds = decide(current, math.ceil(depth / len(sizes)), wait, idle_rounds, min_size, max_size)
+        redis_client.hset(STATE_KEY, f"{worker_queue}:idle", idle_rounds)
+
+        for node, size in sizes.items():
+            if target > size:
+                celery_app.control.pool_grow(target - size, destination=[node])
+            elif target < size:
+                celery_app.control.pool_shrink(size - target, destination=[node])
+
+        replicas = desired_replicas(len(sizes), target, max_size, min_size,
+                                    depth > AUTOSCALE_UP_BACKLOG_PER_PROCESS * target * len(sizes))
+        redis_client.hset(REPLICAS_KEY, worker_queue, replicas)
+
+        if target != current:
+            logger.info(f"📈 {worker_queue}: pool {current} → {target} (fila {depth}, espera {wait:.1f}s)")
+        decisions[worker_queue] = {"depth": depth, "wait": round(wait, 2), "workers": len(sizes),
+                                   "pool_from": current, "pool_to": target, "replicas": replicas}
+
+    redis_client.hset(STATE_KEY, "evaluated_at", time.time())
+    return decisions
@@ -2,12 +2,16 @@ import os
 import json
 import logging
 import re
+from collections import defaultdict
 from pathlib import Path
 from datetime import datetime
 import pytz
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+from utils.db_metrics import execute_query
+from utils.stage_metrics import stage
+from utils.file_utils import nif_from_local_filename
 from utils.xml_parser import (
     extract_references_from_nc_xml,
     extract_nif_from_filename,
@@ -36,18 +40,18 @@ def insert_companies_batch(companies_data):
         
         if len(companies_data) == 1:
             try:
-                response = supabase.table("companies").upsert(
+                response = execute_query(supabase.table("companies").upsert(
                     companies_data[0],
                     on_conflict="company_id"
-                ).execute()
+                ), "companies.upsert")
             except Exception as e:
                 logger.error(f"❌ Erro ao inserir empresa individual: {str(e)}")
                 raise
         else:
-            response = supabase.table("companies").upsert(
+            response = execute_query(supabase.table("companies").upsert(
                 companies_data,
                 on_conflict="company_id"
-            ).execute()
+            ), "companies.upsert")
         
         if response.data:
             logger.info(f"✅ {len(response.data)} empresas inseridas/atualizadas")
@@ -80,20 +84,20 @@ def insert_companies_batch(companies_data):
         if len(cleaned_companies) == 1:
             # Se for apenas um, tentar inserir diretamente
             try:
-                response = supabase.table("companies").upsert(
+                response = execute_query(supabase.table("companies").upsert(
                     cleaned_companies[0],
                     on_conflict="company_id"
-                ).execute()
+                ), "companies.upsert")
             except Exception as e:
                 logger.error(f"❌ Erro ao inserir empresa individual: {str(e)}")
                 logger.error(f"📋 Dados que causaram erro: {json.dumps(cleaned_companies[0], default=str, ensure_ascii=False)}")
                 raise
         else:
             # Usar upsert para evitar duplicatas
-            response = supabase.table("companies").upsert(
+            response = execute_query(supabase.table("companies").upsert(
                 cleaned_companies,
                 on_conflict="company_id"
-            ).execute()
+            ), "companies.upsert")
         
         if response.data:
             logger.info(f"✅ {len(response.data)} empresas inseridas/atualizadas")
@@ -116,18 +120,18 @@ def insert_filiais_batch(filiais_data):
         
         if len(filiais_data) == 1:
             try:
-                response = supabase.table("filiais").upsert(
+                response = execute_query(supabase.table("filiais").upsert(
                     filiais_data[0],
                     on_conflict="filial_number"
-                ).execute()
+                ), "filiais.upsert")
             except Exception as e:
                 logger.error(f"❌ Erro ao inserir filial individual: {str(e)}")
                 raise
         else:
-            response = supabase.table("filiais").upsert(
+            response = execute_query(supabase.table("filiais").upsert(
                 filiais_data,
                 on_conflict="filial_number"
-            ).execute()
+            ), "filiais.upsert")
         
         if response.data:
             logger.info(f"✅ {len(response.data)} filiais inseridas/atualizadas")
@@ -162,20 +166,20 @@ def insert_filiais_batch(filiais_data):
         # Tentar inserir um por um primeiro para identificar problemas
         if len(cleaned_filiais) == 1:
             try:
-                response = supabase.table("filiais").upsert(
+                response = execute_query(supabase.table("filiais").upsert(
                     cleaned_filiais[0],
                     on_conflict="filial_number"
-                ).execute()
+                ), "filiais.upsert")
             except Exception as e:
                 logger.error(f"❌ Erro ao inserir filial individual: {str(e)}")
                 logger.error(f"📋 Dados que causaram erro: {json.dumps(cleaned_filiais[0], default=str, ensure_ascii=False)}")
                 raise
         else:
             # Usar upsert para evitar duplicatas baseado no filial_number que é único
-            response = supabase.table("filiais").upsert(
+            response = execute_query(supabase.table("filiais").upsert(
                 cleaned_filiais,
                 on_conflict="filial_number"
-            ).execute()
+            ), "filiais.upsert")
         
         if response.data:
             logger.info(f"✅ {len(response.data)} filiais inseridas/atualizadas")
@@ -198,18 +202,18 @@ def insert_invoices_batch(invoices_data):
         
         if len(invoices_data) == 1:
             try:
-                response = supabase.table("invoices").upsert(
+                response = execute_query(supabase.table("invoices").upsert(
                     invoices_data[0],
                     on_conflict="invoice_no,company_id"
-                ).execute()
+                ), "invoices.upsert")
             except Exception as e:
                 logger.error(f"❌ Erro ao inserir fatura individual: {str(e)}")
                 raise
         else:
-            response = supabase.table("invoices").upsert(
+            response = execute_query(supabase.table("invoices").upsert(
                 invoices_data,
                 on_conflict="invoice_no,company_id"
-            ).execute()
+            ), "invoices.upsert")
         
         if response.data:
             logger.info(f"✅ {len(response.data)} faturas inseridas/atualizadas")
@@ -229,7 +233,7 @@ def insert_invoice_lines_batch(lines_data):
             return
         
         # Inserir linhas em lote
-        response = supabase.table("invoice_lines").insert(lines_data).execute()
+        response = execute_query(supabase.table("invoice_lines").insert(lines_data), "invoice_lines.insert")
         
         logger.info(f"✅ {len(lines_data)} linhas de faturas processadas em lote")
         return response
@@ -244,7 +248,7 @@ def insert_file_links_batch(links_data):
             return
         
         # Inserir links em lote
-        response = supabase.table("invoice_file_links").insert(links_data).execute()
+        response = execute_query(supabase.table("invoice_file_links").insert(links_data), "invoice_file_links.insert")
         
         logger.info(f"✅ {len(links_data)} links de arquivos processados em lote")
         return response
@@ -252,6 +256,20 @@ def insert_file_links_batch(links_data):
     except Exception as e:
         logger.error(f"Erro ao inserir links em lote: {str(e)}")
         return None
+def update_rollups(invoice_ids) -> bool:
+    """Aplica aos agregados horários de vendas (sales_rollup_hourly) e diários de produtos
+    (product_rollup_daily) a diferença de contribuição destas faturas, numa só RPC"""
+    invoice_ids = sorted(set(invoice_ids or []))
+    if not invoice_ids:
+        return True
+    try:
+        execute_query(supabase.rpc("apply_rollup_deltas", {"p_invoice_ids": invoice_ids}), "rpc.apply_rollup_deltas")
+        logger.info(f"📈 Agregados atualizados para {len(invoice_ids)} fatura(s)")
+        return True
+    except Exception as e:
+        # Falha nos agregados não invalida a ingestão; reprocessar a fatura volta a aplicar a diferença
+        logger.error(f"❌ Erro ao atualizar agregados: {str(e)}")
+        return False
 def process_and_insert_invoice_batch(data: dict):
     """Processa e insere fatura no Supabase usando inserção em lote da memória"""
     try:
@@ -266,28 +284,38 @@ def process_and_insert_invoice_batch(data: dict):
         
         if companies_batch:
             logger.info(f"🏢 Inserindo {len(companies_batch)} empresas...")
-            insert_companies_batch(companies_batch)
+            with stage("db.companies"):
+                insert_companies_batch(companies_batch)
 
         if filiais_batch:
             logger.info(f"🏪 Inserindo {len(filiais_batch)} filiais...")
-            insert_filiais_batch(filiais_batch)
+            with stage("db.filiais"):
+                insert_filiais_batch(filiais_batch)
 
         logger.info(f"📄 Inserindo {len(invoices_batch)} faturas...")
-        invoices_response = insert_invoices_batch(invoices_batch)
+        with stage("db.invoices"):
+            invoices_response = insert_invoices_batch(invoices_batch)
         
         if invoices_response and invoices_response.data:
-            existing_file = supabase.table("invoice_files").select("id").eq("filename", data["arquivo_origem"]).execute()
+            # Aplicar desativações de NCs que chegaram antes desta FR (antes das linhas,
+            # para que os agregados de produtos já vejam active = false)
+            with stage("db.pending_deactivations"):
+                apply_pending_deactivations(invoices_response.data)
+
+            with stage("db.invoice_files"):
+                existing_file = execute_query(supabase.table("invoice_files").select("id").eq("filename", data["arquivo_origem"]), "invoice_files.select")
             
             if existing_file.data:
                 file_id = existing_file.data[0]["id"]
                 logger.info(f"ℹ️ Arquivo já existe com ID: {file_id}, reutilizando")
             else:
                 logger.info("📝 Inserindo arquivo no banco (faturas foram inseridas)...")
-                file_insert = supabase.table("invoice_files").insert({
-                    "filename": data["arquivo_origem"],
-                    "data_processamento": data["data_processamento"],
-                    "total_faturas": data["total_faturas"]
-                }).execute()
+                with stage("db.invoice_files"):
+                    file_insert = execute_query(supabase.table("invoice_files").insert({
+                        "filename": data["arquivo_origem"],
+                        "data_processamento": data["data_processamento"],
+                        "total_faturas": data["total_faturas"]
+                    }), "invoice_files.insert")
 
                 if not file_insert.data:
                     logger.error("❌ Erro: Resposta vazia ao inserir arquivo")
@@ -315,10 +343,11 @@ def process_and_insert_invoice_batch(data: dict):
                     # IMPORTANTE: Apagar TODAS as linhas antigas desta fatura antes de inserir as novas!
                     # Isto garante que quando uma fatura é reprocessada (upsert), as linhas antigas
                     # não ficam "presas" na base de dados com dados corrompidos ou desatualizados.
-                    existing_lines = supabase.table("invoice_lines").select("id").eq("invoice_id", invoice_id).execute()
-                    if existing_lines.data and len(existing_lines.data) > 0:
-                        logger.info(f"🗑️ Apagando {len(existing_lines.data)} linhas antigas da fatura {inv_no} (empresa {comp_id}) antes de reinserir...")
-                        supabase.table("invoice_lines").delete().eq("invoice_id", invoice_id).execute()
+                    with stage("db.line_cleanup"):
+                        existing_lines = execute_query(supabase.table("invoice_lines").select("id").eq("invoice_id", invoice_id), "invoice_lines.select")
+                        if existing_lines.data and len(existing_lines.data) > 0:
+                            logger.info(f"🗑️ Apagando {len(existing_lines.data)} linhas antigas da fatura {inv_no} (empresa {comp_id}) antes de reinserir...")
+                            execute_query(supabase.table("invoice_lines").delete().eq("invoice_id", invoice_id), "invoice_lines.delete")
                     
                     if inv_no in lines_by_invoice:
                         for linha in lines_by_invoice[inv_no]:
@@ -326,7 +355,8 @@ def process_and_insert_invoice_batch(data: dict):
                             linha_with_invoice_id["invoice_id"] = invoice_id
                             lines_batch.append(linha_with_invoice_id)
 
-                    existing_link = supabase.table("invoice_file_links").select("id").eq("invoice_id", invoice_id).eq("invoice_file_id", file_id).execute()
+                    with stage("db.links"):
+                        existing_link = execute_query(supabase.table("invoice_file_links").select("id").eq("invoice_id", invoice_id).eq("invoice_file_id", file_id), "invoice_file_links.select")
                     if not existing_link.data:
                         links_batch.append({
                             "invoice_file_id": file_id,
@@ -337,11 +367,17 @@ def process_and_insert_invoice_batch(data: dict):
 
             if lines_batch:
                 logger.info(f"📋 Inserindo {len(lines_batch)} linhas de faturas...")
-                insert_invoice_lines_batch(lines_batch)
+                with stage("db.lines"):
+                    insert_invoice_lines_batch(lines_batch)
 
             if links_batch:
                 logger.info(f"🔗 Inserindo {len(links_batch)} links de arquivos...")
-                insert_file_links_batch(links_batch)
+                with stage("db.links"):
+                    insert_file_links_batch(links_batch)
+
+            # Atualizar agregados (vendas e produtos) com a diferença trazida por estas faturas
+            with stage("db.rollups"):
+                update_rollups(invoice["id"] for invoice in invoices_response.data)
         else:
             logger.error("❌ Falha ao inserir faturas, arquivo e linhas não serão inseridas")
             return False
@@ -354,45 +390,256 @@ def process_and_insert_invoice_batch(data: dict):
         import traceback
         traceback.print_exc()
         return False
-def deactivate_invoice(invoice_no: str) -> bool:
-    """Desativa uma fatura (marca active = false) ao invés de deletar"""
+def process_and_insert_invoice_micro_batch(datasets: list) -> dict:
+    """Insere vários ficheiros pequenos (mesmo NIF) com upserts combinados.
+    Cada ficheiro mantém o seu registo em invoice_files e os seus links; devolve {arquivo_origem: sucesso}"""
+    filenames = [data["arquivo_origem"] for data in datasets]
     try:
-        logger.info(f"🔄 Iniciando desativação da fatura: {invoice_no}")
-        
-        # 1. Buscar a fatura pelo número
-        invoice_response = supabase.table("invoices").select("id, active").eq("invoice_no", invoice_no).execute()
+        logger.info(f"🔄 Inserção combinada de {len(datasets)} ficheiros na DB")
+
+        # Juntar lotes; uma fatura repetida entre ficheiros fica com a última versão e liga a todos
+        companies = {}
+        filiais = {}
+        invoices = {}
+        lines = {}
+        files_by_invoice = defaultdict(list)
+        for data in datasets:
+            for company in data.get("companies_batch", []):
+                companies[company["company_id"]] = company
+            for filial in data.get("filiais_batch", []):
+                filiais[filial["filial_number"]] = filial
+            lines_by_invoice = data.get("lines_by_invoice", {})
+            for invoice in data.get("invoices_batch", []):
+                key = (invoice["invoice_no"], invoice.get("company_id", ""))
+                invoices[key] = invoice
+                lines[key] = lines_by_invoice.get(invoice["invoice_no"], [])
+                files_by_invoice[key].append(data["arquivo_origem"])
+
+        if companies:
+            with stage("db.companies"):
+                insert_companies_batch(list(companies.values()))
+        if filiais:
+            with stage("db.filiais"):
+                insert_filiais_batch(list(filiais.values()))
+
+        invoices_batch = list(invoices.values())
+        with stage("db.invoices"):
+            invoices_response = insert_invoices_batch(invoices_batch)
+        if not invoices_response or not invoices_response.data:
+            logger.error("❌ Falha ao inserir faturas do lote, ficheiros e linhas não serão inseridos")
+            return {filename: False for filename in filenames}
+
+        with stage("db.pending_deactivations"):
+            apply_pending_deactivations(invoices_response.data)
+
+        # Um registo invoice_files por ficheiro, com um select e um insert para o lote todo
+        with stage("db.invoice_files"):
+            existing_files = execute_query(supabase.table("invoice_files").select("id, filename").in_("filename", filenames), "invoice_files.select")
+        file_ids = {row["filename"]: row["id"] for row in existing_files.data or []}
+        new_files = {}
+        for data in datasets:
+            if data["arquivo_origem"] not in file_ids:
+                new_files[data["arquivo_origem"]] = {
+                    "filename": data["arquivo_origem"],
+                    "data_processamento": data["data_processamento"],
+                    "total_faturas": data["total_faturas"]
+                }
+        if new_files:
+            with stage("db.invoice_files"):
+                file_insert = execute_query(supabase.table("invoice_files").insert(list(new_files.values())), "invoice_files.insert")
+            for row in file_insert.data or []:
+                file_ids[row["filename"]] = row["id"]
+
+        invoice_mapping = {(invoice["invoice_no"], invoice.get("company_id", "")): invoice["id"] for invoice in invoices_response.data}
+        invoice_ids = [invoice_mapping[key] for key in invoices if key in invoice_mapping]
+
+        linked = set()
+        if invoice_ids:
+            # Reprocessamento: apagar as linhas antigas de todas as faturas numa só chamada
+            with stage("db.line_cleanup"):
+                execute_query(supabase.table("invoice_lines").delete().in_("invoice_id", invoice_ids), "invoice_lines.delete")
+            if file_ids:
+                with stage("db.links"):
+                    existing_links = execute_query(supabase.table("invoice_file_links").select("invoice_id, invoice_file_id")
+                                                   .in_("invoice_id", invoice_ids).in_("invoice_file_id", list(file_ids.values())),
+                                                   "invoice_file_links.select")
+                linked = {(row["invoice_id"], row["invoice_file_id"]) for row in existing_links.data or []}
+
+        failed_files = {filename for filename in filenames if filename not in file_ids}
+        failed_files.update(data["arquivo_origem"] for data in datasets if not data.get("invoices_batch"))
+        lines_batch = []
+        links_batch = []
+        for key in invoices:
+            invoice_id = invoice_mapping.get(key)
+            if not invoice_id:
+                logger.warning(f"⚠️ Fatura {key[0]} não foi inserida, linhas ignoradas")
+                failed_files.update(files_by_invoice[key])
+                continue
+            for linha in lines[key]:
+                linha_with_invoice_id = linha.copy()
+                linha_with_invoice_id["invoice_id"] = invoice_id
+                lines_batch.append(linha_with_invoice_id)
+            for filename in files_by_invoice[key]:
+                file_id = file_ids.get(filename)
+                if file_id and (invoice_id, file_id) not in linked:
+                    links_batch.append({"invoice_file_id": file_id, "invoice_id": invoice_id})
+                    linked.add((invoice_id, file_id))
+
+        if lines_batch:
+            logger.info(f"📋 Inserindo {len(lines_batch)} linhas de faturas...")
+            with stage("db.lines"):
+                insert_invoice_lines_batch(lines_batch)
+
+        if links_batch:
+            logger.info(f"🔗 Inserindo {len(links_batch)} links de arquivos...")
+            with stage("db.links"):
+                insert_file_links_batch(links_batch)
+
+        with stage("db.rollups"):
+            update_rollups(invoice_ids)
+
+        logger.info(f"✅ Lote combinado inserido: {len(filenames) - len(failed_files)}/{len(filenames)} ficheiros")
+        return {filename: filename not in failed_files for filename in filenames}
+
+    except Exception as e:
+        logger.error(f"Erro ao inserir lote combinado no banco: {str(e)}")
+        return {filename: False for filename in filenames}
+def find_invoice_for_deactivation(invoice_no: str, company_id: str):
+    """Busca a fatura da empresa pelo número com os campos necessários à desativação (None se não existir).
+    O número só é único dentro do NIF: outra empresa pode ter uma fatura com o mesmo número"""
+    invoice_response = execute_query(supabase.table("invoices").select("id, invoice_no, active, company_id, filial, invoice_date")
+                                     .eq("invoice_no", invoice_no).eq("company_id", company_id), "invoices.select")
+    return invoice_response.data[0] if invoice_response.data else None
+def deactivate_invoice_row(invoice: dict, refresh_rollups: bool = True) -> bool:
+    """Marca active = false numa fatura já carregada e retira-a dos agregados"""
+    invoice_no = invoice.get("invoice_no")
+    invoice_id = invoice["id"]
+    current_active = invoice.get("active", True)
+
+    # Verificar se já está desativada
+    if current_active is False:
+        logger.info(f"ℹ️ Fatura {invoice_no} já está desativada")
+        return True
+
+    logger.info(f"📋 Fatura encontrada com ID: {invoice_id}, status atual: active={current_active}")
+
+    invoice_update = execute_query(supabase.table("invoices").update({
+        "active": False
+    }).eq("id", invoice_id), "invoices.update")
+
+    if invoice_update.data:
+        logger.info(f"✅ Fatura {invoice_no} desativada com sucesso (active = false)")
+        if refresh_rollups:
+            update_rollups([invoice_id])
+        return True
+
+    logger.error(f"❌ Falha ao desativar fatura {invoice_no}")
+    return False
+def deactivate_invoice(invoice_no: str, company_id: str) -> bool:
+    """Desativa uma fatura da empresa (marca active = false) ao invés de deletar"""
+    try:
+        logger.info(f"🔄 Iniciando desativação da fatura: {invoice_no} ({company_id})")
         
-        if not invoice_response.data:
+        invoice = find_invoice_for_deactivation(invoice_no, company_id)
+        if not invoice:
             logger.warning(f"⚠️ Fatura não encontrada: {invoice_no}")
             return False
         
-        invoice_id = invoice_response.data[0]["id"]
-        current_active = invoice_response.data[0].get("active", True)
-        
-        # Verificar se já está desativada
-        if current_active is False:
-            logger.info(f"ℹ️ Fatura {invoice_no} já está desativada")
-            return True
-        
-        logger.info(f"📋 Fatura encontrada com ID: {invoice_id}, status atual: active={current_active}")
-        
-        # 2. Atualizar a fatura para active = false
-        invoice_update = supabase.table("invoices").update({
-            "active": False
-        }).eq("id", invoice_id).execute()
-        
-        if invoice_update.data:
-            logger.info(f"✅ Fatura {invoice_no} desativada com sucesso (active = false)")
-            return True
-        else:
-            logger.error(f"❌ Falha ao desativar fatura {invoice_no}")
-            return False
+        return deactivate_invoice_row(invoice)
         
     except Exception as e:
         logger.error(f"❌ Erro ao desativar fatura {invoice_no}: {str(e)}")
         return False
+def record_pending_deactivations(entries) -> bool:
+    """Regista no ledger (pending_deactivations) as referências de uma NC"""
+    if not entries:
+        return True
+    try:
+        execute_query(supabase.table("pending_deactivations").upsert(
+            entries,
+            on_conflict="invoice_no,company_id"
+        ), "pending_deactivations.upsert")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Erro ao registar desativações pendentes: {str(e)}")
+        return False
+def _ledger_keys_by_company(keys) -> dict:
+    """{company_id: [invoice_no]} a partir de pares (invoice_no, company_id) do ledger"""
+    by_company = {}
+    for invoice_no, company_id in set(keys or []):
+        by_company.setdefault(company_id, []).append(invoice_no)
+    return {company_id: sorted(invoice_nos) for company_id, invoice_nos in by_company.items()}
+def mark_deactivations_applied(keys) -> None:
+    """Marca como aplicadas as entradas do ledger (invoice_no, company_id) indicadas"""
+    try:
+        for company_id, invoice_nos in _ledger_keys_by_company(keys).items():
+            execute_query(supabase.table("pending_deactivations").update({
+                "applied_at": datetime.now(tz=pytz.timezone('Europe/Lisbon')).isoformat()
+            }).eq("company_id", company_id).in_("invoice_no", invoice_nos).is_("applied_at", "null"), "pending_deactivations.update")
+    except Exception as e:
+        logger.error(f"❌ Erro ao marcar desativações como aplicadas: {str(e)}")
+def apply_pending_deactivations(invoices) -> list:
+    """Aplica as desativações registadas por NCs às faturas acabadas de gravar.
+
+    Consulta o ledger inteiro (aplicado ou não) para que reprocessar uma FR
+    já anulada (o upsert repõe active = true) volte a desativá-la."""
+    by_invoice_no = {invoice["invoice_no"]: invoice for invoice in invoices or [] if invoice.get("invoice_no")}
+    if not by_invoice_no:
+        return []
+    try:
+        ledger = execute_query(supabase.table("pending_deactivations").select("invoice_no, company_id").in_("invoice_no", sorted(by_invoice_no)), "pending_deactivations.select")
+    except Exception as e:
+        logger.error(f"❌ Erro ao consultar desativações pendentes: {str(e)}")
+        return []
+
+    applied = []
+    for entry in ledger.data or []:
+        invoice = by_invoice_no.get(entry["invoice_no"])
+        if not invoice:
+            continue
+        if entry.get("company_id") and entry["company_id"] != invoice.get("company_id"):
+            continue
+        logger.info(f"🧾 Aplicando desativação pendente da fatura {invoice['invoice_no']}")
+        # Os agregados são atualizados pelo fluxo de inserção a seguir
+        if deactivate_invoice_row(invoice, refresh_rollups=False):
+            invoice["active"] = False
+            applied.append((invoice["invoice_no"], entry.get("company_id", "")))
+
+    mark_deactivations_applied(applied)
+    return [invoice_no for invoice_no, _ in applied]
+def reconcile_pending_deactivations(limit: int = 500) -> dict:
+    """Tenta aplicar entradas do ledger ainda pendentes (ex: falhas transitórias na desativação).
+    Começa pelas entradas nunca tentadas ou há mais tempo sem tentativa, e marca a tentativa nas
+    que continuam pendentes, por isso rondas seguintes avançam pelo ledger em vez de repetir as mesmas"""
+    pending = execute_query(supabase.table("pending_deactivations").select("invoice_no, company_id").is_("applied_at", "null")
+                            .order("last_attempt_at", nullsfirst=True).order("created_at").limit(limit), "pending_deactivations.select")
+    applied = []
+    still_pending = []
+    for entry in pending.data or []:
+        key = (entry["invoice_no"], entry.get("company_id", ""))
+        if deactivate_invoice(*key):
+            applied.append(key)
+        else:
+            still_pending.append(key)
+    mark_deactivations_applied(applied)
+    mark_deactivations_attempted(still_pending)
+    return {"applied": applied, "pending": still_pending}
+def mark_deactivations_attempted(keys) -> None:
+    """Regista a tentativa nas entradas do ledger (invoice_no, company_id) que continuam pendentes"""
+    try:
+        for company_id, invoice_nos in _ledger_keys_by_company(keys).items():
+            execute_query(supabase.table("pending_deactivations").update({
+                "last_attempt_at": datetime.now(tz=pytz.timezone('Europe/Lisbon')).isoformat()
+            }).eq("company_id", company_id).in_("invoice_no", invoice_nos).is_("applied_at", "null"), "pending_deactivations.update")
+    except Exception as e:
+        logger.error(f"❌ Erro ao registar tentativa de desativações pendentes: {str(e)}")
 def process_nc_file(xml_file_path: str) -> dict:
-    """Processa arquivo NC (Nota de Crédito) e desativa faturas referenciadas (active = false)"""
+    """Processa arquivo NC (Nota de Crédito) e desativa faturas referenciadas (active = false).
+
+    Cada referência é primeiro registada em pending_deactivations; se a FR
+    ainda não foi ingerida fica pendente e é aplicada quando a FR for gravada
+    por process_and_insert_invoice_batch, por isso FRs e NCs podem ser
+    processadas em qualquer ordem."""
     try:        
         # Extrair referências do arquivo NC
         references = extract_references_from_nc_xml(xml_file_path)
@@ -403,39 +650,57 @@ def process_nc_file(xml_file_path: str) -> dict:
                 "status": "warning",
                 "message": "Nenhuma referência encontrada",
                 "deactivated_invoices": [],
-                "failed_deactivations": []
+                "failed_deactivations": [],
+                "pending_deactivations": []
             }
         
+        nc_filename = os.path.basename(xml_file_path)
+        company_id = nif_from_local_filename(nc_filename)
         deactivated_invoices = []
         failed_deactivations = []
+        pending_deactivations = []
         
-        # Processar cada referência
+        # Extrair número da fatura de cada referência (ex: "FR 201803Y2025/239")
+        # Padrão esperado: FR + espaços + números + Y + ano/número
+        invoice_pattern = r'FR\s+\d+Y\d{4}/\d+'
+        invoice_nos = []
         for reference in references:
             logger.info(f"🔍 Processando referência: {reference}")
-            
-            # Extrair número da fatura da referência (ex: "FR 201803Y2025/239")
-            # Padrão esperado: FR + espaços + números + Y + ano/número
-            invoice_pattern = r'FR\s+\d+Y\d{4}/\d+'
             match = re.search(invoice_pattern, reference)
-            
             if match:
-                invoice_no = match.group(0)
-                
-                # Tentar desativar a fatura (marcar active = false)
-                if deactivate_invoice(invoice_no):
-                    deactivated_invoices.append(invoice_no)
-                else:
-                    failed_deactivations.append(invoice_no)
+                invoice_nos.append((match.group(0), reference))
             else:
                 logger.warning(f"⚠️ Padrão de fatura não reconhecido na referência: {reference}")
                 failed_deactivations.append(reference)
-        
+
+        # 1. Registar no ledger antes de procurar a fatura: se a FR for gravada em
+        #    paralelo, ou esta NC a encontra, ou a FR encontra a entrada do ledger
+        ledger_entries = [
+            {"invoice_no": invoice_no, "company_id": company_id, "nc_file": nc_filename, "reference": reference}
+            for invoice_no, reference in invoice_nos
+        ]
+        if not record_pending_deactivations(ledger_entries):
+            raise RuntimeError("Não foi possível registar as referências no ledger de desativações")
+
+        # 2. Desativar as faturas que já existem
+        for invoice_no, _ in invoice_nos:
+            invoice = find_invoice_for_deactivation(invoice_no, company_id)
+            if invoice is None:
+                logger.info(f"⏳ Fatura {invoice_no} ainda não existe, desativação fica pendente")
+                pending_deactivations.append(invoice_no)
+            elif deactivate_invoice_row(invoice):
+                deactivated_invoices.append(invoice_no)
+            else:
+                failed_deactivations.append(invoice_no)
+
+        mark_deactivations_applied([(invoice_no, company_id) for invoice_no in deactivated_invoices])
         
         return {
             "status": "success",
-            "message": f"NC processado: {len(deactivated_invoices)} faturas desativadas, {len(failed_deactivations)} falhas",
+            "message": f"NC processado: {len(deactivated_invoices)} faturas desativadas, {len(pending_deactivations)} pendentes, {len(failed_deactivations)} falhas",
             "deactivated_invoices": deactivated_invoices,
             "failed_deactivations": failed_deactivations,
+            "pending_deactivations": pending_deactivations,
             "total_references": len(references)
         }
         
@@ -445,7 +710,8 @@ def process_nc_file(xml_file_path: str) -> dict:
             "status": "error",
             "message": str(e),
             "deactivated_invoices": [],
-            "failed_deactivations": []
+            "failed_deactivations": [],
+            "pending_deactivations": []
         }
 def insert_opengcs_to_supabase(opengcs_data: dict, xml_file_path: str) -> bool:
     """Insere dados OpenGCs no Supabase"""
@@ -467,17 +733,17 @@ def insert_opengcs_to_supabase(opengcs_data: dict, xml_file_path: str) -> bool:
         logger.info(f"🏪 Inserindo dados OpenGCs para NIF: {nif}, filial: {filial}")
         
         # Verificar se já existe um registro com este NIF e filial
-        existing_record = supabase.table("open_gcs_json").select("loja_id").eq("nif", nif).eq("filial", filial).execute()
+        existing_record = execute_query(supabase.table("open_gcs_json").select("loja_id").eq("nif", nif).eq("filial", filial), "open_gcs_json.select")
         
         if existing_record.data:
             # Atualizar registro existente
             loja_id = existing_record.data[0]["loja_id"]
             logger.info(f"🔄 Atualizando registro existente com loja_id: {loja_id}")
             
-            response = supabase.table("open_gcs_json").update({
+            response = execute_query(supabase.table("open_gcs_json").update({
                 "data": opengcs_data,
                 "updated_at": datetime.now(tz=pytz.timezone('Europe/Lisbon')).isoformat()
-            }).eq("loja_id", loja_id).execute()
+            }).eq("loja_id", loja_id), "open_gcs_json.update")
             
             if response.data:
                 logger.info(f"✅ Dados OpenGCs atualizados para NIF: {nif}, filial: {filial}")
@@ -500,7 +766,7 @@ def insert_opengcs_to_supabase(opengcs_data: dict, xml_file_path: str) -> bool:
                 "updated_at": datetime.now(tz=pytz.timezone('Europe/Lisbon')).isoformat()
             }
             
-            response = supabase.table("open_gcs_json").insert(data_to_insert).execute()
+            response = execute_query(supabase.table("open_gcs_json").insert(data_to_insert), "open_gcs_json.insert")
             
             if response.data:
                 logger.info(f"✅ Dados OpenGCs inseridos para NIF: {nif}, filial: {filial}")
@@ -0,0 +1,144 @@
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Controlador de escoamento do backlog SFTP.
+# Em vez de 50 ficheiros a cada 180 s, o scan volta a ser agendado assim que o
+# ciclo anterior termina e ainda há ficheiros; o tamanho do lote segue o tempo
+# medido por ficheiro e a profundidade das filas, e recua quando a DB sofre.
+
+DRAIN_MODE = os.getenv("DRAIN_MODE", "true").lower() == "true"
+DRAIN_MIN_BATCH = int(os.getenv("DRAIN_MIN_BATCH", "5"))
+DRAIN_MAX_BATCH = int(os.getenv("DRAIN_MAX_BATCH", "500"))
+DRAIN_INITIAL_BATCH = int(os.getenv("MAX_FILES_PER_BATCH", "50"))
+DRAIN_TARGET_CYCLE_SECONDS = float(os.getenv("DRAIN_TARGET_CYCLE_SECONDS", "60"))
+DRAIN_INGEST_CONCURRENCY = int(os.getenv("DRAIN_INGEST_CONCURRENCY", os.getenv("INGEST_FR_CONCURRENCY", "4")))
+DRAIN_MAX_ERROR_RATE = float(os.getenv("DRAIN_MAX_ERROR_RATE", "0.2"))
+DRAIN_MAX_DB_LATENCY = float(os.getenv("DRAIN_MAX_DB_LATENCY", "1.0"))
+DRAIN_BACKOFF_BASE = float(os.getenv("DRAIN_BACKOFF_BASE", "5"))
+DRAIN_MAX_BACKOFF = float(os.getenv("DRAIN_MAX_BACKOFF", "180"))
+DRAIN_MAX_BACKOFF_LEVEL = 6
+EWMA_ALPHA = 0.3
+
+STATE_KEY = "drain:state"
+INGEST_QUEUES = ("ingest-fr", "ingest-nc")
+# Sub-filas de prioridade do transporte Redis do kombu (priority_steps por omissão)
+PRIORITY_SEPARATOR = "\x06\x16"
+PRIORITY_STEPS = (0, 3, 6, 9)
+
+
+def ewma(previous, value, alpha=EWMA_ALPHA):
+    if previous is None:
+        return value
+    return alpha * value + (1 - alpha) * previous
+
+
+def compute_batch_size(file_seconds, queue_depth, backoff_level=0,
+                       concurrency=DRAIN_INGEST_CONCURRENCY,
+                       target_seconds=DRAIN_TARGET_CYCLE_SECONDS,
+                       min_batch=DRAIN_MIN_BATCH, max_batch=DRAIN_MAX_BATCH,
+                       initial_batch=DRAIN_INITIAL_BATCH):
+    """Ficheiros que cabem num ciclo alvo com a concorrência disponível,
+    descontando o que já está em fila e reduzido a metade por nível de backoff"""
+    if not file_seconds or file_seconds <= 0:
+        size = initial_batch
+    else:
+        size = int(target_seconds * concurrency / file_seconds)
+    size -= max(0, int(queue_depth or 0))
+    size = size >> max(0, int(backoff_level))
+    return max(min_batch, min(max_batch, size))
+
+
+def backoff_delay(backoff_level):
+    if backoff_level <= 0:
+        return 0.0
+    return min(DRAIN_MAX_BACKOFF, DRAIN_BACKOFF_BASE * (2 ** (backoff_level - 1)))
+
+
+def queue_depth(redis_client, queues=INGEST_QUEUES):
+    """Mensagens à espera nas filas de ingestão (inclui sub-filas de prioridade)"""
+    depth = 0
+    for queue in queues:
+        for step in PRIORITY_STEPS:
+            key = queue if step == 0 else f"{queue}{PRIORITY_SEPARATOR}{step}"
+            depth += redis_client.llen(key)
+    return depth
+
+
+class DrainController:
+    """Estado do escoamento guardado num hash Redis, partilhado por todos os workers"""
+
+    def __init__(self, redis_client=None):
+        if redis_client is None:
+            from utils.redisUtil import get_redis
+            redis_client = get_redis()
+        self.redis = redis_client
+
+    def state(self) -> dict:
+        raw = self.redis.hgetall(STATE_KEY) or {}
+        return {
+            "file_seconds": float(raw["file_seconds"]) if raw.get("file_seconds") else None,
+            "db_latency": float(raw["db_latency"]) if raw.get("db_latency") else None,
+            "backoff_level": int(raw.get("backoff_level") or 0),
+            "last_batch_size": int(raw.get("last_batch_size") or 0),
+        }
+
+    def plan(self, backlog: int) -> dict:
+        """Tamanho do próximo lote para um backlog de `backlog` ficheiros"""
+        state = self.state()
+        try:
+            depth = queue_depth(self.redis)
+        except Exception as e:
+            logger.warning(f"⚠️ Não foi possível medir a profundidade das filas: {str(e)}")
+            depth = 0
+        size = compute_batch_size(state["file_seconds"], depth, state["backoff_level"])
+        size = min(size, backlog) if backlog else size
+        self.redis.hset(STATE_KEY, "last_batch_size", size)
+        return {"batch_size": size, "queue_depth": depth, **state}
+
+    def record_cycle(self, results, cycle_seconds: float = None) -> dict:
+        """Atualiza tempos médios e nível de backoff a partir dos resultados de um ciclo"""
+        state = self.state()
+        durations = [r["duration_seconds"] for r in results if r.get("duration_seconds") is not None]
+        round_trips = sum((r.get("db") or {}).get("round_trips", 0) for r in results)
+        db_seconds = sum((r.get("db") or {}).get("seconds", 0.0) for r in results)
+        errors = sum(1 for r in results if r.get("status") == "error")
+        error_rate = errors / len(results) if results else 0.0
+        db_latency = db_seconds / round_trips if round_trips else None
+
+        file_seconds = state["file_seconds"]
+        if durations:
+            file_seconds = ewma(file_seconds, sum(durations) / len(durations))
+
+        # Pressão na DB: muitos erros, latência acima do limite ou a subir face à média
+        baseline = state["db_latency"]
+        under_pressure = error_rate > DRAIN_MAX_ERROR_RATE or (
+            db_latency is not None and (
+                db_latency > DRAIN_MAX_DB_LATENCY or (baseline and db_latency > 2 * baseline)
+            )
+        )
+        backoff_level = state["backoff_level"]
+        if under_pressure:
+            backoff_level = min(DRAIN_MAX_BACKOFF_LEVEL, backoff_level + 1)
+        elif backoff_level > 0:
+            backoff_level -= 1
+
+        new_state = {"backoff_level": backoff_level, "updated_at": time.time()}
+        if file_seconds is not None:
+            new_state["file_seconds"] = file_seconds
+        if db_latency is not None:
+            new_state["db_latency"] = ewma(baseline, db_latency)
+        self.redis.hset(STATE_KEY, mapping=new_state)
+
+        if under_pressure:
+            logger.warning(f"🐢 DB sob pressão (erros {error_rate:.0%}, latência {db_latency or 0:.3f}s), backoff nível {backoff_level}")
+        return {
+            "file_seconds": file_seconds,
+            "db_latency": db_latency,
+            "error_rate": error_rate,
+            "backoff_level": backoff_level,
+            "delay": backoff_delay(backoff_level),
+            "cycle_seconds": cycle_seconds,
+        }
@@ -0,0 +1,100 @@
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Via rápida para ficheiros recebidos em tempo real (/receive-file).
+# Os workers de ingestão consomem 'ingest-live' antes de 'ingest-fr'
+# (queue_order_strategy=priority); a guarda de starvation limita quantos ficheiros
+# em tempo real passam à frente por janela enquanto há backlog à espera.
+
+QUEUE_INGEST_LIVE = "ingest-live"
+LIVE_INGEST_ENABLED = os.getenv("LIVE_INGEST_ENABLED", "true").lower() == "true"
+LIVE_MAX_PER_WINDOW = int(os.getenv("LIVE_MAX_PER_WINDOW", "30"))
+LIVE_WINDOW_SECONDS = int(os.getenv("LIVE_WINDOW_SECONDS", "60"))
+
+# Ingestão direta: /receive-file despacha o XML para a ingestão sem o enviar antes ao
+# SFTP; o SFTP passa a ser um arquivo opcional, escrito em background depois da DB.
+DIRECT_INGEST_ENABLED = os.getenv("DIRECT_INGEST_ENABLED", "false").lower() == "true"
+SFTP_ARCHIVE_ENABLED = os.getenv("SFTP_ARCHIVE_ENABLED", "true").lower() == "true"
+# Pastas começadas por '_' são ignoradas pelo scan
+SFTP_ARCHIVE_DIR = os.getenv("SFTP_ARCHIVE_DIR", "/home/mydreami/myDream/_archive")
+
+WINDOW_KEY = "live:window"
+
+
+def choose_live_queue(redis_client, backlog_queue: str, backlog_depth: int) -> str:
+    """Fila para um ficheiro em tempo real: ingest-live, ou a fila normal quando a
+    quota da janela já foi usada e o backlog tem mensagens à espera"""
+    window = int(time.time() // LIVE_WINDOW_SECONDS)
+    key = f"{WINDOW_KEY}:{window}"
+    pipe = redis_client.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, LIVE_WINDOW_SECONDS * 2)
+    used = pipe.execute()[0]
+    if used > LIVE_MAX_PER_WINDOW and backlog_depth > 0:
+        logger.info(f"⚖️ Quota da via rápida esgotada ({used}/{LIVE_MAX_PER_WINDOW}), ficheiro vai para {backlog_queue}")
+        return backlog_queue
+    return QUEUE_INGEST_LIVE
+
+
+# Entradas diretas pendentes: no modo direto o spool guarda a única cópia do ficheiro até à
+# entrega ao SFTP. O registo (sorted set por hora de despacho) deixa o gc reencontrar as que
+# ficaram sem ack (mensagem perdida, tarefa revogada ou expirada) e limita o espaço que ocupam.
+DIRECT_PENDING_KEY = "direct:pending"
+DIRECT_SIZES_KEY = "direct:sizes"
+DIRECT_BYTES_KEY = "direct:bytes"
+DIRECT_ATTEMPTS_KEY = "direct:attempts"
+DIRECT_INGEST_MAX_BYTES = int(os.getenv("DIRECT_INGEST_MAX_BYTES", str(256 * 1024 * 1024)))
+# Tem de ser maior que SPOOL_CLAIM_TTL: antes disso a entrada pode estar a ser ingerida
+DIRECT_INGEST_RECONCILE_AFTER = float(os.getenv("DIRECT_INGEST_RECONCILE_AFTER", "1800"))
+# Re-despachos para a ingestão antes de o ficheiro seguir para a pasta do NIF no SFTP
+DIRECT_INGEST_MAX_REDISPATCH = int(os.getenv("DIRECT_INGEST_MAX_REDISPATCH", "2"))
+
+
+class DirectIngestFull(Exception):
+    """Entradas diretas pendentes ocupam DIRECT_INGEST_MAX_BYTES"""
+
+
+def track_direct_entry(redis_client, spool_key: str, size: int, now: float = None):
+    """Regista uma entrada direta antes de ir para o spool; DirectIngestFull se os bytes
+    pendentes passam do limite (a entrada não fica registada)"""
+    now = time.time() if now is None else now
+    if not redis_client.hsetnx(DIRECT_SIZES_KEY, spool_key, size):
+        # Mesmo conteúdo já pendente: só renova a hora de despacho
+        redis_client.zadd(DIRECT_PENDING_KEY, {spool_key: now})
+        return
+    pending = redis_client.incrby(DIRECT_BYTES_KEY, size)
+    if pending > DIRECT_INGEST_MAX_BYTES:
+        untrack_direct_entry(redis_client, spool_key)
+        raise DirectIngestFull(f"Ingestão direta cheia ({pending - size}/{DIRECT_INGEST_MAX_BYTES} bytes pendentes)")
+    redis_client.zadd(DIRECT_PENDING_KEY, {spool_key: now})
+
+
+def untrack_direct_entry(redis_client, spool_key: str):
+    """Remove a entrada do registo quando o ficheiro deixa de depender do spool"""
+    size = redis_client.hget(DIRECT_SIZES_KEY, spool_key)
+    pipe = redis_client.pipeline()
+    pipe.zrem(DIRECT_PENDING_KEY, spool_key)
+    pipe.hdel(DIRECT_SIZES_KEY, spool_key)
+    pipe.hdel(DIRECT_ATTEMPTS_KEY, spool_key)
+    removed = pipe.execute()[1]
+    # Só quem removeu o tamanho desconta os bytes (untrack repetido não conta duas vezes)
+    if removed and size:
+        redis_client.decrby(DIRECT_BYTES_KEY, int(size))
+
+
+def stale_direct_entries(redis_client, now: float = None, limit: int = 100) -> list:
+    """Entradas despachadas há mais de DIRECT_INGEST_RECONCILE_AFTER sem ack, mais antigas primeiro"""
+    now = time.time() if now is None else now
+    return redis_client.zrangebyscore(DIRECT_PENDING_KEY, 0, now - DIRECT_INGEST_RECONCILE_AFTER, start=0, num=limit)
+
+
+def redispatch_direct_entry(redis_client, spool_key: str, now: float = None) -> int:
+    """Conta mais um re-despacho e renova a hora de despacho; devolve o número de re-despachos"""
+    now = time.time() if now is None else now
+    pipe = redis_client.pipeline()
+    pipe.hincrby(DIRECT_ATTEMPTS_KEY, spool_key, 1)
+    pipe.zadd(DIRECT_PENDING_KEY, {spool_key: now})
+    return pipe.execute()[0]
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ledger de falhas por ficheiro (caminho remoto + hash do conteúdo).
+# Um ficheiro que falha é adiado com backoff exponencial e, ao fim de
+# QUARANTINE_MAX_ATTEMPTS tentativas, movido para a pasta de quarentena no SFTP,
+# deixando de ocupar lugares no lote. Um ficheiro alterado (outro hash) recomeça do zero.
+
+QUARANTINE_MAX_ATTEMPTS = int(os.getenv("QUARANTINE_MAX_ATTEMPTS", "5"))
+QUARANTINE_BASE_DELAY = float(os.getenv("QUARANTINE_BASE_DELAY", "180"))
+QUARANTINE_MAX_DELAY = float(os.getenv("QUARANTINE_MAX_DELAY", "21600"))
+SFTP_QUARANTINE_DIR = os.getenv("SFTP_QUARANTINE_DIR", "/home/mydreami/myDream/_quarantine")
+
+FAILURES_KEY = "ingest:failures"
+# Índice caminho remoto -> próxima tentativa: o scan salta os ficheiros em espera antes do
+# download (o ledger precisa do hash do conteúdo, que só existe depois de descarregar)
+DEFERRED_KEY = "ingest:deferred"
+# Só falhas do próprio ficheiro (XML inválido, tipo desconhecido) contam para a quarentena;
+# erros transitórios da DB ou da rede não marcam o resultado e não avançam o contador
+FILE_ERROR = "file"
+
+
+def is_file_error(result: dict) -> bool:
+    return bool(result) and result.get("status") == "error" and result.get("error_kind") == FILE_ERROR
+
+
+def failure_field(remote_path: str, content_hash: str) -> str:
+    return f"{remote_path}|{content_hash}"
+
+
+def retry_delay(attempts: int) -> float:
+    return min(QUARANTINE_MAX_DELAY, QUARANTINE_BASE_DELAY * (2 ** max(0, attempts - 1)))
+
+
+def quarantine_path(remote_path: str) -> str:
+    nif_folder = os.path.basename(os.path.dirname(remote_path))
+    return f"{SFTP_QUARANTINE_DIR}/{nif_folder}/{os.path.basename(remote_path)}"
+
+
+def deferred_files(redis_client, entries) -> set:
+    """Dos pares (remote_path, hash) devolve os que ainda estão em espera de nova tentativa"""
+    entries = [entry for entry in entries if entry[0]]
+    if not entries:
+        return set()
+    now = time.time()
+    raw = redis_client.hmget(FAILURES_KEY, [failure_field(*entry) for entry in entries])
+    deferred = set()
+    for entry, value in zip(entries, raw):
+        if value and json.loads(value).get("next_retry_at", 0) > now:
+            deferred.add(entry)
+    return deferred
+
+
+def record_failure(redis_client, remote_path: str, content_hash: str, message: str) -> dict:
+    """Regista uma falha; devolve a entrada com 'quarantine' = True quando atingiu o limite"""
+    field = failure_field(remote_path, content_hash)
+    raw = redis_client.hget(FAILURES_KEY, field)
+    now = time.time()
+    entry = json.loads(raw) if raw else {"remote_path": remote_path, "hash": content_hash, "attempts": 0, "first_failed_at": now}
+    entry["attempts"] += 1
+    entry["last_error"] = (message or "")[:500]
+    entry["last_failed_at"] = now
+    entry["next_retry_at"] = now + retry_delay(entry["attempts"])
+    entry["quarantine"] = entry["attempts"] >= QUARANTINE_MAX_ATTEMPTS
+    pipe = redis_client.pipeline()
+    pipe.hset(FAILURES_KEY, field, json.dumps(entry))
+    pipe.hset(DEFERRED_KEY, remote_path, entry["next_retry_at"])
+    pipe.execute()
+    return entry
+
+
+def deferred_remote_paths(redis_client, now: float = None) -> set:
+    """Caminhos remotos ainda em espera de nova tentativa (a verificar antes do download)"""
+    now = time.time() if now is None else now
+    deferred, expired = set(), []
+    for remote_path, next_retry_at in (redis_client.hgetall(DEFERRED_KEY) or {}).items():
+        (deferred.add if float(next_retry_at) > now else expired.append)(remote_path)
+    # Esperas já vencidas saem do índice: uma nova falha volta a registá-las
+    if expired:
+        redis_client.hdel(DEFERRED_KEY, *expired)
+    return deferred
+
+
+def mark_quarantined(redis_client, remote_path: str, content_hash: str, quarantined_to: str):
+    field = failure_field(remote_path, content_hash)
+    raw = redis_client.hget(FAILURES_KEY, field)
+    entry = json.loads(raw) if raw else {"remote_path": remote_path, "hash": content_hash}
+    entry["quarantined_to"] = quarantined_to
+    entry["quarantined_at"] = time.time()
+    # Fora do SFTP de entrada: já não há próxima tentativa automática
+    entry["next_retry_at"] = None
+    pipe = redis_client.pipeline()
+    pipe.hset(FAILURES_KEY, field, json.dumps(entry))
+    pipe.hdel(DEFERRED_KEY, remote_path)
+    pipe.execute()
+
+
+def clear_failure(redis_client, remote_path: str, content_hash: str):
+    pipe = redis_client.pipeline()
+    pipe.hdel(FAILURES_KEY, failure_field(remote_path, content_hash))
+    pipe.hdel(DEFERRED_KEY, remote_path)
+    pipe.execute()
+
+
+def list_failures(redis_client, quarantined_only: bool = False) -> list:
+    entries = [json.loads(value) for value in redis_client.hvals(FAILURES_KEY)]
+    if quarantined_only:
+        entries = [entry for entry in entries if entry.get("quarantined_to")]
+    return sorted(entries, key=lambda entry: entry.get("last_failed_at", 0), reverse=True)
+
+
+def requeue(redis_client, remote_path: str, content_hash: str, move_file) -> bool:
+    """Devolve um ficheiro em quarentena à pasta original e limpa o ledger.
+    move_file(origem, destino) é a operação SFTP (injetada para não acoplar ao paramiko)"""
+    raw = redis_client.hget(FAILURES_KEY, failure_field(remote_path, content_hash))
+    if not raw:
+        return False
+    entry = json.loads(raw)
+    if entry.get("quarantined_to") and not move_file(entry["quarantined_to"], remote_path):
+        return False
+    clear_failure(redis_client, remote_path, content_hash)
+    logger.info(f"🔁 {remote_path} devolvido da quarentena para nova ingestão")
+    return True
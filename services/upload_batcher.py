@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Agrupamento dos uploads SFTP por NIF: cada upload fica numa lista em Redis durante
+# uma janela curta e um único flush envia o lote numa só sessão SSH (uma ligação e
+# uma verificação da pasta por lote em vez de por ficheiro). Cada upload tem o seu
+# upload_id e o resultado individual fica em Redis para consulta.
+# O flush move as entradas para uma lista em curso (upload:inflight:<NIF>:<flush_id>) e só
+# as remove depois do upload e da confirmação: se o worker morrer a meio, a lista deixa
+# de ter heartbeat e volta ao lote no flush seguinte (ou no gc periódico).
+
+UPLOAD_BATCH_ENABLED = os.getenv("UPLOAD_BATCH_ENABLED", "true").lower() == "true"
+UPLOAD_BATCH_WINDOW = float(os.getenv("UPLOAD_BATCH_WINDOW", "2"))
+UPLOAD_BATCH_MAX = int(os.getenv("UPLOAD_BATCH_MAX", "200"))
+UPLOAD_MAX_ATTEMPTS = int(os.getenv("UPLOAD_MAX_ATTEMPTS", "3"))
+UPLOAD_RETRY_DELAY = float(os.getenv("UPLOAD_RETRY_DELAY", "10"))
+UPLOAD_ACK_TTL = int(os.getenv("UPLOAD_ACK_TTL", "86400"))
+# Sem heartbeat há mais do que isto, um flush em curso é dado como morto e o lote é devolvido
+UPLOAD_INFLIGHT_TIMEOUT = float(os.getenv("UPLOAD_INFLIGHT_TIMEOUT", "120"))
+
+PENDING_KEY = "upload:pending"
+FLUSH_KEY = "upload:flush"
+ACK_KEY = "upload:ack"
+INFLIGHT_KEY = "upload:inflight"  # sorted set "<NIF>|<flush_id>" -> último heartbeat
+
+
+def _flush_marker_ttl() -> int:
+    # Se o flush agendado se perder, a marca expira e o próximo upload agenda outro
+    return int(max(UPLOAD_BATCH_WINDOW, UPLOAD_RETRY_DELAY) * 10 + 60)
+
+
+def enqueue_upload(redis_client, nif: str, blob_key: str, filename: str = None,
+                   ingest_now: bool = False, archive: bool = False) -> tuple:
+    """Junta um upload ao lote do NIF. Devolve (upload_id, agendar_flush): agendar_flush
+    é True só para o primeiro upload da janela"""
+    upload_id = uuid.uuid4().hex
+    entry = {"upload_id": upload_id, "blob_key": blob_key, "filename": filename,
+             "ingest_now": ingest_now, "archive": archive, "attempts": 0, "queued_at": time.time()}
+    pipe = redis_client.pipeline()
+    pipe.rpush(f"{PENDING_KEY}:{nif}", json.dumps(entry))
+    pipe.hset(f"{ACK_KEY}:{upload_id}", mapping={"status": "queued", "nif": nif, "filename": filename or ""})
+    pipe.expire(f"{ACK_KEY}:{upload_id}", UPLOAD_ACK_TTL)
+    pipe.execute()
+    return upload_id, claim_flush(redis_client, nif)
+
+
+def claim_flush(redis_client, nif: str) -> bool:
+    """Marca o flush do NIF como agendado; False se já há um pendente"""
+    return bool(redis_client.set(f"{FLUSH_KEY}:{nif}", 1, nx=True, ex=_flush_marker_ttl()))
+
+
+def release_flush(redis_client, nif: str):
+    """Chamado no início do flush: uploads que cheguem a partir daqui agendam o seguinte"""
+    redis_client.delete(f"{FLUSH_KEY}:{nif}")
+
+
+def _inflight_list(nif: str, flush_id: str) -> str:
+    return f"{INFLIGHT_KEY}:{nif}:{flush_id}"
+
+
+def take_batch(redis_client, nif: str, limit: int = None) -> tuple:
+    """Move até `limit` uploads do lote do NIF para a lista em curso de um novo flush.
+    Devolve (flush_id, entradas, restantes); cada entrada leva o JSON original em '_raw'"""
+    key = f"{PENDING_KEY}:{nif}"
+    limit = limit or UPLOAD_BATCH_MAX
+    flush_id = uuid.uuid4().hex
+    inflight = _inflight_list(nif, flush_id)
+    # Registo antes de mover: uma lista em curso sem registo nunca seria recuperada
+    redis_client.zadd(INFLIGHT_KEY, {f"{nif}|{flush_id}": time.time()})
+    pipe = redis_client.pipeline()
+    for _ in range(limit):
+        pipe.lmove(key, inflight, "LEFT", "RIGHT")
+    pipe.llen(key)
+    *moved, remaining = pipe.execute()
+    entries = [{**json.loads(raw), "_raw": raw} for raw in moved if raw is not None]
+    if not entries:
+        redis_client.zrem(INFLIGHT_KEY, f"{nif}|{flush_id}")
+    return flush_id, entries, remaining
+
+
+def heartbeat(redis_client, nif: str, flush_id: str):
+    """Mantém o flush vivo enquanto envia ficheiros"""
+    redis_client.zadd(INFLIGHT_KEY, {f"{nif}|{flush_id}": time.time()}, xx=True)
+
+
+def complete_upload(redis_client, nif: str, flush_id: str, entry: dict):
+    """Remove da lista em curso um upload já enviado (ou sem blob) e confirmado"""
+    redis_client.lrem(_inflight_list(nif, flush_id), 1, entry["_raw"])
+
+
+def requeue_uploads(redis_client, nif: str, flush_id: str, entries: list):
+    """Devolve ao início do lote os uploads que falharam por erro transitório"""
+    if not entries:
+        return
+    pipe = redis_client.pipeline()
+    pipe.lpush(f"{PENDING_KEY}:{nif}", *[json.dumps({key: value for key, value in entry.items() if key != "_raw"})
+                                         for entry in reversed(entries)])
+    for entry in entries:
+        pipe.lrem(_inflight_list(nif, flush_id), 1, entry["_raw"])
+    pipe.execute()
+
+
+def finish_batch(redis_client, nif: str, flush_id: str):
+    """Fecha o flush: o que ainda estiver na lista em curso (não devia) volta ao lote"""
+    _return_inflight(redis_client, nif, flush_id)
+
+
+def _return_inflight(redis_client, nif: str, flush_id: str) -> int:
+    inflight = _inflight_list(nif, flush_id)
+    returned = 0
+    # Do fim da lista em curso para o início do lote: a ordem original mantém-se
+    while redis_client.lmove(inflight, f"{PENDING_KEY}:{nif}", "RIGHT", "LEFT") is not None:
+        returned += 1
+    redis_client.zrem(INFLIGHT_KEY, f"{nif}|{flush_id}")
+    return returned
+
+
+def has_inflight(redis_client, nif: str) -> bool:
+    """Há flushes do NIF ainda em curso (vivos ou por recuperar)"""
+    return any(member.rsplit("|", 1)[0] == nif for member in redis_client.zrange(INFLIGHT_KEY, 0, -1))
+
+
+def reclaim_stale_batches(redis_client, nif: str = None, now: float = None) -> dict:
+    """Devolve ao lote as listas em curso de flushes sem heartbeat (worker morto ou
+    reiniciado a meio). Só do NIF indicado, ou de todos. Devolve {nif: uploads devolvidos}"""
+    now = time.time() if now is None else now
+    reclaimed = {}
+    for member in redis_client.zrangebyscore(INFLIGHT_KEY, 0, now - UPLOAD_INFLIGHT_TIMEOUT):
+        member_nif, flush_id = member.rsplit("|", 1)
+        if nif is not None and member_nif != nif:
+            continue
+        returned = _return_inflight(redis_client, member_nif, flush_id)
+        if returned:
+            logger.warning(f"♻️ Flush {flush_id[:8]} do NIF {member_nif} sem heartbeat: {returned} uploads devolvidos ao lote")
+            reclaimed[member_nif] = reclaimed.get(member_nif, 0) + returned
+    return reclaimed
+
+
+def acknowledge(redis_client, upload_id: str, status: str, **fields):
+    """Regista o resultado individual de um upload (uploaded | error | retrying)"""
+    values = {"status": status, "updated_at": time.time()}
+    values.update({key: value for key, value in fields.items() if value is not None})
+    pipe = redis_client.pipeline()
+    pipe.hset(f"{ACK_KEY}:{upload_id}", mapping={key: str(value) for key, value in values.items()})
+    pipe.expire(f"{ACK_KEY}:{upload_id}", UPLOAD_ACK_TTL)
+    pipe.execute()
+
+
+def upload_status(redis_client, upload_id: str) -> dict:
+    return redis_client.hgetall(f"{ACK_KEY}:{upload_id}")
@@ -3,7 +3,9 @@ from dotenv import load_dotenv
 import paramiko
 import os
 import logging
-import json
+
+from sftp_pool import SFTPPool
+from utils.file_mappings import get_file_mappings
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -17,12 +19,43 @@ port = int(os.getenv("SFTP_PORT", 22))
 username = os.getenv("SFTP_USERNAME")
 password = os.getenv("SFTP_PASSWORD")
 
+def open_transport():
+    """Abre um transporte SSH autenticado (usado pelo pool)"""
+    transport = paramiko.Transport((host, port))
+    try:
+        transport.connect(username=username, password=password)
+    except Exception:
+        transport.close()
+        raise
+    return transport
+
+_pool = None
+
+def get_sftp_pool():
+    """Pool de ligações SFTP deste processo (recriado depois de um fork)"""
+    global _pool
+    if _pool is None or _pool.pid != os.getpid():
+        # Transportes herdados do processo pai não são fechados: o socket é dele
+        _pool = SFTPPool(open_transport)
+    return _pool
+
+def acquire_sftp():
+    """Cliente SFTP do pool; None se não for possível ligar. Devolver com release_sftp()"""
+    try:
+        return get_sftp_pool().acquire()
+    except Exception as e:
+        logger.error(f"Erro ao conectar SFTP: {str(e)}")
+        return None
+
+def release_sftp(sftp):
+    if sftp is not None:
+        get_sftp_pool().release(sftp)
+
 def connect_sftp():
-    """Estabelece conexão SFTP e retorna o cliente"""
+    """Estabelece conexão SFTP dedicada (fora do pool) e retorna o cliente"""
     try:
         # Conectar via SSH
-        transport = paramiko.Transport((host, port))
-        transport.connect(username=username, password=password)
+        transport = open_transport()
         
         # Criar cliente SFTP
         sftp = paramiko.SFTPClient.from_transport(transport)
@@ -32,14 +65,9 @@ def connect_sftp():
         logger.error(f"Erro ao conectar SFTP: {str(e)}")
         return None, None
 
-def download_files_from_sftp():
-    """Baixa arquivos do SFTP percorrendo pastas por NIF"""
-    sftp, transport = connect_sftp()
-    
-    if sftp is None:
-        logger.error("Não foi possível estabelecer conexão SFTP")
-        return []
-    
+def download_files_from_sftp(on_progress=None):
+    """Baixa arquivos do SFTP das pastas por NIF (listagem incremental e downloads em paralelo).
+    on_progress(pastas_verificadas, total_pastas, arquivos_baixados) é chamado por ficheiro e por pasta"""
     try:
         # Pasta remota onde estão as pastas por NIF
         pasta_remota = '/home/mydreami/myDream'
@@ -48,96 +76,68 @@ def download_files_from_sftp():
         pasta_local = './downloads'
         os.makedirs(pasta_local, exist_ok=True)
 
-        downloaded_files = []
-        file_mappings = []  # Armazenar mapeamento arquivo local -> remoto
-        
-        # Listar todas as pastas (NIFs das empresas)
+        # Listagem incremental (só as pastas NIF alteradas desde o último ciclo) e
+        # travessia partilhada com OpenGCs; downloads em várias threads/canais do pool
+        from sftp_scanner import scan_work_items
+        from sftp_download import download_folders
         try:
-            pastas_nif = sftp.listdir(pasta_remota)
-            logger.info(f"Pastas NIF encontradas: {pastas_nif}")
+            pastas_nif = scan_work_items(pasta_remota, 'invoices')
         except Exception as e:
             logger.error(f"Erro ao listar pastas NIF: {str(e)}")
             return []
-        
-        # Percorrer cada pasta NIF
-        for pasta_nif in pastas_nif:
-            try:
-                caminho_pasta_nif = f'{pasta_remota}/{pasta_nif}'
-                logger.info(f"🔄 Verificando pasta NIF: {pasta_nif}")
-                
-                # Listar arquivos na pasta NIF
-                arquivos_pasta = sftp.listdir(caminho_pasta_nif)
-                logger.info(f"📁 Arquivos na pasta {pasta_nif}: {arquivos_pasta}")
-                
-                # Baixar todos os arquivos XML que começam com FR ou NC
-                for arquivo in arquivos_pasta:
-                    if arquivo.endswith('.xml') and (arquivo.startswith('FR') or arquivo.startswith('NC')):
-                        caminho_remoto = f'{caminho_pasta_nif}/{arquivo}'
-                        # Adicionar o NIF (pasta_nif) ao nome do ficheiro local para evitar sobrerposições de clientes diferentes!
-                        nome_local_seguro = f"{pasta_nif}_{arquivo}"
-                        caminho_local = os.path.join(pasta_local, nome_local_seguro)
-                        
-                        logger.info(f'📥 Baixando {arquivo} da pasta {pasta_nif} como {nome_local_seguro}...')
-                        sftp.get(caminho_remoto, caminho_local)
-                        downloaded_files.append(caminho_local)
-                        
-                        # Armazenar mapeamento para exclusão posterior
-                        file_mappings.append({
-                            'local_path': caminho_local,
-                            'remote_path': caminho_remoto,
-                            'filename': arquivo,
-                            'nif_folder': pasta_nif
-                        })
-                        
-            except Exception as e:
-                logger.error(f"Erro ao processar pasta {pasta_nif}: {str(e)}")
-                continue
+
+        # Ficheiros em backoff da quarentena não são descarregados (poupa o I/O do SFTP)
+        try:
+            from utils.redisUtil import get_redis
+            from services.quarantine import deferred_remote_paths
+            em_espera = deferred_remote_paths(get_redis())
+        except Exception as e:
+            logger.warning(f"⚠️ Ledger de falhas indisponível, a descarregar todos os ficheiros: {str(e)}")
+            em_espera = set()
+
+        def selecionar(pasta_nif, arquivo):
+            if f"{pasta_remota}/{pasta_nif}/{arquivo}" in em_espera:
+                return None
+            # Adicionar o NIF (pasta_nif) ao nome do ficheiro local para evitar sobrerposições de clientes diferentes!
+            return f"{pasta_nif}_{arquivo}"
+
+        file_mappings = download_folders(pasta_remota, pastas_nif, selecionar, pasta_local, on_progress)
+        downloaded_files = [mapping['local_path'] for mapping in file_mappings]
 
         logger.info(f"✅ Download concluído! {len(downloaded_files)} arquivos baixados")
         
-        # Salvar mapeamento em arquivo temporário para uso posterior
-        import json
-        mappings_file = os.path.join(pasta_local, 'file_mappings.json')
-        with open(mappings_file, 'w') as f:
-            json.dump(file_mappings, f)
+        # Guardar mapeamentos (indexados pelo caminho local) para a exclusão posterior
+        get_file_mappings().put_many(file_mappings)
         
         return downloaded_files
         
     except Exception as e:
         logger.error(f"Erro durante download: {str(e)}")
         return []
-    finally:
-        # Fechar conexão
-        if sftp:
-            sftp.close()
-        if transport:
-            transport.close()
 
-def delete_file_from_sftp(local_file_path):
-    """Exclui arquivo do SFTP após processamento bem-sucedido"""
+def load_file_mappings(local_paths):
+    """Mapeamentos arquivo local -> remoto dos ficheiros indicados (indexados pelo caminho local)"""
+    return get_file_mappings().get_many(local_paths)
+
+def delete_file_from_sftp(local_file_path, remote_path=None):
+    """Exclui arquivo do SFTP após processamento bem-sucedido.
+    Com remote_path (ex.: vindo do spool) não depende do mapeamento gravado pelo download"""
     try:
-        # Carregar mapeamento de arquivos
-        mappings_file = os.path.join('./downloads', 'file_mappings.json')
-        if not os.path.exists(mappings_file):
-            logger.warning(f"⚠️ Arquivo de mapeamento não encontrado: {mappings_file}")
-            return False
-        
-        with open(mappings_file, 'r') as f:
-            file_mappings = json.load(f)
-        
-        # Encontrar mapeamento para o arquivo local
-        file_mapping = None
-        for mapping in file_mappings:
-            if mapping['local_path'] == local_file_path:
-                file_mapping = mapping
-                break
-        
-        if not file_mapping:
-            logger.warning(f"⚠️ Mapeamento não encontrado para: {local_file_path}")
-            return False
+        if remote_path:
+            file_mapping = {
+                'remote_path': remote_path,
+                'filename': os.path.basename(remote_path),
+                'nif_folder': os.path.basename(os.path.dirname(remote_path))
+            }
+        else:
+            # Encontrar mapeamento para o arquivo local
+            file_mapping = get_file_mappings().get(local_file_path)
+            if not file_mapping:
+                logger.warning(f"⚠️ Mapeamento não encontrado para: {local_file_path}")
+                return False
         
         # Conectar ao SFTP
-        sftp, transport = connect_sftp()
+        sftp = acquire_sftp()
         if sftp is None:
             logger.error("❌ Não foi possível conectar ao SFTP para exclusão")
             return False
@@ -150,12 +150,8 @@ def delete_file_from_sftp(local_file_path):
             sftp.remove(remote_path)
             logger.info(f"✅ Arquivo excluído com sucesso do SFTP: {file_mapping['filename']}")
             
-            # Remover mapeamento da lista
-            file_mappings.remove(file_mapping)
-            
-            # Atualizar arquivo de mapeamento
-            with open(mappings_file, 'w') as f:
-                json.dump(file_mappings, f)
+            # Remover mapeamento
+            get_file_mappings().delete(local_file_path)
             
             return True
             
@@ -163,26 +159,66 @@ def delete_file_from_sftp(local_file_path):
             logger.error(f"❌ Erro ao excluir arquivo do SFTP: {str(e)}")
             return False
         finally:
-            # Fechar conexão
-            if sftp:
-                sftp.close()
-            if transport:
-                transport.close()
+            # Devolver a ligação ao pool
+            release_sftp(sftp)
                 
     except Exception as e:
         logger.error(f"❌ Erro geral na exclusão SFTP: {str(e)}")
         return False
 
+def delete_files_from_sftp(remote_paths):
+    """Exclui vários arquivos do SFTP numa única sessão; devolve {remote_path: sucesso}"""
+    results = {remote_path: False for remote_path in remote_paths}
+    if not remote_paths:
+        return results
+
+    sftp = acquire_sftp()
+    if sftp is None:
+        logger.error("❌ Não foi possível conectar ao SFTP para exclusão")
+        return results
+
+    try:
+        for remote_path in remote_paths:
+            try:
+                sftp.remove(remote_path)
+                results[remote_path] = True
+            except Exception as e:
+                logger.error(f"❌ Erro ao excluir {remote_path} do SFTP: {str(e)}")
+        logger.info(f"🗑️ {sum(results.values())}/{len(remote_paths)} arquivos excluídos do SFTP numa sessão")
+        return results
+    finally:
+        release_sftp(sftp)
+
+def move_file_on_sftp(source_path, target_path):
+    """Move um arquivo dentro do SFTP (cria a pasta de destino se necessário)"""
+    sftp = acquire_sftp()
+    if sftp is None:
+        logger.error("❌ Não foi possível conectar ao SFTP para mover arquivo")
+        return False
+
+    try:
+        target_dir = os.path.dirname(target_path)
+        partial = ''
+        for part in target_dir.strip('/').split('/'):
+            partial = f'{partial}/{part}'
+            try:
+                sftp.stat(partial)
+            except FileNotFoundError:
+                sftp.mkdir(partial)
+        sftp.rename(source_path, target_path)
+        logger.info(f"📦 Arquivo movido no SFTP: {source_path} → {target_path}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Erro ao mover {source_path} no SFTP: {str(e)}")
+        return False
+    finally:
+        release_sftp(sftp)
+
 if __name__ == "__main__":
     download_files_from_sftp()
-def download_opengcs_files_from_sftp():
-    """Baixa arquivos OpenGCs do SFTP percorrendo pastas por NIF"""
-    sftp, transport = connect_sftp()
-    
-    if sftp is None:
-        logger.error("Não foi possível estabelecer conexão SFTP")
-        return []
-    
+def download_opengcs_files_from_sftp(on_progress=None):
+    """Baixa arquivos OpenGCs do SFTP das pastas por NIF (listagem incremental e downloads em paralelo).
+    on_progress(pastas_verificadas, total_pastas, arquivos_baixados) é chamado por ficheiro e por pasta"""
     try:
         # Pasta remota onde estão as pastas por NIF
         pasta_remota = '/home/mydreami/myDream'
@@ -191,94 +227,44 @@ def download_opengcs_files_from_sftp():
         pasta_local = './downloads'
         os.makedirs(pasta_local, exist_ok=True)
 
-        downloaded_files = []
-        file_mappings = []  # Armazenar mapeamento arquivo local -> remoto
-        
-        # Listar todas as pastas (NIFs das empresas)
+        # Listagem incremental (só as pastas NIF alteradas desde o último ciclo) e
+        # travessia partilhada com FR/NC; downloads em várias threads/canais do pool
+        from sftp_scanner import scan_work_items
+        from sftp_download import download_folders
         try:
-            pastas_nif = sftp.listdir(pasta_remota)
-            logger.info(f"Pastas NIF encontradas: {pastas_nif}")
+            pastas_nif = scan_work_items(pasta_remota, 'opengcs')
         except Exception as e:
             logger.error(f"Erro ao listar pastas NIF: {str(e)}")
             return []
-        
-        # Percorrer cada pasta NIF
-        for pasta_nif in pastas_nif:
-            try:
-                caminho_pasta_nif = f'{pasta_remota}/{pasta_nif}'
-                logger.info(f"🔄 Verificando pasta NIF: {pasta_nif}")
-                
-                # Listar arquivos na pasta NIF
-                arquivos_pasta = sftp.listdir(caminho_pasta_nif)
-                logger.info(f"📁 Arquivos na pasta {pasta_nif}: {arquivos_pasta}")
-                
-                # Baixar arquivos que começam com opengcs-{nif}
-                for arquivo in arquivos_pasta:
-                    if arquivo.startswith(f'opengcs-{pasta_nif}'):
-                        caminho_remoto = f'{caminho_pasta_nif}/{arquivo}'
-                        caminho_local = os.path.join(pasta_local, arquivo)
-                        
-                        logger.info(f'📥 Baixando {arquivo} da pasta {pasta_nif}...')
-                        sftp.get(caminho_remoto, caminho_local)
-                        downloaded_files.append(caminho_local)
-                        
-                        # Armazenar mapeamento para exclusão posterior
-                        file_mappings.append({
-                            'local_path': caminho_local,
-                            'remote_path': caminho_remoto,
-                            'filename': arquivo,
-                            'nif_folder': pasta_nif
-                        })
-                        
-            except Exception as e:
-                logger.error(f"Erro ao processar pasta {pasta_nif}: {str(e)}")
-                continue
+
+        def selecionar(pasta_nif, arquivo):
+            return arquivo
+
+        file_mappings = download_folders(pasta_remota, pastas_nif, selecionar, pasta_local, on_progress)
+        downloaded_files = [mapping['local_path'] for mapping in file_mappings]
 
         logger.info(f"✅ Download OpenGCs concluído! {len(downloaded_files)} arquivos baixados")
         
-        # Salvar mapeamento em arquivo temporário para uso posterior
-        import json
-        mappings_file = os.path.join(pasta_local, 'opengcs_file_mappings.json')
-        with open(mappings_file, 'w') as f:
-            json.dump(file_mappings, f)
+        # Guardar mapeamentos (indexados pelo caminho local) para a exclusão posterior
+        get_file_mappings().put_many(file_mappings)
         
         return downloaded_files
         
     except Exception as e:
         logger.error(f"Erro durante download OpenGCs: {str(e)}")
         return []
-    finally:
-        # Fechar conexão
-        if sftp:
-            sftp.close()
-        if transport:
-            transport.close()
 
 def delete_opengcs_file_from_sftp(local_file_path):
     """Exclui arquivo OpenGCs do SFTP após processamento bem-sucedido"""
     try:
-        # Carregar mapeamento de arquivos
-        mappings_file = os.path.join('./downloads', 'opengcs_file_mappings.json')
-        if not os.path.exists(mappings_file):
-            logger.warning(f"⚠️ Arquivo de mapeamento OpenGCs não encontrado: {mappings_file}")
-            return False
-        
-        with open(mappings_file, 'r') as f:
-            file_mappings = json.load(f)
-        
         # Encontrar mapeamento para o arquivo local
-        file_mapping = None
-        for mapping in file_mappings:
-            if mapping['local_path'] == local_file_path:
-                file_mapping = mapping
-                break
-        
+        file_mapping = get_file_mappings().get(local_file_path)
         if not file_mapping:
             logger.warning(f"⚠️ Mapeamento não encontrado para: {local_file_path}")
             return False
         
         # Conectar ao SFTP
-        sftp, transport = connect_sftp()
+        sftp = acquire_sftp()
         if sftp is None:
             logger.error("❌ Não foi possível conectar ao SFTP para exclusão")
             return False
@@ -291,12 +277,8 @@ def delete_opengcs_file_from_sftp(local_file_path):
             sftp.remove(remote_path)
             logger.info(f"✅ Arquivo OpenGCs excluído com sucesso do SFTP: {file_mapping['filename']}")
             
-            # Remover mapeamento da lista
-            file_mappings.remove(file_mapping)
-            
-            # Atualizar arquivo de mapeamento
-            with open(mappings_file, 'w') as f:
-                json.dump(file_mappings, f)
+            # Remover mapeamento
+            get_file_mappings().delete(local_file_path)
             
             return True
             
@@ -304,11 +286,8 @@ def delete_opengcs_file_from_sftp(local_file_path):
             logger.error(f"❌ Erro ao excluir arquivo OpenGCs do SFTP: {str(e)}")
             return False
         finally:
-            # Fechar conexão
-            if sftp:
-                sftp.close()
-            if transport:
-                transport.close()
+            # Devolver a ligação ao pool
+            release_sftp(sftp)
                 
     except Exception as e:
         logger.error(f"❌ Erro geral na exclusão SFTP OpenGCs: {str(e)}")
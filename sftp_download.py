@@ -0,0 +1,102 @@
+import os
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from prometheus_client import Histogram
+
+from sftp_connection import acquire_sftp, release_sftp
+from sftp_pool import SFTP_POOL_MAX_TRANSPORTS, SFTP_POOL_MAX_CHANNELS
+
+logger = logging.getLogger(__name__)
+
+# Download paralelo das pastas por NIF: as pastas são listadas em simultâneo
+# (sftp_scanner) e os ficheiros descarregados por um conjunto limitado de threads,
+# cada uma com o seu canal SFTP do pool. Cada ficheiro é escrito num temporário e renomeado no fim,
+# pelo que nunca fica um XML parcial na pasta local.
+
+# Por omissão, uma thread por canal disponível no pool
+SFTP_DOWNLOAD_WORKERS = int(os.getenv("SFTP_DOWNLOAD_WORKERS", str(SFTP_POOL_MAX_TRANSPORTS * SFTP_POOL_MAX_CHANNELS)))
+
+SFTP_DOWNLOAD_SECONDS = Histogram(
+    "sftp_download_seconds",
+    "Duração do download de cada ficheiro do SFTP",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+SFTP_LIST_SECONDS = Histogram(
+    "sftp_list_seconds",
+    "Duração da listagem de cada pasta NIF no SFTP",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+
+
+def _with_sftp(operation):
+    sftp = acquire_sftp()
+    if sftp is None:
+        raise ConnectionError("Não foi possível obter ligação SFTP do pool")
+    try:
+        return operation(sftp)
+    finally:
+        release_sftp(sftp)
+
+
+def _download_file(remote_path: str, local_path: str) -> float:
+    """Descarrega para um temporário e renomeia; devolve a duração em segundos"""
+    tmp_path = f"{local_path}.{uuid.uuid4().hex}.part"
+    started = time.perf_counter()
+    try:
+        _with_sftp(lambda sftp: sftp.get(remote_path, tmp_path))
+        os.replace(tmp_path, local_path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    elapsed = time.perf_counter() - started
+    SFTP_DOWNLOAD_SECONDS.observe(elapsed)
+    return elapsed
+
+
+def download_folders(remote_root: str, folder_files: dict, select, local_dir: str,
+                     on_progress=None, workers: int = SFTP_DOWNLOAD_WORKERS) -> list:
+    """Descarrega em paralelo os ficheiros escolhidos das pastas já listadas (ver sftp_scanner).
+    folder_files: {pasta_nif: [nomes]}; select(pasta_nif, nome) devolve o nome local, ou None para ignorar.
+    Devolve os mapeamentos (local_path, remote_path, filename, nif_folder, download_seconds)."""
+    os.makedirs(local_dir, exist_ok=True)
+    mappings = []
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="sftp-download") as executor:
+        downloads = {}
+        for nif_folder, files in folder_files.items():
+            for filename in files:
+                local_name = select(nif_folder, filename)
+                if not local_name:
+                    continue
+                remote_path = f"{remote_root}/{nif_folder}/{filename}"
+                local_path = os.path.join(local_dir, local_name)
+                downloads[executor.submit(_download_file, remote_path, local_path)] = {
+                    "local_path": local_path,
+                    "remote_path": remote_path,
+                    "filename": filename,
+                    "nif_folder": nif_folder,
+                }
+
+        for future in as_completed(downloads):
+            mapping = downloads[future]
+            try:
+                mapping["download_seconds"] = round(future.result(), 4)
+            except Exception as e:
+                logger.error(f"❌ Erro ao baixar {mapping['remote_path']}: {str(e)}")
+                continue
+            mappings.append(mapping)
+            if on_progress:
+                on_progress(len(folder_files), len(folder_files), len(mappings))
+
+    if mappings:
+        latencies = sorted(mapping["download_seconds"] for mapping in mappings)
+        logger.info(f"📥 {len(mappings)} ficheiros de {len(folder_files)} pastas em {time.perf_counter() - started:.2f}s "
+                    f"({workers} canais; p50 {latencies[len(latencies) // 2]:.3f}s, máx {latencies[-1]:.3f}s por ficheiro)")
+    return mappings
@@ -0,0 +1,194 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Pool de ligações SFTP por processo: cada transporte SSH autenticado é reutilizado
+# entre downloads, exclusões e uploads, com um número limitado de canais SFTP por
+# transporte. Transportes parados mais de SFTP_POOL_MAX_IDLE segundos são fechados;
+# um transporte ou canal morto é descartado e substituído na próxima utilização.
+
+SFTP_POOL_MAX_TRANSPORTS = int(os.getenv("SFTP_POOL_MAX_TRANSPORTS", "2"))
+SFTP_POOL_MAX_CHANNELS = int(os.getenv("SFTP_POOL_MAX_CHANNELS", "4"))
+SFTP_POOL_MAX_IDLE = float(os.getenv("SFTP_POOL_MAX_IDLE", "300"))
+SFTP_POOL_ACQUIRE_TIMEOUT = float(os.getenv("SFTP_POOL_ACQUIRE_TIMEOUT", "60"))
+# Canal parado há mais de N segundos é verificado (stat) antes de ser entregue
+SFTP_POOL_CHECK_AFTER = float(os.getenv("SFTP_POOL_CHECK_AFTER", "30"))
+SFTP_KEEPALIVE = int(os.getenv("SFTP_KEEPALIVE", "30"))
+
+
+class _PooledTransport:
+    def __init__(self, transport):
+        self.transport = transport
+        self.idle = []  # [(SFTPClient, último_uso)]
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+    def alive(self) -> bool:
+        return self.transport.is_active() and self.transport.is_authenticated()
+
+    def close(self):
+        for sftp, _ in self.idle:
+            _close_quietly(sftp)
+        self.idle = []
+        _close_quietly(self.transport)
+
+
+def _close_quietly(resource):
+    try:
+        resource.close()
+    except Exception:
+        pass
+
+
+def _channel_open(sftp) -> bool:
+    channel = sftp.get_channel()
+    return channel is not None and not channel.closed
+
+
+class SFTPPool:
+    """Transportes SSH autenticados partilhados pelas threads de um processo.
+    open_transport() devolve um paramiko.Transport já ligado e autenticado."""
+
+    def __init__(self, open_transport, max_transports: int = SFTP_POOL_MAX_TRANSPORTS,
+                 max_channels: int = SFTP_POOL_MAX_CHANNELS, max_idle: float = SFTP_POOL_MAX_IDLE):
+        self.open_transport = open_transport
+        self.max_transports = max_transports
+        self.max_channels = max_channels
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+        self._transports = []
+        self._owners = {}  # id(SFTPClient) -> _PooledTransport
+        self._connecting = 0
+        self._cond = threading.Condition()
+
+    def _evict(self, now: float):
+        """Fecha canais e transportes parados há mais de max_idle ou mortos (com o lock)"""
+        for pooled in list(self._transports):
+            if not pooled.alive():
+                self._transports.remove(pooled)
+                if pooled.in_use == 0:
+                    pooled.close()
+                continue
+            fresh = []
+            for sftp, last_used in pooled.idle:
+                if now - last_used > self.max_idle or not _channel_open(sftp):
+                    _close_quietly(sftp)
+                else:
+                    fresh.append((sftp, last_used))
+            pooled.idle = fresh
+            if pooled.in_use == 0 and not pooled.idle and now - pooled.last_used > self.max_idle:
+                self._transports.remove(pooled)
+                pooled.close()
+                logger.info("🔌 Transporte SFTP inativo fechado")
+
+    def _reserve(self):
+        """Escolhe um canal livre, um transporte com vaga ou um novo transporte (com o lock).
+        Devolve (transporte, cliente_reutilizado) ou (None, None) para ligar um transporte novo"""
+        for pooled in self._transports:
+            if pooled.in_use >= self.max_channels:
+                continue
+            pooled.in_use += 1
+            if pooled.idle:
+                return pooled, pooled.idle.pop()
+            return pooled, None
+        if len(self._transports) + self._connecting < self.max_transports:
+            self._connecting += 1
+            return None, None
+        return False, None
+
+    def acquire(self, timeout: float = SFTP_POOL_ACQUIRE_TIMEOUT):
+        """Cliente SFTP pronto a usar; devolver sempre com release()"""
+        import paramiko
+
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                self._evict(time.monotonic())
+                pooled, idle = self._reserve()
+                while pooled is False:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("Sem canais SFTP livres no pool")
+                    self._cond.wait(remaining)
+                    pooled, idle = self._reserve()
+
+            if pooled is None:
+                # Novo transporte (handshake e autenticação) fora do lock
+                try:
+                    transport = self.open_transport()
+                    transport.set_keepalive(SFTP_KEEPALIVE)
+                except Exception:
+                    with self._cond:
+                        self._connecting -= 1
+                        self._cond.notify()
+                    raise
+                pooled = _PooledTransport(transport)
+                pooled.in_use = 1
+                with self._cond:
+                    self._connecting -= 1
+                    self._transports.append(pooled)
+                logger.info(f"🔌 Novo transporte SFTP no pool ({len(self._transports)}/{self.max_transports})")
+                idle = None
+
+            try:
+                if idle is not None:
+                    sftp, last_used = idle
+                    if time.monotonic() - last_used > SFTP_POOL_CHECK_AFTER:
+                        sftp.stat(".")
+                else:
+                    sftp = paramiko.SFTPClient.from_transport(pooled.transport)
+            except Exception as e:
+                # Canal ou transporte morto: descartar e tentar de novo até ao prazo
+                logger.warning(f"⚠️ Ligação SFTP do pool inválida, a descartar: {str(e)}")
+                with self._cond:
+                    pooled.in_use -= 1
+                    if idle is not None:
+                        _close_quietly(idle[0])
+                    if not pooled.alive() and pooled in self._transports:
+                        self._transports.remove(pooled)
+                        if pooled.in_use == 0:
+                            pooled.close()
+                    self._cond.notify()
+                if time.monotonic() >= deadline:
+                    raise ConnectionError(f"Não foi possível obter ligação SFTP: {str(e)}")
+                continue
+
+            with self._cond:
+                self._owners[id(sftp)] = pooled
+            return sftp
+
+    def release(self, sftp):
+        """Devolve o cliente ao pool (ou fecha-o se o canal/transporte morreu)"""
+        with self._cond:
+            pooled = self._owners.pop(id(sftp), None)
+            if pooled is None:
+                _close_quietly(sftp)
+                return
+            pooled.in_use -= 1
+            pooled.last_used = time.monotonic()
+            if pooled in self._transports and pooled.alive() and _channel_open(sftp):
+                pooled.idle.append((sftp, pooled.last_used))
+            else:
+                _close_quietly(sftp)
+                if pooled in self._transports and not pooled.alive():
+                    self._transports.remove(pooled)
+                if pooled not in self._transports and pooled.in_use == 0:
+                    pooled.close()
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for pooled in self._transports:
+                pooled.close()
+            self._transports = []
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "transports": len(self._transports),
+                "channels_in_use": sum(pooled.in_use for pooled in self._transports),
+                "channels_idle": sum(len(pooled.idle) for pooled in self._transports),
+            }
@@ -0,0 +1,243 @@
+import os
+import json
+import stat
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from sftp_download import SFTP_DOWNLOAD_WORKERS, SFTP_LIST_SECONDS, _with_sftp
+
+logger = logging.getLogger(__name__)
+
+# Scan incremental do SFTP: a raiz é lida com listdir_attr e só as pastas NIF cuja
+# mtime mudou desde o último ciclo são listadas de novo. O snapshot (mtime de cada
+# pasta e tamanho/mtime de cada ficheiro) fica em Redis; as pastas sem alterações
+# usam a listagem guardada. O custo da listagem cresce com o que mudou, não com o
+# número de clientes.
+
+SFTP_SCAN_INCREMENTAL = os.getenv("SFTP_SCAN_INCREMENTAL", "true").lower() == "true"
+# Listagem completa periódica, para corrigir qualquer desvio do snapshot
+SFTP_SCAN_FULL_EVERY = float(os.getenv("SFTP_SCAN_FULL_EVERY", "3600"))
+# A mtime das pastas tem resolução de 1 s: pastas alteradas perto da última listagem são relidas
+SFTP_SCAN_MTIME_SLACK = float(os.getenv("SFTP_SCAN_MTIME_SLACK", "2"))
+
+# Travessia partilhada: um só scan por ciclo serve FR/NC e OpenGCs. As classes do
+# outro pipeline ficam em Redis durante SFTP_SCAN_SHARE_TTL e são consumidas uma vez,
+# desde que a travessia seja posterior ao fim do último ciclo desse pipeline
+SFTP_SCAN_SHARED = os.getenv("SFTP_SCAN_SHARED", "true").lower() == "true"
+SFTP_SCAN_SHARE_TTL = int(os.getenv("SFTP_SCAN_SHARE_TTL", "60"))
+
+SNAPSHOT_KEY = "sftp:snapshot"
+WORK_KEY = "sftp:work"
+
+# Pipeline -> classes de ficheiros que consome
+PIPELINES = {"invoices": ("FR", "NC"), "opengcs": ("OpenGCs",)}
+
+
+class SnapshotStore:
+    """Snapshot da árvore SFTP em Redis (hash de pastas + hash de ficheiros por pasta)"""
+
+    def __init__(self, redis_client, root: str):
+        self.redis = redis_client
+        self.prefix = f"{SNAPSHOT_KEY}:{root}"
+
+    def folders(self) -> dict:
+        return {name: json.loads(value) for name, value in self.redis.hgetall(f"{self.prefix}:folders").items()}
+
+    def files(self, folders: list) -> dict:
+        pipe = self.redis.pipeline()
+        for folder in folders:
+            pipe.hgetall(f"{self.prefix}:files:{folder}")
+        return {folder: {name: json.loads(value) for name, value in entries.items()}
+                for folder, entries in zip(folders, pipe.execute())}
+
+    def full_scan_due(self, now: float) -> bool:
+        last = self.redis.get(f"{self.prefix}:full_at")
+        return last is None or now - float(last) >= SFTP_SCAN_FULL_EVERY
+
+    def save(self, folders: dict, listings: dict, removed: list, full: bool, now: float):
+        """folders: {pasta: {"mtime", "listed_at"}} das pastas relidas; listings: {pasta: {ficheiro: attrs}}"""
+        pipe = self.redis.pipeline()
+        if folders:
+            pipe.hset(f"{self.prefix}:folders", mapping={name: json.dumps(value) for name, value in folders.items()})
+        for folder, files in listings.items():
+            pipe.delete(f"{self.prefix}:files:{folder}")
+            if files:
+                pipe.hset(f"{self.prefix}:files:{folder}", mapping={name: json.dumps(value) for name, value in files.items()})
+        for folder in removed:
+            pipe.hdel(f"{self.prefix}:folders", folder)
+            pipe.delete(f"{self.prefix}:files:{folder}")
+        if full:
+            pipe.set(f"{self.prefix}:full_at", now)
+        pipe.execute()
+
+
+def _list_attrs(path: str) -> list:
+    started = time.perf_counter()
+    entries = _with_sftp(lambda sftp: sftp.listdir_attr(path))
+    SFTP_LIST_SECONDS.observe(time.perf_counter() - started)
+    return entries
+
+
+def _file_attrs(entries) -> dict:
+    return {entry.filename: {"size": entry.st_size, "mtime": entry.st_mtime}
+            for entry in entries if not stat.S_ISDIR(entry.st_mode or 0)}
+
+
+def scan_folders(remote_root: str, redis_client=None, workers: int = SFTP_DOWNLOAD_WORKERS) -> dict:
+    """Ficheiros de cada pasta NIF: {pasta: {ficheiro: {"size", "mtime"}}}.
+    Pastas começadas por '_' (_quarantine, _archive, ...) são ignoradas."""
+    now = time.time()
+    root_entries = _list_attrs(remote_root)
+    current = {entry.filename: entry.st_mtime for entry in root_entries
+               if stat.S_ISDIR(entry.st_mode or 0) and not entry.filename.startswith('_')}
+
+    store = None
+    if SFTP_SCAN_INCREMENTAL:
+        if redis_client is None:
+            from utils.redisUtil import get_redis
+            redis_client = get_redis()
+        store = SnapshotStore(redis_client, remote_root)
+
+    previous, cached, full = {}, {}, True
+    if store is not None:
+        try:
+            previous = store.folders()
+            full = store.full_scan_due(now)
+        except Exception as e:
+            logger.warning(f"⚠️ Snapshot SFTP indisponível, listagem completa: {str(e)}")
+            store = None
+
+    unchanged = []
+    for folder, mtime in current.items():
+        known = previous.get(folder)
+        if (full or known is None or known.get("mtime") != mtime
+                or mtime >= known.get("listed_at", 0) - SFTP_SCAN_MTIME_SLACK):
+            continue
+        unchanged.append(folder)
+    if unchanged:
+        try:
+            cached = store.files(unchanged)
+        except Exception as e:
+            logger.warning(f"⚠️ Snapshot SFTP indisponível, listagem completa: {str(e)}")
+            unchanged = []
+        # Listagem guardada incompleta (ex.: chave expulsa pelo LRU do Redis): reler a pasta
+        unchanged = [folder for folder in unchanged if len(cached.get(folder, {})) == previous[folder].get("files", 0)]
+    unchanged_set = set(unchanged)
+    changed = [folder for folder in current if folder not in unchanged_set]
+    removed = [folder for folder in previous if folder not in current]
+
+    listings = {}
+    if changed:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(changed))), thread_name_prefix="sftp-scan") as executor:
+            results = executor.map(lambda folder: _safe_list(f"{remote_root}/{folder}"), changed)
+            for folder, entries in zip(changed, results):
+                if entries is not None:
+                    listings[folder] = _file_attrs(entries)
+
+    result = {folder: cached[folder] for folder in unchanged}
+    result.update(listings)
+    if store is not None:
+        try:
+            store.save({folder: {"mtime": current[folder], "listed_at": now, "files": len(files)}
+                        for folder, files in listings.items()},
+                       listings, removed, full, now)
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao atualizar snapshot SFTP: {str(e)}")
+
+    logger.info(f"📂 Scan SFTP{' completo' if full else ''}: {len(current)} pastas, {len(listings)} listadas, "
+                f"{len(unchanged)} sem alterações, {sum(len(files) for files in result.values())} ficheiros")
+    return result
+
+
+def _safe_list(path: str):
+    try:
+        return _list_attrs(path)
+    except Exception as e:
+        logger.error(f"Erro ao processar pasta {os.path.basename(path)}: {str(e)}")
+        return None
+
+
+def classify_entry(folder: str, filename: str):
+    """Classe do ficheiro (FR | NC | OpenGCs), ou None se nenhum pipeline o processa"""
+    if filename.startswith(f"opengcs-{folder}"):
+        return "OpenGCs"
+    if filename.endswith(".xml") and filename[:2] in ("FR", "NC"):
+        return filename[:2]
+    return None
+
+
+def classify_scan(listing: dict) -> dict:
+    """{classe: {pasta: [ficheiros]}} a partir do resultado de scan_folders"""
+    work = {work_class: {} for classes in PIPELINES.values() for work_class in classes}
+    for folder, files in listing.items():
+        for filename in files:
+            work_class = classify_entry(folder, filename)
+            if work_class:
+                work[work_class].setdefault(folder, []).append(filename)
+    return work
+
+
+def _pipeline_items(work: dict, pipeline: str) -> dict:
+    items = {}
+    for work_class in PIPELINES[pipeline]:
+        for folder, files in work[work_class].items():
+            items.setdefault(folder, []).extend(files)
+    return items
+
+
+def scan_work_items(remote_root: str, pipeline: str, redis_client=None) -> dict:
+    """Ficheiros a processar pelo pipeline ('invoices' ou 'opengcs'): {pasta: [ficheiros]}.
+    Se a travessia do outro pipeline deixou itens recentes, usa-os sem tocar no SFTP; senão
+    percorre a árvore uma vez e entrega as restantes classes aos respetivos pipelines."""
+    if not SFTP_SCAN_SHARED:
+        return _pipeline_items(classify_scan(scan_folders(remote_root, redis_client)), pipeline)
+
+    if redis_client is None:
+        from utils.redisUtil import get_redis
+        redis_client = get_redis()
+
+    try:
+        pipe = redis_client.pipeline()
+        pipe.get(f"{WORK_KEY}:{remote_root}:{pipeline}")
+        pipe.delete(f"{WORK_KEY}:{remote_root}:{pipeline}")
+        pipe.get(f"{WORK_KEY}:{remote_root}:{pipeline}:valid_after")
+        raw, _, valid_after = pipe.execute()
+    except Exception as e:
+        logger.warning(f"⚠️ Itens do scan partilhado indisponíveis: {str(e)}")
+        raw = None
+    if raw is not None:
+        shared = json.loads(raw)
+        items = shared["items"]
+        if valid_after is None or shared["scanned_at"] >= float(valid_after):
+            logger.info(f"♻️ Scan SFTP partilhado: {sum(len(files) for files in items.values())} ficheiros "
+                        f"({pipeline}) da última travessia")
+            return items
+        logger.info(f"🗑️ Itens partilhados ({pipeline}) anteriores ao último ciclo descartados, nova travessia")
+
+    scanned_at = time.time()
+    work = classify_scan(scan_folders(remote_root, redis_client))
+    try:
+        pipe = redis_client.pipeline()
+        for other in PIPELINES:
+            if other != pipeline:
+                pipe.set(f"{WORK_KEY}:{remote_root}:{other}",
+                         json.dumps({"scanned_at": scanned_at, "items": _pipeline_items(work, other)}),
+                         ex=SFTP_SCAN_SHARE_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao entregar itens do scan aos outros pipelines: {str(e)}")
+    logger.info("📋 Itens do scan: " + ", ".join(f"{sum(len(files) for files in folders.values())} {work_class}"
+                                                  for work_class, folders in work.items()))
+    return _pipeline_items(work, pipeline)
+
+
+def invalidate_work_items(remote_root: str, pipeline: str, redis_client=None):
+    """Chamado quando um ciclo do pipeline termina (e excluiu ficheiros do SFTP): itens
+    partilhados de travessias que começaram antes deixam de ser usados"""
+    if not SFTP_SCAN_SHARED:
+        return
+    if redis_client is None:
+        from utils.redisUtil import get_redis
+        redis_client = get_redis()
+    redis_client.set(f"{WORK_KEY}:{remote_root}:{pipeline}:valid_after", time.time(), ex=SFTP_SCAN_SHARE_TTL)
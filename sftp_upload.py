@@ -3,7 +3,7 @@ import logging
 import os
 from datetime import datetime
 
-from sftp_connection import connect_sftp
+from sftp_connection import acquire_sftp, release_sftp
 
 logger = logging.getLogger(__name__)
 
@@ -16,33 +16,37 @@ class SFTPXMLUploader:
 
     def __init__(self):
         self.sftp = None
-        self.transport = None
+        # Pastas já verificadas nesta sessão (um lote do mesmo NIF verifica a pasta uma vez)
+        self._known_dirs = set()
 
     def __enter__(self):
-        self.sftp, self.transport = connect_sftp()
+        # Canal de um transporte do pool: sem novo handshake SSH por upload
+        self.sftp = acquire_sftp()
         if self.sftp is None:
             raise ConnectionError("Não foi possível estabelecer conexão SFTP")
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.sftp:
-            self.sftp.close()
-        if self.transport:
-            self.transport.close()
+        release_sftp(self.sftp)
+        self.sftp = None
 
     def _ensure_remote_dir(self, remote_path: str):
         """Cria a directoria remota se não existir."""
+        if remote_path in self._known_dirs:
+            return
         try:
             self.sftp.stat(remote_path)
         except FileNotFoundError:
             logger.info(f"📁 Criando pasta remota: {remote_path}")
             self.sftp.mkdir(remote_path)
+        self._known_dirs.add(remote_path)
 
     def upload_xml(
         self,
         xml_content: bytes,
         nif: str,
         filename: str | None = None,
+        root: str = SFTP_ROOT,
     ) -> dict:
         """
         Faz upload de um ficheiro XML para a pasta do NIF no SFTP.
@@ -51,6 +55,7 @@ class SFTPXMLUploader:
             xml_content: conteúdo do XML em bytes.
             nif: NIF (CompanyID) extraído do XML — define a pasta de destino.
             filename: nome do ficheiro remoto. Se omitido, gera um nome com timestamp.
+            root: pasta raiz das pastas por NIF (ex: a pasta de arquivo, ignorada pelo scan).
 
         Returns:
             dict com remote_path e filename do ficheiro enviado.
@@ -72,10 +77,12 @@ class SFTPXMLUploader:
             filename += ".xml"
 
         # Caminho da pasta do NIF no SFTP
-        nif_folder = f"{SFTP_ROOT}/{nif}"
+        nif_folder = f"{root}/{nif}"
         remote_path = f"{nif_folder}/{filename}"
 
-        # Criar pasta do NIF se necessário
+        # Criar pasta do NIF (e a raiz, se for outra) se necessário
+        if root != SFTP_ROOT:
+            self._ensure_remote_dir(root)
         self._ensure_remote_dir(nif_folder)
 
         # Fazer upload a partir de buffer em memória (sem disco)
@@ -96,6 +103,7 @@ def upload_xml_to_sftp(
     xml_content: bytes,
     nif: str,
     filename: str | None = None,
+    root: str = SFTP_ROOT,
 ) -> dict:
     """
     Função de conveniência para upload de um XML sem gerir o contexto manualmente.
@@ -107,4 +115,4 @@ def upload_xml_to_sftp(
         dict com remote_path, filename, nif_folder e size_bytes.
     """
     with SFTPXMLUploader() as uploader:
-        return uploader.upload_xml(xml_content, nif, filename)
+        return uploader.upload_xml(xml_content, nif, filename, root)
@@ -10,21 +10,38 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-def start_celery_worker():
-    """Inicia o Celery worker"""
-    print("🚀 Iniciando Celery worker...")
+# Fila -> (concorrência, prefetch), configuráveis por variáveis de ambiente
+WORKER_QUEUES = {
+    "scan": (os.getenv("SCAN_CONCURRENCY", "1"), os.getenv("SCAN_PREFETCH", "1")),
+    "ingest-fr": (os.getenv("INGEST_FR_CONCURRENCY", "4"), os.getenv("INGEST_FR_PREFETCH", "1")),
+    "ingest-nc": (os.getenv("INGEST_NC_CONCURRENCY", "2"), os.getenv("INGEST_NC_PREFETCH", "1")),
+    "sftp-upload": (os.getenv("SFTP_UPLOAD_CONCURRENCY", "4"), os.getenv("SFTP_UPLOAD_PREFETCH", "4")),
+    "opengcs": (os.getenv("OPENGCS_CONCURRENCY", "1"), os.getenv("OPENGCS_PREFETCH", "1")),
+}
+
+# Filas consumidas antes da fila principal do worker (a ordem define a prioridade)
+WORKER_PRIORITY_QUEUES = {
+    "ingest-fr": ["ingest-live"],
+    "ingest-nc": ["ingest-live"],
+}
+
+def start_celery_worker(queue, concurrency, prefetch):
+    """Inicia um Celery worker dedicado a uma fila"""
+    print(f"🚀 Iniciando Celery worker da fila '{queue}' (concorrência {concurrency}, prefetch {prefetch})...")
     try:
         # Comando para iniciar o worker
         cmd = [
             "celery", "-A", "celery_config.celery_app", 
-            "worker", "--loglevel=info", "--concurrency=1"
+            "worker", "-Q", ",".join(WORKER_PRIORITY_QUEUES.get(queue, []) + [queue]), "-n", f"{queue}@%h",
+            "--loglevel=info", f"--concurrency={concurrency}",
+            f"--prefetch-multiplier={prefetch}"
         ]
         
         process = subprocess.Popen(cmd)
-        print(f"✅ Celery worker iniciado com PID: {process.pid}")
+        print(f"✅ Celery worker '{queue}' iniciado com PID: {process.pid}")
         return process
     except Exception as e:
-        print(f"❌ Erro ao iniciar Celery worker: {e}")
+        print(f"❌ Erro ao iniciar Celery worker '{queue}': {e}")
         return None
 
 def start_celery_beat():
@@ -71,11 +88,16 @@ def main():
     redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
     print(f"📡 Conectando ao Redis: {redis_url}")
     
-    # Iniciar worker
-    worker_process = start_celery_worker()
-    if not worker_process:
-        print("❌ Falha ao iniciar worker. Saindo...")
-        sys.exit(1)
+    # Iniciar um worker por fila
+    worker_processes = {}
+    for queue, (concurrency, prefetch) in WORKER_QUEUES.items():
+        process = start_celery_worker(queue, concurrency, prefetch)
+        if not process:
+            print("❌ Falha ao iniciar worker. Saindo...")
+            for running in worker_processes.values():
+                running.terminate()
+            sys.exit(1)
+        worker_processes[queue] = process
     
     # Aguardar um pouco antes de iniciar o beat
     time.sleep(2)
@@ -84,7 +106,8 @@ def main():
     beat_process = start_celery_beat()
     if not beat_process:
         print("❌ Falha ao iniciar beat. Saindo...")
-        worker_process.terminate()
+        for running in worker_processes.values():
+            running.terminate()
         sys.exit(1)
     
     # Aguardar um pouco antes de iniciar o Flower
@@ -94,13 +117,14 @@ def main():
     flower_process = start_flower()
     if not flower_process:
         print("❌ Falha ao iniciar Flower. Saindo...")
-        worker_process.terminate()
+        for running in worker_processes.values():
+            running.terminate()
         beat_process.terminate()
         sys.exit(1)
     
     print("✅ Todos os serviços iniciados com sucesso!")
     print("📋 Serviços disponíveis:")
-    print("   - Celery Worker: Processando tarefas")
+    print(f"   - Celery Workers: {', '.join(worker_processes)}")
     print("   - Celery Beat: Agendando tarefas a cada 5 minutos")
     print("   - Flower: http://localhost:5555 (monitoramento)")
     print("📋 Para parar os serviços, pressione Ctrl+C")
@@ -111,8 +135,9 @@ def main():
             time.sleep(1)
             
             # Verificar se os processos ainda estão rodando
-            if worker_process.poll() is not None:
-                print("❌ Celery worker parou inesperadamente")
+            stopped = [queue for queue, process in worker_processes.items() if process.poll() is not None]
+            if stopped:
+                print(f"❌ Celery worker parou inesperadamente: {', '.join(stopped)}")
                 break
                 
             if beat_process.poll() is not None:
@@ -127,9 +152,9 @@ def main():
         print("\n🛑 Parando serviços...")
         
         # Terminar processos
-        if worker_process:
-            worker_process.terminate()
-            print("✅ Celery worker parado")
+        for queue, process in worker_processes.items():
+            process.terminate()
+            print(f"✅ Celery worker '{queue}' parado")
             
         if beat_process:
             beat_process.terminate()
@@ -1,17 +1,37 @@
 import os
 import sys
+import time
 import logging
 from pathlib import Path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'celery'))
 from celery_config import celery_app
-from sftp_connection import download_files_from_sftp, delete_file_from_sftp, connect_sftp, download_opengcs_files_from_sftp, delete_opengcs_file_from_sftp
-from sftp_upload import upload_xml_to_sftp
-from celery import chain
+from sftp_connection import download_files_from_sftp, delete_file_from_sftp, delete_files_from_sftp, connect_sftp, download_opengcs_files_from_sftp, delete_opengcs_file_from_sftp, load_file_mappings, move_file_on_sftp
+from sftp_upload import upload_xml_to_sftp, SFTPXMLUploader, SFTP_ROOT
+from celery import chain, chord
+from celery.exceptions import SoftTimeLimitExceeded
 
 # Importar as novas referências
 from utils.xml_parser import parse_xml_to_json, parse_opengcs_xml_to_json
-from utils.file_utils import remove_file_safely, file_existis, invoice_fr_or_nc
-from services.db_ops import process_and_insert_invoice_batch, process_nc_file, insert_opengcs_to_supabase
+from utils.file_utils import remove_file_safely, file_existis, invoice_fr_or_nc, nif_from_local_filename
+from services.db_ops import process_and_insert_invoice_batch, process_and_insert_invoice_micro_batch, process_nc_file, insert_opengcs_to_supabase, reconcile_pending_deactivations
+from utils.db_metrics import file_scope
+from utils.stage_metrics import stage, stage_scope, record_stage
+from services.drain_controller import DrainController, DRAIN_MODE, queue_depth
+from services.priority_lane import (choose_live_queue, LIVE_INGEST_ENABLED, SFTP_ARCHIVE_ENABLED, SFTP_ARCHIVE_DIR,
+                                    DIRECT_INGEST_MAX_REDISPATCH, track_direct_entry, untrack_direct_entry,
+                                    stale_direct_entries, redispatch_direct_entry)
+from services.autoscaler import run_autoscaler, AUTOSCALE_ENABLED
+from services.upload_batcher import (UPLOAD_BATCH_ENABLED, UPLOAD_BATCH_WINDOW, UPLOAD_MAX_ATTEMPTS, UPLOAD_RETRY_DELAY,
+                                     UPLOAD_INFLIGHT_TIMEOUT, enqueue_upload, claim_flush, release_flush, take_batch,
+                                     requeue_uploads, acknowledge, heartbeat, complete_upload, finish_batch,
+                                     has_inflight, reclaim_stale_batches)
+from services.quarantine import deferred_files, record_failure, clear_failure, mark_quarantined, quarantine_path, is_file_error, FILE_ERROR
+from utils.redisUtil import get_redis
+from utils.redis_lock import LeaseLock
+from utils.task_progress import TaskProgress
+from utils.spool import get_spool, get_blob_spool, file_content_key, content_key, key_content_hash
+from utils.file_mappings import get_file_mappings
+from sftp_scanner import invalidate_work_items
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +41,24 @@ logger = logging.getLogger(__name__)
 MAX_FILES_PER_BATCH = int(os.getenv("MAX_FILES_PER_BATCH", "50"))
 CLEANUP_AFTER_PROCESSING = os.getenv("CLEANUP_AFTER_PROCESSING", "true").lower() == "true"
 
+# OpenGCs corre na sua própria fila/cadência; o orçamento limita cada ciclo
+OPENGCS_TIME_BUDGET = float(os.getenv("OPENGCS_TIME_BUDGET", "20"))
+OPENGCS_SOFT_TIME_LIMIT = int(os.getenv("OPENGCS_SOFT_TIME_LIMIT", "60"))
+# Os OpenGCs não saem do SFTP: o hash do conteúdo ingerido fica por caminho remoto e o
+# ciclo só processa ficheiros novos ou alterados, por isso o orçamento avança pelo backlog
+OPENGCS_INGESTED_KEY = "opengcs:ingested"
+
+# Micro-lotes: FRs pequenas do mesmo NIF são ingeridas juntas (MICRO_BATCH_SIZE=1 desativa)
+MICRO_BATCH_SIZE = int(os.getenv("MICRO_BATCH_SIZE", "10"))
+MICRO_BATCH_MAX_BYTES = int(os.getenv("MICRO_BATCH_MAX_BYTES", "65536"))
+
+# Um único ciclo de scan SFTP de cada vez: lease renovado durante o download e
+# mantido até o chord terminar (os ficheiros só saem do SFTP depois de ingeridos)
+SCAN_LOCK_KEY = "lock:scan:sftp"
+SCAN_RERUN_KEY = "lock:scan:sftp:rerun"
+SCAN_LOCK_TTL = int(os.getenv("SCAN_LOCK_TTL", "60"))
+SCAN_CYCLE_LEASE = int(os.getenv("SCAN_CYCLE_LEASE", "900"))
+
 def cleanup_processed_files():
     """Limpa arquivos processados das pastas"""
     if not CLEANUP_AFTER_PROCESSING:
@@ -50,6 +88,15 @@ def cleanup_processed_files():
 
 def process_single_opengcs_file(xml_file_path: str):
     """Tarefa Celery para processar um arquivo OpenGCs individual"""
+    filename = os.path.basename(xml_file_path)
+    with stage_scope("OpenGCs", nif_from_local_filename(filename)) as stage_timer:
+        with file_scope(filename, "OpenGCs") as db_stats:
+            result = _process_single_opengcs_file(xml_file_path)
+    result["db"] = db_stats.summary()
+    result["stages"] = stage_timer.summary()
+    return result
+
+def _process_single_opengcs_file(xml_file_path: str):
     logger.info(f"🔄 Iniciando processamento do arquivo OpenGCs: {xml_file_path}")
     try:
         # Verificar se arquivo existe
@@ -62,7 +109,8 @@ def process_single_opengcs_file(xml_file_path: str):
         
         if json_data:
             # Inserir no Supabase
-            insertion_success = insert_opengcs_to_supabase(json_data, xml_file_path)
+            with stage("db.opengcs"):
+                insertion_success = insert_opengcs_to_supabase(json_data, xml_file_path)
             
             if insertion_success:
                 # Excluir arquivo do SFTP apenas se a inserção foi bem-sucedida
@@ -102,60 +150,315 @@ def process_single_opengcs_file(xml_file_path: str):
         logger.error(f"Erro ao processar OpenGCs {xml_file_path}: {str(e)}")
         return {"status": "error", "file": xml_file_path, "message": str(e)}
 
-@celery_app.task
-def download_and_queue_opengcs_files():
-    """Tarefa Celery para baixar arquivos OpenGCs SFTP e criar tarefas individuais"""
+def pending_opengcs_files(redis_client, ledger_keys: dict) -> list:
+    """Ficheiros (por ordem) cujo conteúdo ainda não foi ingerido. ledger_keys: {local: (remoto, hash)}"""
+    files = list(ledger_keys)
+    try:
+        ingested = redis_client.hmget(OPENGCS_INGESTED_KEY, [ledger_keys[xml_file][0] for xml_file in files])
+    except Exception as e:
+        logger.warning(f"⚠️ Registo de OpenGCs ingeridos indisponível, a processar todos: {str(e)}")
+        return files
+    return [xml_file for xml_file, content_hash in zip(files, ingested) if content_hash != ledger_keys[xml_file][1]]
+
+def mark_opengcs_ingested(redis_client, remote_path: str, content_hash: str):
+    try:
+        redis_client.hset(OPENGCS_INGESTED_KEY, remote_path, content_hash)
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao registar OpenGCs ingerido {remote_path}: {str(e)}")
+
+@celery_app.task(bind=True, soft_time_limit=OPENGCS_SOFT_TIME_LIMIT, time_limit=OPENGCS_SOFT_TIME_LIMIT + 15)
+def download_and_queue_opengcs_files(self):
+    """Tarefa Celery (fila 'opengcs', agendamento próprio) para baixar e processar arquivos OpenGCs.
+    Respeita OPENGCS_TIME_BUDGET: o que não couber no orçamento fica para o próximo ciclo."""
     logger.info("🔄 Iniciando download de arquivos OpenGCs SFTP...")
+    started_at = time.monotonic()
+    processed = []
+    progress = TaskProgress(self, stage="download", status="A baixar arquivos OpenGCs")
     
     try:
         # Baixar arquivos OpenGCs do SFTP
-        downloaded_files = download_opengcs_files_from_sftp()
+        downloaded_files = download_opengcs_files_from_sftp(
+            on_progress=lambda pastas, total, arquivos: progress.update(current=pastas, total=total, files_scanned=arquivos)
+        )
         
         if not downloaded_files:
             logger.info("Nenhum arquivo OpenGCs encontrado no SFTP")
             return {"status": "success", "message": "Nenhum arquivo OpenGCs para processar", "queued_tasks": 0}
         
+        # Ficheiros já ingeridos com o mesmo conteúdo não voltam a ocupar o lote
+        redis_client = get_redis()
+        mappings = load_file_mappings(downloaded_files)
+        ledger_keys = {xml_file: (mappings.get(xml_file, {}).get("remote_path") or xml_file, file_content_key(xml_file))
+                       for xml_file in downloaded_files}
+        pending_files = pending_opengcs_files(redis_client, ledger_keys)
+        unchanged_files = len(downloaded_files) - len(pending_files)
+
         # Limitar número de arquivos processados por vez
-        files_to_process = downloaded_files[:MAX_FILES_PER_BATCH]
-        remaining_files = len(downloaded_files) - len(files_to_process)
+        files_to_process = pending_files[:MAX_FILES_PER_BATCH]
         
-        logger.info(f"📊 Total de arquivos OpenGCs baixados: {len(downloaded_files)}")
-        logger.info(f"📊 Arquivos OpenGCs a processar neste lote: {len(files_to_process)}")
-        if remaining_files > 0:
-            logger.info(f"📊 Arquivos OpenGCs restantes para próximo lote: {remaining_files}")
+        logger.info(f"📊 Total de arquivos OpenGCs baixados: {len(downloaded_files)} ({unchanged_files} já ingeridos sem alterações)")
+        logger.info(f"📊 Arquivos OpenGCs a processar neste lote: {len(files_to_process)} (orçamento: {OPENGCS_TIME_BUDGET}s)")
         
-        # Criar tarefa individual para cada arquivo (limitado)
-        queued_tasks = []
+        progress.update(current=0, total=len(files_to_process), stage="process",
+                        status="A processar arquivos OpenGCs", force=True)
         for xml_file in files_to_process:
-            # Criar tarefa individual no Celery
+            if time.monotonic() - started_at >= OPENGCS_TIME_BUDGET:
+                logger.info("⏱️ Orçamento de tempo OpenGCs esgotado, restantes ficam para o próximo ciclo")
+                break
             result = process_single_opengcs_file(xml_file)
-            queued_tasks.append({
+            if result.get("status") == "success":
+                mark_opengcs_ingested(redis_client, *ledger_keys[xml_file])
+            progress.update(current=len(processed) + 1, rows_written=progress.meta.get("rows_written", 0) + result["db"]["rows"])
+            processed.append({
                 "file": xml_file,
-                "task_id": result.get("task_id", None),
                 "status": result.get("status", "unknown")
             })
         
-        logger.info(f"✅ {len(queued_tasks)} tarefas OpenGCs criadas para processamento")
+        remaining_files = len(pending_files) - len(processed)
+        if remaining_files > 0:
+            logger.info(f"📊 Arquivos OpenGCs restantes para próximo lote: {remaining_files}")
+        logger.info(f"✅ {len(processed)} arquivos OpenGCs processados em {time.monotonic() - started_at:.1f}s")
         
         return {
             "status": "success", 
-            "message": f"{len(queued_tasks)} arquivos OpenGCs baixados e tarefas criadas (limite: {MAX_FILES_PER_BATCH})",
-            "queued_tasks": len(queued_tasks),
+            "message": f"{len(processed)} arquivos OpenGCs processados (limite: {MAX_FILES_PER_BATCH}, orçamento: {OPENGCS_TIME_BUDGET}s)",
+            "queued_tasks": len(processed),
             "total_files": len(downloaded_files),
-            "processed_files": len(files_to_process),
+            "unchanged_files": unchanged_files,
+            "processed_files": len(processed),
             "remaining_files": remaining_files,
-            "tasks": queued_tasks
+            "tasks": processed
         }
         
+    except SoftTimeLimitExceeded:
+        logger.warning(f"⏱️ Limite de tempo da tarefa OpenGCs atingido após {len(processed)} arquivos")
+        return {"status": "warning", "message": "Limite de tempo atingido", "processed_files": len(processed), "tasks": processed}
     except Exception as e:
         logger.error(f"Erro geral no download SFTP OpenGCs: {str(e)}")
         return {"status": "error", "message": str(e)}
 
 
 
-@celery_app.task
-def process_single_xml_file(xml_file_path: str):
-    """Processa um arquivo XML individual (FR ou NC)"""
+@celery_app.task(bind=True)
+def process_single_xml_file(self, xml_file_path: str, spool_key: str = None, scan_token: str = None):
+    """Processa um arquivo XML individual (FR ou NC).
+    Com spool_key o conteúdo vem do spool, pelo que a tarefa pode correr em qualquer worker.
+    Com scan_token (ficheiros de um ciclo de scan) renova o lease do scan ao terminar.
+    O resultado inclui o tempo de cada etapa (download, parse, fases da DB, exclusão SFTP, ...)"""
+    filename = os.path.basename(xml_file_path)
+    try:
+        with stage_scope(invoice_fr_or_nc(filename), nif_from_local_filename(filename)) as stage_timer:
+            result = _ingest_single_xml_file(self, xml_file_path, spool_key)
+    finally:
+        renew_scan_lease(scan_token)
+    result["stages"] = stage_timer.summary()
+    return result
+
+def _ingest_single_xml_file(task, xml_file_path: str, spool_key: str = None):
+    filename = os.path.basename(xml_file_path)
+    spool_meta = {}
+    claim_token = None
+    if spool_key:
+        spool = get_spool()
+        xml_file_path, spool_meta, claim_token, error = _claim_spooled_file(spool, xml_file_path, spool_key)
+        if error:
+            return error
+    remote_path = spool_meta.get("remote_path")
+    # Recebido pela API e despachado sem passar pelo SFTP: não há ficheiro remoto a excluir
+    direct = bool(spool_meta.get("direct"))
+
+    progress = TaskProgress(task, stage="parse", status=f"A processar {filename}")
+    # Resumo das chamadas à DB (round trips, latência, linhas, bytes) vai no resultado da tarefa
+    started = time.perf_counter()
+    result = None
+    try:
+        with file_scope(filename, invoice_fr_or_nc(filename),
+                        on_record=lambda stats: progress.update(stage="db", rows_written=stats.rows)) as db_stats:
+            result = _process_single_xml_file(xml_file_path, progress, remote_path, delete_remote=not direct)
+    finally:
+        if spool_key and direct:
+            spool.release(spool_key, claim_token)
+            hand_off_direct_ingest(spool, spool_key, spool_meta, result)
+        elif spool_key:
+            # Ingerido ou em quarentena: sai do spool. Caso contrário o claim é libertado e o próximo scan volta a tentar
+            spool.release(spool_key, claim_token)
+            quarantined = track_ingest_outcome(result, remote_path, key_content_hash(spool_key))
+            if quarantined or (result and result.get("status") == "success"):
+                spool.delete(spool_key)
+    progress.flush()
+    result["db"] = db_stats.summary()
+    result["duration_seconds"] = round(time.perf_counter() - started, 4)
+    return result
+
+def track_ingest_outcome(result: dict, remote_path: str, content_hash: str) -> bool:
+    """Atualiza o ledger de falhas do ficheiro; devolve True se foi posto em quarentena"""
+    if not result or not remote_path or not content_hash:
+        return False
+    try:
+        redis_client = get_redis()
+        if result.get("status") == "success":
+            clear_failure(redis_client, remote_path, content_hash)
+            return False
+        if not is_file_error(result):
+            # Erros transitórios (DB, rede, spool) não contam: o próximo scan volta a tentar
+            return False
+
+        entry = record_failure(redis_client, remote_path, content_hash, result.get("message"))
+        result["attempts"] = entry["attempts"]
+        if not entry["quarantine"]:
+            return False
+        target = quarantine_path(remote_path)
+        if move_file_on_sftp(remote_path, target):
+            mark_quarantined(redis_client, remote_path, content_hash, target)
+            result["quarantined_to"] = target
+            logger.warning(f"☣️ {os.path.basename(remote_path)} em quarentena após {entry['attempts']} tentativas: {target}")
+            return True
+    except Exception as e:
+        logger.error(f"Erro ao atualizar ledger de falhas de {remote_path}: {str(e)}")
+    return False
+
+def hand_off_direct_ingest(spool, spool_key: str, spool_meta: dict, result: dict):
+    """Depois da ingestão direta o ficheiro segue para o SFTP em background: para a pasta
+    de arquivo se foi ingerido, ou para a pasta do NIF se falhou, onde o scan normal volta
+    a tentar (com a quarentena de falhas repetidas)"""
+    if result and result.get("status") == "skipped":
+        return
+    success = bool(result and result.get("status") == "success")
+    if success and not SFTP_ARCHIVE_ENABLED:
+        spool.delete(spool_key)
+        untrack_direct_entry(get_redis(), spool_key)
+        return
+    try:
+        blob_key = get_blob_spool().put(spool.get(spool_key))
+        queue_sftp_upload(blob_key, spool_meta.get("nif_folder"), spool_meta.get("received_filename"), archive=success)
+        spool.delete(spool_key)
+        untrack_direct_entry(get_redis(), spool_key)
+    except Exception as e:
+        # O conteúdo continua no spool e no registo de pendentes: a reconciliação no gc volta a tentar
+        logger.error(f"❌ Falha ao enviar {spool_meta.get('received_filename')} (spool {spool_key[:12]}) para o SFTP: {str(e)}")
+
+def _claim_spooled_file(spool, xml_file_path: str, spool_key: str):
+    """Reclama a chave no spool e materializa o ficheiro neste worker.
+    Devolve (caminho_local, metadados_do_spool, token, resultado_de_erro)"""
+    filename = os.path.basename(xml_file_path)
+    claim_token = spool.claim(spool_key)
+    if claim_token is None:
+        logger.info(f"⏭️ {filename} já está a ser processado por outro worker")
+        return xml_file_path, {}, None, {"status": "skipped", "file": xml_file_path, "message": "Ficheiro reclamado por outro worker"}
+    try:
+        meta = spool.meta(spool_key)
+        # O download do SFTP foi feito no scan; a duração vem nos metadados do spool
+        record_stage("download", meta.get("download_seconds"))
+        with stage("spool"):
+            local_path = spool.materialize(spool_key, filename)
+        return local_path, meta, claim_token, None
+    except Exception as e:
+        spool.release(spool_key, claim_token)
+        logger.error(f"❌ Falha ao obter {filename} do spool: {str(e)}")
+        return xml_file_path, {}, None, {"status": "error", "file": xml_file_path, "message": f"Spool indisponível: {str(e)}"}
+
+@celery_app.task(bind=True)
+def process_xml_micro_batch(self, files: list, scan_token: str = None):
+    """Ingere várias FRs pequenas do mesmo NIF: parse de todas, upserts combinados e
+    exclusão remota numa só sessão SFTP. Devolve um resultado por ficheiro.
+    files: [{"path": ..., "spool_key": ...}]"""
+    nif = nif_from_local_filename(os.path.basename(files[0]["path"])) if files else ""
+    try:
+        with stage_scope("FR", nif) as stage_timer:
+            ordered = _ingest_xml_micro_batch(self, files)
+    finally:
+        renew_scan_lease(scan_token)
+    # Etapas do lote inteiro vão no primeiro resultado, tal como o resumo da DB
+    for index, result in enumerate(ordered):
+        result["stages"] = stage_timer.summary() if index == 0 else None
+    return ordered
+
+def _ingest_xml_micro_batch(task, files: list):
+    started = time.perf_counter()
+    spool = get_spool()
+    progress = TaskProgress(task, total=len(files), stage="parse", status=f"Micro-lote de {len(files)} ficheiros")
+    results = {}
+    claimed = []  # (caminho_original, caminho_local, caminho_remoto, spool_key, token, json_data)
+
+    for entry in files:
+        xml_file_path, spool_key = entry["path"], entry.get("spool_key")
+        remote_path, claim_token = None, None
+        if spool_key:
+            xml_file_path, spool_meta, claim_token, error = _claim_spooled_file(spool, xml_file_path, spool_key)
+            if error:
+                results[entry["path"]] = error
+                continue
+            remote_path = spool_meta.get("remote_path")
+        try:
+            json_data = parse_xml_to_json(xml_file_path)
+        except Exception as e:
+            logger.error(f"Erro ao processar {xml_file_path}: {str(e)}")
+            json_data = None
+        if not json_data:
+            results[entry["path"]] = {"status": "error", "file": xml_file_path, "type": "FR", "message": "Falha na conversão XML",
+                                      "error_kind": FILE_ERROR}
+            if spool_key:
+                spool.release(spool_key, claim_token)
+                if track_ingest_outcome(results[entry["path"]], remote_path, key_content_hash(spool_key)):
+                    spool.delete(spool_key)
+            continue
+        claimed.append((entry["path"], xml_file_path, remote_path, spool_key, claim_token, json_data))
+        progress.update(current=len(claimed), invoices_parsed=progress.meta.get("invoices_parsed", 0) + json_data.get("total_faturas", 0))
+
+    db_summary = None
+    if claimed:
+        progress.update(stage="db", force=True)
+        nif = nif_from_local_filename(os.path.basename(claimed[0][1]))
+        with file_scope(f"micro-lote {nif} ({len(claimed)} ficheiros)", "FR",
+                        on_record=lambda stats: progress.update(rows_written=stats.rows)) as db_stats:
+            outcome = process_and_insert_invoice_micro_batch([item[5] for item in claimed])
+            # Ficheiros que falharam no lote combinado são repetidos sozinhos para isolar o problema
+            for item in claimed:
+                if not outcome.get(item[5]["arquivo_origem"]):
+                    outcome[item[5]["arquivo_origem"]] = process_and_insert_invoice_batch(item[5])
+        db_summary = db_stats.summary()
+
+        # Exclusão remota dos ficheiros ingeridos numa única sessão
+        progress.update(stage="cleanup", force=True)
+        ingested = [item for item in claimed if outcome.get(item[5]["arquivo_origem"])]
+        mappings = load_file_mappings([item[0] for item in ingested if not item[2]])
+        remote_paths = {}
+        for original_path, xml_file_path, remote_path, _, _, json_data in ingested:
+            remote_paths[original_path] = remote_path or mappings.get(original_path, {}).get("remote_path")
+        with stage("sftp_delete"):
+            deleted = delete_files_from_sftp([path for path in remote_paths.values() if path])
+        get_file_mappings().delete(*[original_path for original_path, remote_path in remote_paths.items()
+                                     if deleted.get(remote_path)])
+
+        for original_path, xml_file_path, remote_path, spool_key, claim_token, json_data in claimed:
+            success = bool(outcome.get(json_data["arquivo_origem"]))
+            if success:
+                if not deleted.get(remote_paths.get(original_path)):
+                    logger.warning(f"⚠️ Falha ao excluir arquivo do SFTP: {os.path.basename(xml_file_path)}")
+                with stage("cleanup"):
+                    remove_file_safely(xml_file_path, "Arquivo XML")
+                results[original_path] = {"status": "success", "file": xml_file_path, "type": "FR",
+                                          "total_faturas": json_data.get("total_faturas", 0)}
+            else:
+                results[original_path] = {"status": "error", "file": xml_file_path, "type": "FR",
+                                          "message": "Falha na inserção no banco de dados"}
+            if spool_key:
+                spool.release(spool_key, claim_token)
+                if track_ingest_outcome(results[original_path], remote_path, key_content_hash(spool_key)) or success:
+                    spool.delete(spool_key)
+
+    progress.flush()
+    # Tempo e chamadas à DB do lote repartidos pelos ficheiros (o controlador de escoamento mede por ficheiro)
+    duration = (time.perf_counter() - started) / max(1, len(files))
+    ordered = [results[entry["path"]] for entry in files]
+    for index, result in enumerate(ordered):
+        result["duration_seconds"] = round(duration, 4)
+        result["micro_batch"] = len(files)
+        result["db"] = db_summary if index == 0 else None
+    return ordered
+
+def _process_single_xml_file(xml_file_path: str, progress: TaskProgress = None, remote_path: str = None,
+                             delete_remote: bool = True):
     try:
         file_existis(xml_file_path)
         
@@ -165,31 +468,37 @@ def process_single_xml_file(xml_file_path: str):
         
         if file_type == 'NC':
             # Processar arquivo NC (extrair referências e deletar faturas referenciadas)
-            nc_result = process_nc_file(xml_file_path)
+            with stage("nc_deactivation"):
+                nc_result = process_nc_file(xml_file_path)
             
             # Agora também salvar a invoice NC no banco (mesmo processo das FRs)
             logger.info(f"🔄 Processando e salvando invoice NC no banco: {filename}")
             
             # Converter XML para JSON
             json_data = parse_xml_to_json(xml_file_path)
+            if json_data and progress:
+                progress.update(stage="db", invoices_parsed=json_data.get("total_faturas", 0), force=True)
             
             if json_data:
                 # Processar e inserir no Supabase usando dicionário de memória
                 insertion_success = process_and_insert_invoice_batch(json_data)
                 
-                if insertion_success and nc_result["status"] in ["success", "warning"]:
+                if insertion_success and nc_result["status"] in ["success", "warning"] and delete_remote:
                     # Excluir arquivo do SFTP apenas se a inserção foi bem-sucedida E o processamento de referências foi OK
                     logger.info(f"🗑️ Excluindo arquivo NC do SFTP após processamento bem-sucedido: {xml_file_path}")
                 
-                    sftp_deleted = delete_file_from_sftp(xml_file_path)
+                    with stage("sftp_delete"):
+                        sftp_deleted = delete_file_from_sftp(xml_file_path, remote_path=remote_path)
                     
                     if sftp_deleted:
                         logger.info(f"✅ Arquivo NC excluído do SFTP com sucesso: {filename}")
                     else:
                         logger.warning(f"⚠️ Falha ao excluir arquivo NC do SFTP: {filename}")
-                    
+
+                if insertion_success and nc_result["status"] in ["success", "warning"]:
                     # Remover arquivos locais após processamento bem-sucedido
-                    remove_file_safely(xml_file_path, "Arquivo NC XML")
+                    with stage("cleanup"):
+                        remove_file_safely(xml_file_path, "Arquivo NC XML")
                     
                     logger.info(f"✅ Arquivo NC processado e salvo com sucesso: {xml_file_path}")
                     return {
@@ -198,6 +507,7 @@ def process_single_xml_file(xml_file_path: str):
                         "type": "NC",
                         "total_faturas": json_data.get("total_faturas", 0),
                         "deactivated_invoices": nc_result.get("deactivated_invoices", []),
+                        "pending_deactivations": nc_result.get("pending_deactivations", []),
                         "failed_deactivations": nc_result.get("failed_deactivations", []),
                         "total_references": nc_result.get("total_references", 0),
                         "message": f"NC salva no banco. {nc_result['message']}"
@@ -211,6 +521,7 @@ def process_single_xml_file(xml_file_path: str):
                         "type": "NC",
                         "message": "Falha na inserção da invoice NC no banco de dados",
                         "deactivated_invoices": nc_result.get("deactivated_invoices", []),
+                        "pending_deactivations": nc_result.get("pending_deactivations", []),
                         "failed_deactivations": nc_result.get("failed_deactivations", []),
                         "total_references": nc_result.get("total_references", 0)
                     }
@@ -223,6 +534,7 @@ def process_single_xml_file(xml_file_path: str):
                         "type": "NC",
                         "total_faturas": json_data.get("total_faturas", 0),
                         "deactivated_invoices": nc_result.get("deactivated_invoices", []),
+                        "pending_deactivations": nc_result.get("pending_deactivations", []),
                         "failed_deactivations": nc_result.get("failed_deactivations", []),
                         "total_references": nc_result.get("total_references", 0),
                         "message": f"NC salva no banco, mas {nc_result.get('message', 'problemas no processamento de referências')}"
@@ -237,6 +549,7 @@ def process_single_xml_file(xml_file_path: str):
                         "type": "NC",
                         "message": "Falha na conversão XML da invoice NC, mas referências foram processadas",
                         "deactivated_invoices": nc_result.get("deactivated_invoices", []),
+                        "pending_deactivations": nc_result.get("pending_deactivations", []),
                         "failed_deactivations": nc_result.get("failed_deactivations", []),
                         "total_references": nc_result.get("total_references", 0)
                     }
@@ -247,32 +560,38 @@ def process_single_xml_file(xml_file_path: str):
                         "status": "error", 
                         "file": xml_file_path, 
                         "type": "NC",
-                        "message": nc_result.get("message", "Falha no processamento da invoice NC")
+                        "message": nc_result.get("message", "Falha no processamento da invoice NC"),
+                        "error_kind": FILE_ERROR
                     }
         
         # Processar arquivo FR (Fatura Regular)
         elif file_type == "FR":   
             # Converter XML para JSON
             json_data = parse_xml_to_json(xml_file_path)
+            if json_data and progress:
+                progress.update(stage="db", invoices_parsed=json_data.get("total_faturas", 0), force=True)
             
             if json_data:
                 # Processar e inserir no Supabase usando inserção em lote
                 insertion_success = process_and_insert_invoice_batch(json_data)
                 
-                if insertion_success:
+                if insertion_success and delete_remote:
                     # Excluir arquivo do SFTP apenas se a inserção foi bem-sucedida
                     logger.info(f"🗑️ Excluindo arquivo do SFTP após processamento bem-sucedido: {xml_file_path}")
                 
                 
-                    sftp_deleted = delete_file_from_sftp(xml_file_path)
+                    with stage("sftp_delete"):
+                        sftp_deleted = delete_file_from_sftp(xml_file_path, remote_path=remote_path)
                     
                     if sftp_deleted:
                          logger.info(f"✅ Arquivo excluído do SFTP com sucesso: {os.path.basename(xml_file_path)}")
                     else:
                          logger.warning(f"⚠️ Falha ao excluir arquivo do SFTP: {os.path.basename(xml_file_path)}")
-                    
+
+                if insertion_success:
                     # Remover arquivos locais após processamento bem-sucedido
-                    remove_file_safely(xml_file_path, "Arquivo XML")
+                    with stage("cleanup"):
+                        remove_file_safely(xml_file_path, "Arquivo XML")
                     
                     #logger.info(f"✅ Arquivo processado com sucesso: {xml_file_path}")
                     return {
@@ -293,32 +612,177 @@ def process_single_xml_file(xml_file_path: str):
                     }
             else:
                 #logger.error(f"❌ Falha ao processar: {xml_file_path}")
-                return {"status": "error", "file": xml_file_path, "type": "FR", "message": "Falha na conversão XML"}
+                return {"status": "error", "file": xml_file_path, "type": "FR", "message": "Falha na conversão XML", "error_kind": FILE_ERROR}
         else:
-             return {"status": "error", "file": xml_file_path, "type": "UNKNOWN", "message": "Tipo desconhecido"}  
+             return {"status": "error", "file": xml_file_path, "type": "UNKNOWN", "message": "Tipo desconhecido", "error_kind": FILE_ERROR}  
     except Exception as e:
         #logger.error(f"Erro ao processar {xml_file_path}: {str(e)}")
         return {"status": "error", "file": xml_file_path, "message": str(e)}
 
 @celery_app.task
-def download_and_queue_sftp_files():
-    """Tarefa Celery para baixar arquivos SFTP e criar tarefas individuais
-    IMPORTANTE: Processa FRs primeiro, depois NCs para evitar inconsistências"""
-    logger.info("🔄 Iniciando download de arquivos SFTP...")
+def collect_ingest_results(results, remaining: int = 0, dispatched_at: float = None, lock_token: str = None):
+    """Callback do chord: consolida os resultados de todos os ficheiros do ciclo.
+    Em modo de escoamento volta a agendar o scan enquanto houver ficheiros no SFTP"""
+    # Micro-lotes devolvem uma lista de resultados (um por ficheiro)
+    results = [item for result in results for item in (result if isinstance(result, list) else [result]) if item]
+    summary = {"success": 0, "warning": 0, "error": 0}
+    for result in results:
+        status = result.get("status", "error")
+        summary[status] = summary.get(status, 0) + 1
+
+    logger.info(f"✅ Ciclo de ingestão concluído: {len(results)} arquivos "
+                f"({summary['success']} ok, {summary['warning']} avisos, {summary['error']} erros)")
+
+    drain = None
+    if DRAIN_MODE:
+        try:
+            cycle_seconds = time.time() - dispatched_at if dispatched_at else None
+            drain = DrainController().record_cycle(results, cycle_seconds)
+        except Exception as e:
+            # Sem Redis/controlador o beat continua a garantir os ciclos
+            logger.error(f"Erro no controlador de escoamento: {str(e)}")
+    follow_up = DRAIN_MODE and remaining > 0 and drain is not None
+
+    # O lock sai antes de agendar o scan seguinte: com countdown 0 um worker livre pode
+    # começar logo e não deve encontrar o lock deste ciclo (seria ignorado como sobreposto)
+    if lock_token:
+        finish_scan_cycle(lock_token, follow_up_scheduled=follow_up)
+
+    if follow_up:
+        try:
+            # Os ficheiros deste ciclo já saíram do SFTP: o próximo scan só vê o backlog
+            download_and_queue_sftp_files.apply_async(countdown=drain["delay"])
+            logger.info(f"🔁 {remaining} arquivos por escoar, novo scan em {drain['delay']:.0f}s")
+        except Exception as e:
+            logger.error(f"Erro ao agendar o scan seguinte: {str(e)}")
+
+    return {
+        "status": "success",
+        "processed_files": len(results),
+        "summary": summary,
+        "remaining": remaining,
+        "drain": drain,
+        "results": results
+    }
+
+
+def build_ingest_header(fr_files: list, nc_files: list, spool_keys: dict, scan_token: str = None) -> list:
+    """Assinaturas do chord: FRs pequenas agrupadas por NIF em micro-lotes, o resto ficheiro a ficheiro"""
+    header = []
+    small_by_nif = {}
+    for xml_file in fr_files:
+        if MICRO_BATCH_SIZE > 1 and os.path.getsize(xml_file) <= MICRO_BATCH_MAX_BYTES:
+            small_by_nif.setdefault(nif_from_local_filename(os.path.basename(xml_file)), []).append(xml_file)
+        else:
+            header.append(process_single_xml_file.s(xml_file, spool_key=spool_keys.get(xml_file), scan_token=scan_token))
+
+    for nif_files in small_by_nif.values():
+        for start in range(0, len(nif_files), MICRO_BATCH_SIZE):
+            chunk = nif_files[start:start + MICRO_BATCH_SIZE]
+            if len(chunk) == 1:
+                header.append(process_single_xml_file.s(chunk[0], spool_key=spool_keys.get(chunk[0]), scan_token=scan_token))
+            else:
+                header.append(process_xml_micro_batch.s([{"path": xml_file, "spool_key": spool_keys.get(xml_file)} for xml_file in chunk],
+                                                        scan_token=scan_token))
+
+    # NCs ficam sempre individuais (extração de referências e ledger de desativações)
+    header.extend(process_single_xml_file.s(xml_file, spool_key=spool_keys.get(xml_file), scan_token=scan_token)
+                  for xml_file in nc_files)
+    return header
+
+
+def renew_scan_lease(scan_token: str):
+    """Cada ficheiro ingerido estende o lease do ciclo por SCAN_CYCLE_LEASE: o lock fica
+    com o ciclo enquanto o chord avança, e expira sozinho se as tarefas deixarem de correr"""
+    if not scan_token:
+        return
+    try:
+        LeaseLock(get_redis(), SCAN_LOCK_KEY, SCAN_CYCLE_LEASE, token=scan_token).renew()
+    except Exception as e:
+        logger.warning(f"⚠️ Falha ao renovar o lease do scan: {str(e)}")
+
+
+@celery_app.task
+def abort_scan_cycle(request, exc, traceback, lock_token: str = None):
+    """Errback do chord: uma tarefa do cabeçalho falhou e o callback não vai correr,
+    por isso o lock do scan é libertado já em vez de esperar que o lease expire"""
+    logger.error(f"❌ Chord de ingestão falhou ({exc}), lock do scan libertado")
+    if lock_token:
+        finish_scan_cycle(lock_token)
 
-    download_and_queue_opengcs_files_sync()
+
+def finish_scan_cycle(lock_token: str, follow_up_scheduled: bool = False):
+    """Liberta o lock do scan e, se houve disparos sobrepostos, agenda uma única execução seguinte"""
+    redis_client = get_redis()
+    LeaseLock(redis_client, SCAN_LOCK_KEY, SCAN_LOCK_TTL, token=lock_token).release()
+    # Os ficheiros deste ciclo já saíram do SFTP: listagens partilhadas anteriores estão desatualizadas
+    try:
+        invalidate_work_items(SFTP_ROOT, "invoices", redis_client)
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao invalidar itens do scan partilhado: {str(e)}")
+    # delete devolve 1 só para quem consome o pedido: vários disparos dão um único scan
+    if redis_client.delete(SCAN_RERUN_KEY) and not follow_up_scheduled:
+        download_and_queue_sftp_files.delay()
+        logger.info("🔁 Scan pedido durante o ciclo anterior, nova execução agendada")
+
+
+@celery_app.task(bind=True)
+def download_and_queue_sftp_files(self):
+    """Tarefa Celery para baixar arquivos SFTP e criar tarefas individuais.
+    FRs e NCs são processadas em paralelo e em qualquer ordem (ver pending_deactivations)"""
+    try:
+        redis_client = get_redis()
+        lock = LeaseLock(redis_client, SCAN_LOCK_KEY, SCAN_LOCK_TTL)
+        if not lock.acquire():
+            redis_client.set(SCAN_RERUN_KEY, 1, ex=SCAN_CYCLE_LEASE)
+            logger.info("⏭️ Scan SFTP já em curso, execução agrupada no próximo ciclo")
+            return {"status": "skipped", "message": "Scan já em curso; nova execução após o ciclo atual", "queued_tasks": 0}
+    except Exception as e:
+        logger.error(f"Erro ao obter lock do scan SFTP: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+    lock.start_heartbeat()
+    handed_over = False
+    try:
+        result = _download_and_queue_sftp_files(lock, TaskProgress(self, stage="download", status="A baixar arquivos SFTP"))
+        handed_over = bool(result.get("chord_id"))
+        return result
+    finally:
+        lock.stop_heartbeat()
+        if not handed_over:
+            try:
+                finish_scan_cycle(lock.token)
+            except Exception as e:
+                logger.error(f"Erro ao libertar lock do scan SFTP: {str(e)}")
+
+
+def _download_and_queue_sftp_files(lock: LeaseLock, progress: TaskProgress):
+    logger.info("🔄 Iniciando download de arquivos SFTP...")
 
     try:
         # Baixar arquivos do SFTP
-        downloaded_files = download_files_from_sftp()
+        downloaded_files = download_files_from_sftp(
+            on_progress=lambda pastas, total, arquivos: progress.update(current=pastas, total=total, files_scanned=arquivos)
+        )
+        progress.update(stage="dispatch", status=f"{len(downloaded_files)} arquivos baixados", force=True)
         
         if not downloaded_files:
             logger.info("Nenhum arquivo XML encontrado no SFTP")
             return {"status": "success", "message": "Nenhum arquivo para processar", "queued_tasks": 0}
+
+        # Ficheiros que falharam recentemente esperam pelo backoff e não ocupam lugar no lote
+        mappings = load_file_mappings(downloaded_files)
+        content_hashes = {xml_file: file_content_key(xml_file) for xml_file in downloaded_files}
+        ledger_keys = {xml_file: (mappings.get(xml_file, {}).get("remote_path"), content_hashes[xml_file]) for xml_file in downloaded_files}
+        deferred = deferred_files(get_redis(), list(ledger_keys.values()))
+        if deferred:
+            downloaded_files = [xml_file for xml_file in downloaded_files if ledger_keys[xml_file] not in deferred]
+            logger.info(f"⏳ {len(deferred)} arquivos com falhas recentes aguardam nova tentativa")
+            if not downloaded_files:
+                return {"status": "success", "message": "Apenas arquivos em espera de nova tentativa", "queued_tasks": 0,
+                        "deferred_files": len(deferred)}
         
- 
-        
-        # Separar arquivos por tipo (FR primeiro, depois NC)
+        # Separar arquivos por tipo (limites aplicados separadamente)
         fr_files = []
         nc_files = []
         
@@ -336,71 +800,62 @@ def download_and_queue_sftp_files():
         
         logger.info(f"📊 Arquivos separados: {len(fr_files)} FRs, {len(nc_files)} NCs")
         
-        # Limitar número de arquivos processados por vez (aplicar limite separadamente)
-        fr_to_process = fr_files[:MAX_FILES_PER_BATCH]
-        nc_to_process = nc_files[:MAX_FILES_PER_BATCH]
+        # Limitar número de arquivos processados por vez (aplicar limite separadamente).
+        # Em modo de escoamento o limite vem do tempo medido por ficheiro e da fila.
+        batch_size = MAX_FILES_PER_BATCH
+        if DRAIN_MODE:
+            try:
+                plan = DrainController().plan(len(downloaded_files))
+                batch_size = plan["batch_size"]
+                logger.info(f"📐 Lote dinâmico: {batch_size} (fila: {plan['queue_depth']}, backoff: {plan['backoff_level']})")
+            except Exception as e:
+                logger.warning(f"⚠️ Controlador de escoamento indisponível, a usar limite fixo: {str(e)}")
+        fr_to_process = fr_files[:batch_size]
+        nc_to_process = nc_files[:batch_size]
         
         remaining_fr = len(fr_files) - len(fr_to_process)
         remaining_nc = len(nc_files) - len(nc_to_process)
-        
-        queued_tasks = []
 
-        
-        # PROCESSAR PRIMEIRO TODAS AS FRs (Faturas Regulares) - SEQUENCIALMENTE
-        # Isso garante que todas as FRs sejam processadas antes das NCs
-        logger.info(f"📄 Processando {len(fr_to_process)} arquivos FR primeiro (sequencialmente)...")
-        fr_results = []
-        for i, xml_file in enumerate(fr_to_process, 1):
-            logger.info(f"🔄 Processando FR {i}/{len(fr_to_process)}: {os.path.basename(xml_file)}")
-            try:
-                # Processar de forma síncrona para garantir ordem
-                result = process_single_xml_file(xml_file)
-                fr_results.append({
-                    "file": xml_file,
-                    "status": result.get("status", "unknown"),
-                    "type": "FR"
-                })
-                logger.info(f"✅ FR {i}/{len(fr_to_process)} concluída: {result.get('status', 'unknown')}")
-            except Exception as e:
-                logger.error(f"❌ Erro ao processar FR {i}/{len(fr_to_process)}: {str(e)}")
-                fr_results.append({
-                    "file": xml_file,
-                    "status": "error",
-                    "error": str(e),
-                    "type": "FR"
-                })
-        
-        logger.info(f"✅ Todas as {len(fr_to_process)} tarefas FR foram concluídas")
-        
-        # AGORA PROCESSAR AS NCs (Notas de Crédito) - PODE SER PARALELO
-        logger.info(f"📝 Processando {len(nc_to_process)} arquivos NC após conclusão das FRs...")
-        nc_tasks = []
-        for xml_file in nc_to_process:
-            # Criar tarefa individual no Celery (pode processar em paralelo)
-            task = process_single_xml_file.delay(xml_file)
-            nc_tasks.append(task)
-            queued_tasks.append({
-                "file": xml_file,
-                "task_id": task.id,
-                "type": "NC"
-            })
-            logger.info(f"📋 Tarefa NC criada para: {os.path.basename(xml_file)} (ID: {task.id})")
-        
-        # Adicionar resultados das FRs processadas
-        queued_tasks.extend(fr_results)
-        
-        logger.info(f"✅ {len(queued_tasks)} tarefas criadas para processamento ({len(fr_to_process)} FRs + {len(nc_to_process)} NCs)")
+        # Sem barreira FR -> NC: referências de NCs a FRs ainda não gravadas ficam no
+        # ledger pending_deactivations. Todos os ficheiros correm em paralelo e o chord
+        # recolhe os resultados.
+        files_to_process = fr_to_process + nc_to_process
+        nifs = {nif_from_local_filename(os.path.basename(xml_file)) for xml_file in files_to_process}
+        # Guardar no spool (chave = hash do conteúdo) com o caminho remoto para a exclusão
+        spool = get_spool()
+        spool_keys = {}
+        for xml_file in files_to_process:
+            mapping = mappings.get(xml_file, {})
+            spool_keys[xml_file] = spool.put_file(xml_file, {"remote_path": mapping.get("remote_path"),
+                                                             "nif_folder": mapping.get("nif_folder"),
+                                                             "download_seconds": mapping.get("download_seconds")})
+
+        # O download pode ter demorado mais do que o lease: sem lock não se despacha nada
+        lock.stop_heartbeat()
+        if lock.lost or not lock.renew(SCAN_CYCLE_LEASE):
+            logger.error("🔓 Lock do scan perdido antes do despacho, ciclo abandonado")
+            return {"status": "error", "message": "Lock do scan perdido", "queued_tasks": 0}
+
+        callback = collect_ingest_results.s(remaining=remaining_fr + remaining_nc, dispatched_at=time.time(),
+                                            lock_token=lock.token)
+        callback.on_error(abort_scan_cycle.s(lock_token=lock.token))
+        header = build_ingest_header(fr_to_process, nc_to_process, spool_keys, scan_token=lock.token)
+        result = chord(header)(callback)
+        logger.info(f"📋 {len(header)} tarefas criadas para {len(files_to_process)} arquivos ({len(fr_to_process)} FRs + {len(nc_to_process)} NCs, {len(nifs)} NIFs), chord: {result.id}")
         
         return {
             "status": "success", 
-            "message": f"{len(fr_to_process)} FRs processadas primeiro, depois {len(nc_to_process)} NCs (limite: {MAX_FILES_PER_BATCH})",
-            "queued_tasks": len(queued_tasks),
+            "message": f"{len(fr_to_process)} FRs e {len(nc_to_process)} NCs enviadas em paralelo (limite: {batch_size})",
+            "queued_tasks": len(files_to_process),
+            "batch_size": batch_size,
+            "chord_id": result.id,
+            "nifs": len(nifs),
             "fr_files": len(fr_to_process),
             "nc_files": len(nc_to_process),
             "remaining_fr": remaining_fr,
             "remaining_nc": remaining_nc,
             "total_files": len(downloaded_files),
-            "tasks": queued_tasks
+            "deferred_files": len(deferred)
         }
         
     except Exception as e:
@@ -408,6 +863,31 @@ def download_and_queue_sftp_files():
         return {"status": "error", "message": str(e)}
 
 
+@celery_app.task
+def reconcile_pending_deactivations_task():
+    """Reaplica desativações do ledger que ficaram pendentes por falhas transitórias"""
+    try:
+        result = reconcile_pending_deactivations()
+        logger.info(f"🧾 Ledger de desativações: {len(result['applied'])} aplicadas, {len(result['pending'])} ainda pendentes")
+        return {"status": "success", "applied": len(result["applied"]), "pending": len(result["pending"])}
+    except Exception as e:
+        logger.error(f"Erro ao reconciliar desativações pendentes: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+
+@celery_app.task
+def autoscale_workers():
+    """Ajusta o pool dos workers de ingestão/upload à profundidade e espera das filas"""
+    if not AUTOSCALE_ENABLED:
+        return {"status": "skipped", "message": "Autoscaling desativado"}
+    try:
+        decisions = run_autoscaler(celery_app, get_redis())
+        return {"status": "success", "queues": decisions}
+    except Exception as e:
+        logger.error(f"Erro no autoscaler: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+
 @celery_app.task
 def cleanup_files_task():
     """Tarefa Celery para limpeza programada de arquivos"""
@@ -436,38 +916,220 @@ def download_all():
         download_and_queue_sftp_files.s()
     ).apply_async()
 
-def download_and_queue_opengcs_files_sync():
-    """Mesma lógica do download_and_queue_opengcs_files, mas rodando síncrono"""
-    logger.info("🔄 Baixando arquivos OpenGCs de forma síncrona...")
+def dispatch_live_ingest(xml_bytes: bytes, nif: str, filename: str, remote_path: str = None):
+    """Envia um ficheiro acabado de receber para a via rápida de ingestão (sem esperar pelo scan).
+    Sem remote_path o ficheiro ainda não está no SFTP (ingestão direta a partir da API)"""
+    file_type = invoice_fr_or_nc(filename)
+    if file_type not in ("FR", "NC"):
+        return None
 
-    downloaded_files = download_opengcs_files_from_sftp()
-    if not downloaded_files:
-        logger.info("Nenhum arquivo OpenGCs encontrado")
-        return
+    local_name = f"{nif}_{filename}"
+    direct = remote_path is None
+    redis_client = get_redis()
+    if direct:
+        # O spool passa a ter a única cópia: regista-a antes (DirectIngestFull se não há espaço)
+        track_direct_entry(redis_client, content_key(xml_bytes), len(xml_bytes))
+    spool_key = get_spool().put(xml_bytes, {"filename": local_name, "remote_path": remote_path, "nif_folder": nif,
+                                            "received_filename": filename, "live": True, "direct": direct})
+    task, queue = _send_live_ingest(redis_client, local_name, spool_key, file_type)
+    logger.info(f"⚡ {filename} enviado para ingestão imediata na fila {queue} (tarefa {task.id})")
+    return {"task_id": task.id, "queue": queue, "spool_key": spool_key}
 
-    files_to_process = downloaded_files[:MAX_FILES_PER_BATCH]
+def _send_live_ingest(redis_client, local_name: str, spool_key: str, file_type: str):
+    backlog_queue = "ingest-nc" if file_type == "NC" else "ingest-fr"
+    queue = choose_live_queue(redis_client, backlog_queue, queue_depth(redis_client, (backlog_queue,)))
+    task = process_single_xml_file.apply_async(args=[os.path.join("./downloads", local_name)],
+                                               kwargs={"spool_key": spool_key}, queue=queue)
+    return task, queue
 
-    for xml_file in files_to_process:
-        # Chama process_single_opengcs_file de forma síncrona
-        process_single_opengcs_file(xml_file)
-    
-    logger.info(f"✅ {len(files_to_process)} arquivos OpenGCs processados")
+def reconcile_direct_ingest() -> dict:
+    """Entradas diretas sem ack há mais de DIRECT_INGEST_RECONCILE_AFTER (mensagem perdida,
+    tarefa revogada ou expirada): volta a despachá-las para a ingestão e, esgotados os
+    re-despachos, envia o ficheiro para a pasta do NIF no SFTP, onde o scan normal o ingere"""
+    redis_client = get_redis()
+    spool = get_spool()
+    summary = {"redispatched": 0, "handed_off": 0, "missing": 0, "busy": 0}
+    for spool_key in stale_direct_entries(redis_client):
+        if not spool.exists(spool_key):
+            untrack_direct_entry(redis_client, spool_key)
+            summary["missing"] += 1
+            continue
+        claim_token = spool.claim(spool_key)
+        if claim_token is None:
+            # Lease ativo: a ingestão está a correr agora
+            summary["busy"] += 1
+            continue
+        try:
+            meta = spool.meta(spool_key)
+            local_name = meta.get("filename") or spool_key
+            attempts = redispatch_direct_entry(redis_client, spool_key)
+            if attempts <= DIRECT_INGEST_MAX_REDISPATCH:
+                spool.release(spool_key, claim_token)
+                claim_token = None
+                task, queue = _send_live_ingest(redis_client, local_name, spool_key, invoice_fr_or_nc(local_name))
+                logger.warning(f"♻️ {local_name} sem resposta da ingestão direta, re-despachado para {queue} "
+                               f"({attempts}/{DIRECT_INGEST_MAX_REDISPATCH}, tarefa {task.id})")
+                summary["redispatched"] += 1
+            else:
+                logger.warning(f"♻️ {local_name} sem resposta após {DIRECT_INGEST_MAX_REDISPATCH} re-despachos, segue para o SFTP")
+                hand_off_direct_ingest(spool, spool_key, meta, {"status": "error", "message": "Ingestão direta sem resposta"})
+                summary["handed_off"] += 1
+        except Exception as e:
+            logger.error(f"❌ Erro ao reconciliar a entrada direta {spool_key[:12]}: {str(e)}")
+        finally:
+            if claim_token:
+                spool.release(spool_key, claim_token)
+    if any(summary.values()):
+        logger.info(f"♻️ Reconciliação da ingestão direta: {summary}")
+    return summary
 
+@celery_app.task
+def gc_blob_spool():
+    """Remove do spool de blobs os payloads expirados, reporta o espaço ocupado,
+    apaga as entradas abandonadas do spool de ficheiros, reconcilia as entradas diretas
+    que ficaram sem ack e devolve ao lote os uploads de flushes que morreram a meio"""
+    result = get_blob_spool().gc()
+    try:
+        result["spool"] = get_spool().gc()
+    except Exception as e:
+        logger.error(f"❌ Erro no GC do spool: {str(e)}")
+    try:
+        result["direct_ingest"] = reconcile_direct_ingest()
+    except Exception as e:
+        logger.error(f"❌ Erro na reconciliação da ingestão direta: {str(e)}")
+    try:
+        # Lotes de upload de NIFs sem novos uploads não teriam outro flush que os recuperasse
+        redis_client = get_redis()
+        result["upload_batches"] = reclaim_stale_batches(redis_client)
+        for nif in result["upload_batches"]:
+            if claim_flush(redis_client, nif):
+                flush_upload_batch.apply_async(args=[nif])
+    except Exception as e:
+        logger.error(f"❌ Erro ao recuperar lotes de upload em curso: {str(e)}")
+    return result
 
 @celery_app.task(bind=True, max_retries=3)
-def async_upload_xml_to_sftp(self, xml_string: str, nif: str, filename: str):
+def async_upload_xml_to_sftp(self, xml_string: str = None, nif: str = None, filename: str = None,
+                             ingest_now: bool = False, blob_key: str = None, archive: bool = False):
     """
     Task Celery que empurra o processo lento do SFTP para um processo em background.
+    Com blob_key o XML é lido do spool de blobs em vez de viajar na mensagem.
+    Com ingest_now (ficheiros em tempo real) a ingestão segue logo pela via rápida.
+    Com archive o ficheiro já foi ingerido e vai para SFTP_ARCHIVE_DIR, fora do scan.
     """
-    try:
+    if blob_key:
+        try:
+            xml_bytes = get_blob_spool().get(blob_key)
+        except FileNotFoundError:
+            logger.error(f"❌ Blob {blob_key[:12]} de {filename} não existe (expirado?), upload abandonado")
+            return {"status": "error", "filename": filename, "message": "Blob não encontrado no spool"}
+    else:
         # Reconverter a string que viajou pelo broker (ex: Redis) em bytes para a sua função aceitar
         xml_bytes = xml_string.encode('utf-8')
-        
+
+    try:
         # Chama a sua função original que já funciona bem!
-        result = upload_xml_to_sftp(xml_content=xml_bytes, nif=nif, filename=filename)
-        return result
-        
+        if archive:
+            result = upload_xml_to_sftp(xml_content=xml_bytes, nif=nif, filename=filename, root=SFTP_ARCHIVE_DIR)
+        else:
+            result = upload_xml_to_sftp(xml_content=xml_bytes, nif=nif, filename=filename)
     except Exception as exc:
         # Se o SFTP der um pico de erro de ligação, tentamos outra vez (máximo 3 vezes)
         logger.error(f"Erro no upload SFTP: {exc}. A tentar de novo em 10s...")
         raise self.retry(exc=exc, countdown=10)
+
+    _after_sftp_upload(xml_bytes, nif, result, ingest_now, archive, blob_key)
+    return result
+
+def _after_sftp_upload(xml_bytes: bytes, nif: str, result: dict, ingest_now: bool, archive: bool, blob_key: str = None):
+    """Via rápida (se pedida) e remoção do blob depois de um upload bem-sucedido"""
+    if ingest_now and LIVE_INGEST_ENABLED and not archive:
+        try:
+            result["live_ingest"] = dispatch_live_ingest(xml_bytes, nif, result["filename"], result["remote_path"])
+        except Exception as e:
+            # O ficheiro já está no SFTP: o scan normal acaba por o ingerir
+            logger.error(f"Erro ao enviar {result['filename']} para a via rápida: {str(e)}")
+    if blob_key:
+        # Só depois do upload: uma nova tentativa ainda precisa do blob
+        get_blob_spool().delete(blob_key)
+
+def queue_sftp_upload(blob_key: str, nif: str, filename: str = None, ingest_now: bool = False, archive: bool = False) -> dict:
+    """Agenda o upload de um blob: no lote do NIF (UPLOAD_BATCH_ENABLED) ou numa tarefa própria"""
+    if not UPLOAD_BATCH_ENABLED:
+        task = async_upload_xml_to_sftp.delay(blob_key=blob_key, nif=nif, filename=filename,
+                                              ingest_now=ingest_now, archive=archive)
+        return {"task_id": task.id}
+    upload_id, schedule = enqueue_upload(get_redis(), nif, blob_key, filename, ingest_now, archive)
+    if schedule:
+        flush_upload_batch.apply_async(args=[nif], countdown=UPLOAD_BATCH_WINDOW)
+    return {"upload_id": upload_id}
+
+@celery_app.task
+def flush_upload_batch(nif: str):
+    """Envia os uploads pendentes de um NIF numa única sessão SFTP, com confirmação por upload"""
+    redis_client = get_redis()
+    release_flush(redis_client, nif)
+    # Lotes de flushes que morreram a meio (crash ou restart do worker) voltam primeiro ao lote
+    reclaim_stale_batches(redis_client, nif)
+    flush_id, entries, remaining = take_batch(redis_client, nif)
+    if not entries:
+        # Outro flush ainda tem uploads em curso: se morrer, este NIF volta a ser verificado
+        if has_inflight(redis_client, nif) and claim_flush(redis_client, nif):
+            flush_upload_batch.apply_async(args=[nif], countdown=UPLOAD_INFLIGHT_TIMEOUT)
+        return {"status": "empty", "nif": nif}
+
+    blob_spool = get_blob_spool()
+    pending = list(entries)
+    retry = []
+    uploaded = 0
+    try:
+        with SFTPXMLUploader() as uploader:
+            while pending:
+                entry = pending[0]
+                try:
+                    xml_bytes = blob_spool.get(entry["blob_key"])
+                except FileNotFoundError:
+                    pending.pop(0)
+                    acknowledge(redis_client, entry["upload_id"], "error", message="Blob não encontrado no spool")
+                    complete_upload(redis_client, nif, flush_id, entry)
+                    continue
+                root = SFTP_ARCHIVE_DIR if entry.get("archive") else SFTP_ROOT
+                try:
+                    result = uploader.upload_xml(xml_bytes, nif, entry.get("filename"), root)
+                except Exception as e:
+                    pending.pop(0)
+                    retry.append({**entry, "last_error": str(e)})
+                    continue
+                pending.pop(0)
+                uploaded += 1
+                _after_sftp_upload(xml_bytes, nif, result, entry.get("ingest_now"), entry.get("archive"), entry["blob_key"])
+                acknowledge(redis_client, entry["upload_id"], "uploaded", remote_path=result["remote_path"],
+                            live_task_id=(result.get("live_ingest") or {}).get("task_id"))
+                # Só sai da lista em curso depois do upload e da confirmação
+                complete_upload(redis_client, nif, flush_id, entry)
+                heartbeat(redis_client, nif, flush_id)
+    except Exception as e:
+        # Sessão perdida: o que não foi enviado volta ao lote
+        logger.error(f"Erro na sessão SFTP do lote {nif}: {str(e)}")
+        retry.extend({**entry, "last_error": str(e)} for entry in pending)
+
+    requeued = []
+    for entry in retry:
+        entry["attempts"] = entry.get("attempts", 0) + 1
+        if entry["attempts"] >= UPLOAD_MAX_ATTEMPTS:
+            # Blob fica no spool até ao GC para recuperação manual
+            acknowledge(redis_client, entry["upload_id"], "error", attempts=entry["attempts"], message=entry["last_error"])
+            complete_upload(redis_client, nif, flush_id, entry)
+        else:
+            acknowledge(redis_client, entry["upload_id"], "retrying", attempts=entry["attempts"], message=entry["last_error"])
+            requeued.append(entry)
+    requeue_uploads(redis_client, nif, flush_id, requeued)
+    finish_batch(redis_client, nif, flush_id)
+
+    if (requeued or remaining) and claim_flush(redis_client, nif):
+        flush_upload_batch.apply_async(args=[nif], countdown=UPLOAD_RETRY_DELAY if requeued else 0)
+
+    logger.info(f"📤 Lote {nif}: {uploaded}/{len(entries)} enviados numa sessão SFTP"
+                + (f", {len(requeued)} a repetir" if requeued else ""))
+    return {"status": "success", "nif": nif, "uploaded": uploaded, "batch": len(entries),
+            "requeued": len(requeued), "failed": len(retry) - len(requeued), "remaining": remaining}
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Testes das decisões do autoscaler (sem Redis nem workers)
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.autoscaler import (decide, current_wait, record_queue_wait, AUTOSCALE_DOWN_AFTER,
+                                 AUTOSCALE_TARGET_WAIT, AUTOSCALE_UP_BACKLOG_PER_PROCESS, AUTOSCALE_WAIT_STALE)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+
+    def hmget(self, key, *fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update({field: str(value) for field, value in mapping.items()})
+
+
+def test_decide_grows_with_backlog():
+    depth = int(AUTOSCALE_UP_BACKLOG_PER_PROCESS * 2) + 1
+    size, idle_rounds = decide(2, depth, 0, 3, 1, 8)
+    assert size > 2
+    assert idle_rounds == 0
+
+
+def test_decide_grows_at_most_double_and_within_max():
+    assert decide(2, 10_000, 0, 0, 1, 8)[0] == 4
+    assert decide(6, 10_000, 0, 0, 1, 8)[0] == 8
+
+
+def test_decide_grows_on_wait_with_messages_queued():
+    size, _ = decide(2, 1, AUTOSCALE_TARGET_WAIT + 1, 0, 1, 8)
+    assert size == 3
+
+
+def test_decide_holds_with_moderate_load():
+    assert decide(3, 1, 0, 4, 1, 8) == (3, 0)
+
+
+def test_decide_shrinks_only_after_idle_rounds():
+    size, idle_rounds = 4, 0
+    for _ in range(AUTOSCALE_DOWN_AFTER - 1):
+        size, idle_rounds = decide(size, 0, 0, idle_rounds, 1, 8)
+        assert size == 4
+    assert decide(size, 0, 0, idle_rounds, 1, 8) == (3, 0)
+
+
+def test_decide_ignores_old_wait_when_queue_is_empty():
+    # Último pico de espera ainda guardado mas sem mensagens: conta como folga
+    size, idle_rounds = decide(8, 0, AUTOSCALE_TARGET_WAIT * 10, AUTOSCALE_DOWN_AFTER - 1, 1, 8)
+    assert (size, idle_rounds) == (7, 0)
+
+
+def test_decide_respects_min():
+    assert decide(1, 0, 0, AUTOSCALE_DOWN_AFTER, 1, 8)[0] == 1
+
+
+def test_current_wait_discards_stale_samples():
+    assert current_wait(["12.5", "1000"], 1000 + AUTOSCALE_WAIT_STALE - 1) == 12.5
+    assert current_wait(["12.5", "1000"], 1000 + AUTOSCALE_WAIT_STALE + 1) is None
+    assert current_wait([None, None], 1000) is None
+
+
+def test_record_queue_wait_restarts_after_stale_sample():
+    redis_client = FakeRedis()
+    record_queue_wait(redis_client, "ingest-fr", 600, now=1000)
+    record_queue_wait(redis_client, "ingest-fr", 1, now=1000 + AUTOSCALE_WAIT_STALE + 1)
+    assert float(redis_client.hashes["autoscale:wait"]["ingest-fr"]) == 1
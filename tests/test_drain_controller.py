@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Testes do controlador de escoamento (tamanho do lote, backoff e médias, sem Redis)
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.drain_controller import (DrainController, compute_batch_size, backoff_delay, ewma, queue_depth,
+                                       DRAIN_BACKOFF_BASE, DRAIN_MAX_BACKOFF, DRAIN_MAX_BACKOFF_LEVEL,
+                                       EWMA_ALPHA, PRIORITY_SEPARATOR, STATE_KEY)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+        self.lists = {}
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        target = self.hashes.setdefault(key, {})
+        if field is not None:
+            target[field] = str(value)
+        target.update({name: str(item) for name, item in (mapping or {}).items()})
+
+    def llen(self, key):
+        return self.lists.get(key, 0)
+
+
+def batch(file_seconds, depth=0, backoff_level=0):
+    return compute_batch_size(file_seconds, depth, backoff_level, concurrency=4, target_seconds=60,
+                              min_batch=5, max_batch=500, initial_batch=50)
+
+
+def test_batch_size_uses_initial_without_measurements():
+    assert batch(None) == 50
+    assert batch(0) == 50
+
+
+def test_batch_size_fills_the_target_cycle():
+    assert batch(1.0) == 240
+    assert batch(0.1) == 500  # limitado por max_batch
+    assert batch(100.0) == 5  # limitado por min_batch
+
+
+def test_batch_size_discounts_queued_messages():
+    assert batch(1.0, depth=40) == 200
+    assert batch(1.0, depth=10_000) == 5
+
+
+def test_batch_size_halves_per_backoff_level():
+    assert batch(1.0, backoff_level=1) == 120
+    assert batch(1.0, backoff_level=2) == 60
+
+
+def test_backoff_delay_grows_and_is_capped():
+    assert backoff_delay(0) == 0.0
+    assert backoff_delay(1) == DRAIN_BACKOFF_BASE
+    assert backoff_delay(2) == DRAIN_BACKOFF_BASE * 2
+    assert backoff_delay(100) == DRAIN_MAX_BACKOFF
+
+
+def test_ewma():
+    assert ewma(None, 4.0) == 4.0
+    assert ewma(2.0, 4.0) == EWMA_ALPHA * 4.0 + (1 - EWMA_ALPHA) * 2.0
+
+
+def test_queue_depth_counts_priority_subqueues():
+    redis_client = FakeRedis()
+    redis_client.lists = {"ingest-fr": 3, f"ingest-fr{PRIORITY_SEPARATOR}3": 2, "ingest-nc": 1}
+    assert queue_depth(redis_client) == 6
+
+
+def test_record_cycle_backs_off_on_errors_and_recovers():
+    redis_client = FakeRedis()
+    controller = DrainController(redis_client)
+    failing = [{"status": "error", "duration_seconds": 1.0}] * 5
+    cycle = controller.record_cycle(failing)
+    assert cycle["backoff_level"] == 1
+    assert cycle["delay"] == backoff_delay(1)
+    assert float(redis_client.hashes[STATE_KEY]["file_seconds"]) == 1.0
+
+    healthy = [{"status": "success", "duration_seconds": 1.0, "db": {"round_trips": 10, "seconds": 0.1}}] * 5
+    assert controller.record_cycle(healthy)["backoff_level"] == 0
+
+
+def test_record_cycle_backoff_is_capped():
+    controller = DrainController(FakeRedis())
+    for _ in range(DRAIN_MAX_BACKOFF_LEVEL + 3):
+        cycle = controller.record_cycle([{"status": "error"}])
+    assert cycle["backoff_level"] == DRAIN_MAX_BACKOFF_LEVEL
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Testes do store de mapeamentos ficheiro local -> remoto (sem Redis)
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.file_mappings import FileMappingStore
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+        self.zsets = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def hdel(self, key, *fields):
+        return sum(1 for field in fields if self.hashes.get(key, {}).pop(field, None) is not None)
+
+    def persist(self, key):
+        return True
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, *members):
+        return sum(1 for member in members if self.zsets.get(key, {}).pop(member, None) is not None)
+
+    def zrangebyscore(self, key, low, high):
+        return [member for member, score in self.zsets.get(key, {}).items() if low <= score <= high]
+
+
+def mapping(name):
+    return {"local_path": f"./downloads/{name}", "remote_path": f"/r/123/{name}", "filename": name, "nif_folder": "123"}
+
+
+def test_put_get_and_delete():
+    store = FileMappingStore(FakeRedis())
+    store.put_many([mapping("FR_1.xml"), mapping("FR_2.xml")])
+    assert store.get("./downloads/FR_1.xml")["remote_path"] == "/r/123/FR_1.xml"
+    assert set(store.get_many(["./downloads/FR_1.xml", "./downloads/FR_2.xml", "./downloads/x"])) == {
+        "./downloads/FR_1.xml", "./downloads/FR_2.xml"}
+    assert store.delete("./downloads/FR_1.xml") == 1
+    assert store.get("./downloads/FR_1.xml") is None
+
+
+def test_old_mappings_expire_while_downloads_continue():
+    store = FileMappingStore(FakeRedis(), ttl=100)
+    store.put_many([mapping("FR_old.xml")], now=0)
+    store.put_many([mapping("FR_new.xml")], now=50)
+    assert store.get("./downloads/FR_old.xml")
+    # Downloads contínuos não renovam mapeamentos de outros ficheiros
+    store.put_many([mapping("FR_next.xml")], now=120)
+    assert store.get("./downloads/FR_old.xml") is None
+    assert store.get("./downloads/FR_new.xml")
+
+
+def test_redownload_renews_the_mapping():
+    store = FileMappingStore(FakeRedis(), ttl=100)
+    store.put_many([mapping("FR_1.xml")], now=0)
+    store.put_many([mapping("FR_1.xml")], now=90)
+    store.put_many([mapping("FR_2.xml")], now=150)
+    assert store.get("./downloads/FR_1.xml")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Testes da via rápida e do registo de entradas diretas (sem Redis)
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.priority_lane import (choose_live_queue, track_direct_entry, untrack_direct_entry, stale_direct_entries,
+                                    redispatch_direct_entry, DirectIngestFull, QUEUE_INGEST_LIVE, LIVE_MAX_PER_WINDOW,
+                                    DIRECT_INGEST_MAX_BYTES, DIRECT_INGEST_RECONCILE_AFTER, DIRECT_BYTES_KEY)
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+        self.zsets = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def incr(self, key):
+        return self.incrby(key, 1)
+
+    def incrby(self, key, amount):
+        self.values[key] = int(self.values.get(key, 0)) + amount
+        return self.values[key]
+
+    def decrby(self, key, amount):
+        return self.incrby(key, -amount)
+
+    def expire(self, key, seconds):
+        return True
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hsetnx(self, key, field, value):
+        target = self.hashes.setdefault(key, {})
+        if field in target:
+            return 0
+        target[field] = str(value)
+        return 1
+
+    def hincrby(self, key, field, amount):
+        target = self.hashes.setdefault(key, {})
+        target[field] = str(int(target.get(field, 0)) + amount)
+        return int(target[field])
+
+    def hdel(self, key, *fields):
+        return sum(1 for field in fields if self.hashes.get(key, {}).pop(field, None) is not None)
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        return 1 if self.zsets.get(key, {}).pop(member, None) is not None else 0
+
+    def zrangebyscore(self, key, low, high, start=0, num=None):
+        members = sorted((score, member) for member, score in self.zsets.get(key, {}).items() if low <= score <= high)
+        return [member for _, member in members][start:start + num if num is not None else None]
+
+
+def test_live_queue_within_quota():
+    redis_client = FakeRedis()
+    assert choose_live_queue(redis_client, "ingest-fr", backlog_depth=100) == QUEUE_INGEST_LIVE
+
+
+def test_live_queue_falls_back_when_quota_used_and_backlog_waiting():
+    redis_client = FakeRedis()
+    for _ in range(LIVE_MAX_PER_WINDOW):
+        assert choose_live_queue(redis_client, "ingest-fr", backlog_depth=100) == QUEUE_INGEST_LIVE
+    assert choose_live_queue(redis_client, "ingest-fr", backlog_depth=100) == "ingest-fr"
+    # Sem backlog não há quem ultrapassar: continua na via rápida
+    assert choose_live_queue(redis_client, "ingest-fr", backlog_depth=0) == QUEUE_INGEST_LIVE
+
+
+def test_direct_entries_are_tracked_and_released_once():
+    redis_client = FakeRedis()
+    track_direct_entry(redis_client, "a", 100, now=0)
+    track_direct_entry(redis_client, "a", 100, now=5)  # mesmo conteúdo: não conta duas vezes
+    track_direct_entry(redis_client, "b", 50, now=0)
+    assert redis_client.values[DIRECT_BYTES_KEY] == 150
+    untrack_direct_entry(redis_client, "a")
+    untrack_direct_entry(redis_client, "a")
+    assert redis_client.values[DIRECT_BYTES_KEY] == 50
+
+
+def test_direct_entries_over_the_cap_are_refused():
+    redis_client = FakeRedis()
+    track_direct_entry(redis_client, "a", DIRECT_INGEST_MAX_BYTES, now=0)
+    with pytest.raises(DirectIngestFull):
+        track_direct_entry(redis_client, "b", 1, now=0)
+    assert redis_client.values[DIRECT_BYTES_KEY] == DIRECT_INGEST_MAX_BYTES
+    assert stale_direct_entries(redis_client, now=DIRECT_INGEST_RECONCILE_AFTER) == ["a"]
+
+
+def test_stale_direct_entries_and_redispatch():
+    redis_client = FakeRedis()
+    track_direct_entry(redis_client, "old", 10, now=0)
+    track_direct_entry(redis_client, "new", 10, now=DIRECT_INGEST_RECONCILE_AFTER)
+    assert stale_direct_entries(redis_client, now=DIRECT_INGEST_RECONCILE_AFTER) == ["old"]
+    assert redispatch_direct_entry(redis_client, "old", now=DIRECT_INGEST_RECONCILE_AFTER) == 1
+    # Re-despachada: volta a ter o prazo inteiro antes da próxima reconciliação
+    assert stale_direct_entries(redis_client, now=DIRECT_INGEST_RECONCILE_AFTER) == []
+    assert redispatch_direct_entry(redis_client, "old") == 2
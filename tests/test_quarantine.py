@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Testes do ledger de falhas e da quarentena (sem Redis nem SFTP)
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.quarantine import (retry_delay, quarantine_path, record_failure, clear_failure, deferred_files,
+                                 deferred_remote_paths, mark_quarantined, is_file_error, FILE_ERROR, QUARANTINE_BASE_DELAY, QUARANTINE_MAX_DELAY,
+                                 QUARANTINE_MAX_ATTEMPTS, SFTP_QUARANTINE_DIR)
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = value
+
+    def hdel(self, key, *fields):
+        return sum(1 for field in fields if self.hashes.get(key, {}).pop(field, None) is not None)
+
+
+def test_retry_delay_doubles_and_is_capped():
+    assert retry_delay(1) == QUARANTINE_BASE_DELAY
+    assert retry_delay(2) == QUARANTINE_BASE_DELAY * 2
+    assert retry_delay(3) == QUARANTINE_BASE_DELAY * 4
+    assert retry_delay(100) == QUARANTINE_MAX_DELAY
+
+
+def test_quarantine_path_keeps_nif_folder():
+    assert quarantine_path("/home/x/123456789/FR_1.xml") == f"{SFTP_QUARANTINE_DIR}/123456789/FR_1.xml"
+
+
+def test_only_file_errors_count():
+    assert is_file_error({"status": "error", "error_kind": FILE_ERROR})
+    assert not is_file_error({"status": "error", "message": "Falha na inserção no banco de dados"})
+    assert not is_file_error({"status": "success", "error_kind": FILE_ERROR})
+    assert not is_file_error(None)
+
+
+def test_record_failure_quarantines_after_max_attempts():
+    redis_client = FakeRedis()
+    for attempt in range(1, QUARANTINE_MAX_ATTEMPTS + 1):
+        entry = record_failure(redis_client, "/r/1/FR_1.xml", "abc", "XML inválido")
+        assert entry["attempts"] == attempt
+    assert entry["quarantine"]
+
+
+def test_failed_file_is_deferred_until_cleared():
+    redis_client = FakeRedis()
+    record_failure(redis_client, "/r/1/FR_1.xml", "abc", "XML inválido")
+    assert deferred_files(redis_client, [("/r/1/FR_1.xml", "abc"), ("/r/1/FR_2.xml", "def")]) == {("/r/1/FR_1.xml", "abc")}
+    # Outra versão do ficheiro (outro hash) não fica à espera
+    assert deferred_files(redis_client, [("/r/1/FR_1.xml", "new")]) == set()
+    clear_failure(redis_client, "/r/1/FR_1.xml", "abc")
+    assert deferred_files(redis_client, [("/r/1/FR_1.xml", "abc")]) == set()
+
+
+def test_deferred_remote_paths_are_skipped_before_download():
+    redis_client = FakeRedis()
+    entry = record_failure(redis_client, "/r/1/FR_1.xml", "abc", "XML inválido")
+    assert deferred_remote_paths(redis_client) == {"/r/1/FR_1.xml"}
+    # Espera vencida: volta a ser descarregado e sai do índice
+    assert deferred_remote_paths(redis_client, now=entry["next_retry_at"] + 1) == set()
+    assert deferred_remote_paths(redis_client) == set()
+
+
+def test_quarantined_or_cleared_files_leave_the_deferred_index():
+    redis_client = FakeRedis()
+    record_failure(redis_client, "/r/1/FR_1.xml", "abc", "XML inválido")
+    record_failure(redis_client, "/r/1/FR_2.xml", "def", "XML inválido")
+    clear_failure(redis_client, "/r/1/FR_1.xml", "abc")
+    mark_quarantined(redis_client, "/r/1/FR_2.xml", "def", quarantine_path("/r/1/FR_2.xml"))
+    assert deferred_remote_paths(redis_client) == set()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Testes do scan SFTP: snapshot incremental e travessia partilhada entre pipelines (sem ligação SFTP)
+"""
+import os
+import stat
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for module in ("paramiko", "dotenv", "prometheus_client"):
+    pytest.importorskip(module)
+
+import sftp_scanner
+from sftp_scanner import scan_folders, scan_work_items, invalidate_work_items, classify_entry, classify_scan, _pipeline_items
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = str(value)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+        self.hashes.pop(key, None)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.hashes.get(key, {}).pop(field, None)
+
+
+class Entry:
+    def __init__(self, filename, directory=False, mtime=100, size=10):
+        self.filename = filename
+        self.st_mode = stat.S_IFDIR if directory else stat.S_IFREG
+        self.st_mtime = mtime
+        self.st_size = size
+
+
+class FakeTree:
+    """Árvore remota: {pasta: (mtime, [ficheiros])}; regista as pastas listadas"""
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.listed = []
+
+    def list_attrs(self, path):
+        self.listed.append(path)
+        if path == "/r":
+            return [Entry(folder, directory=True, mtime=mtime) for folder, (mtime, _) in self.folders.items()]
+        mtime, files = self.folders[os.path.basename(path)]
+        return [Entry(name, mtime=mtime) for name in files]
+
+
+@pytest.fixture
+def tree(monkeypatch):
+    tree = FakeTree({"111": (100, ["FR_1.xml"]), "222": (100, ["NC_1.xml"]), "_quarantine": (100, ["FR_9.xml"])})
+    monkeypatch.setattr(sftp_scanner, "_list_attrs", tree.list_attrs)
+    monkeypatch.setattr(sftp_scanner, "SFTP_SCAN_INCREMENTAL", True)
+    return tree
+
+
+def test_first_scan_lists_every_folder_except_underscore(tree):
+    result = scan_folders("/r", FakeRedis(), workers=1)
+    assert set(result) == {"111", "222"}
+    assert result["111"] == {"FR_1.xml": {"size": 10, "mtime": 100}}
+    assert "/r/_quarantine" not in tree.listed
+
+
+def test_unchanged_folders_come_from_the_snapshot(tree):
+    redis_client = FakeRedis()
+    scan_folders("/r", redis_client, workers=1)
+    tree.listed.clear()
+    tree.folders["222"] = (200, ["NC_1.xml", "NC_2.xml"])
+    result = scan_folders("/r", redis_client, workers=1)
+    assert tree.listed == ["/r", "/r/222"]
+    assert set(result["222"]) == {"NC_1.xml", "NC_2.xml"}
+    assert set(result["111"]) == {"FR_1.xml"}
+
+
+def test_removed_folders_leave_the_snapshot(tree):
+    redis_client = FakeRedis()
+    scan_folders("/r", redis_client, workers=1)
+    del tree.folders["222"]
+    assert set(scan_folders("/r", redis_client, workers=1)) == {"111"}
+    assert "222" not in sftp_scanner.SnapshotStore(redis_client, "/r").folders()
+
+
+def test_classify_entry():
+    assert classify_entry("123", "FR 1Y2025_1.xml") == "FR"
+    assert classify_entry("123", "NC 1Y2025_1.xml") == "NC"
+    assert classify_entry("123", "opengcs-123-2025.xml") == "OpenGCs"
+    assert classify_entry("123", "FR 1Y2025_1.txt") is None
+    assert classify_entry("123", "opengcs-456-2025.xml") is None
+
+
+def test_classify_scan_groups_by_class_and_folder():
+    work = classify_scan({"123": ["FR_1.xml", "NC_1.xml", "opengcs-123-a.xml", "notas.txt"], "456": ["FR_2.xml"]})
+    assert work["FR"] == {"123": ["FR_1.xml"], "456": ["FR_2.xml"]}
+    assert work["NC"] == {"123": ["NC_1.xml"]}
+    assert work["OpenGCs"] == {"123": ["opengcs-123-a.xml"]}
+    assert _pipeline_items(work, "invoices") == {"123": ["FR_1.xml", "NC_1.xml"], "456": ["FR_2.xml"]}
+
+
+def test_one_walk_feeds_both_pipelines(tree, monkeypatch):
+    monkeypatch.setattr(sftp_scanner, "SFTP_SCAN_SHARED", True)
+    tree.folders["111"] = (100, ["FR_1.xml", "opengcs-111-a.xml"])
+    redis_client = FakeRedis()
+    assert scan_work_items("/r", "invoices", redis_client) == {"111": ["FR_1.xml"], "222": ["NC_1.xml"]}
+    tree.listed.clear()
+    assert scan_work_items("/r", "opengcs", redis_client) == {"111": ["opengcs-111-a.xml"]}
+    assert tree.listed == []
+
+
+def test_shared_items_are_dropped_after_invalidation(tree, monkeypatch):
+    monkeypatch.setattr(sftp_scanner, "SFTP_SCAN_SHARED", True)
+    redis_client = FakeRedis()
+    scan_work_items("/r", "opengcs", redis_client)
+    # Um ciclo de faturas terminou (e excluiu ficheiros) depois da travessia
+    invalidate_work_items("/r", "invoices", redis_client)
+    tree.listed.clear()
+    scan_work_items("/r", "invoices", redis_client)
+    assert "/r" in tree.listed
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Testes do spool local: conteúdo por hash, claims com lease e retoma de claims expirados
+"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("dotenv")
+
+from utils.spool import LocalSpool, content_key, key_content_hash
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return LocalSpool(root=str(tmp_path / "spool"), claim_ttl=60)
+
+
+def test_put_is_content_addressed(spool, tmp_path):
+    key = spool.put(b"<AuditFile/>", {"filename": "123_FR_1.xml"})
+    assert key == content_key(b"<AuditFile/>")
+    assert spool.put(b"<AuditFile/>") == key
+    assert spool.get(key) == b"<AuditFile/>"
+    local_path = spool.materialize(key, "FR_1.xml", work_dir=str(tmp_path / "work"))
+    with open(local_path, "rb") as f:
+        assert f.read() == b"<AuditFile/>"
+
+
+def test_claim_is_exclusive_until_released(spool):
+    key = spool.put(b"data")
+    token = spool.claim(key)
+    assert token
+    assert spool.claim(key) is None
+    # Só o dono do claim o liberta
+    spool.release(key, "outro-token")
+    assert spool.claim(key) is None
+    spool.release(key, token)
+    assert spool.claim(key)
+
+
+def test_expired_claim_is_taken_over(spool):
+    key = spool.put(b"data")
+    stale_token = spool.claim(key, ttl=-1)
+    token = spool.claim(key)
+    assert token and token != stale_token
+    # O worker antigo já não liberta o claim novo
+    spool.release(key, stale_token)
+    assert spool.claim(key) is None
+
+
+def test_delete_removes_content_and_claim(spool):
+    key = spool.put(b"data", {"filename": "x.xml"})
+    spool.claim(key)
+    spool.delete(key)
+    assert not spool.exists(key)
+    assert spool.meta(key) == {}
+    assert spool.claim(key)
+
+
+def test_same_content_from_two_remote_paths_keeps_both(spool):
+    first = spool.put(b"data", {"remote_path": "/r/111/FR_1.xml"})
+    second = spool.put(b"data", {"remote_path": "/r/222/FR_1.xml"})
+    assert first != second
+    assert key_content_hash(first) == key_content_hash(second) == content_key(b"data")
+    assert spool.meta(first)["remote_path"] == "/r/111/FR_1.xml"
+    assert spool.meta(second)["remote_path"] == "/r/222/FR_1.xml"
+
+
+def test_gc_removes_expired_unclaimed_entries(spool):
+    expired = spool.put(b"old", {"remote_path": "/r/1/FR_1.xml"})
+    claimed = spool.put(b"busy", {"remote_path": "/r/1/FR_2.xml"})
+    direct = spool.put(b"direct", {"direct": True})
+    spool.claim(claimed)
+    assert spool.gc(now=time.time() + 10, ttl=5) == {"removed": 1}
+    assert not spool.exists(expired)
+    assert spool.exists(claimed) and spool.exists(direct)
+    # Entradas recentes ficam
+    assert spool.gc(ttl=3600) == {"removed": 0}
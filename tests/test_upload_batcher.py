@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Testes do lote de uploads por NIF: lista em curso e recuperação de flushes mortos (sem Redis)
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.upload_batcher import (enqueue_upload, take_batch, complete_upload, requeue_uploads, finish_batch,
+                                     reclaim_stale_batches, has_inflight, PENDING_KEY, UPLOAD_INFLIGHT_TIMEOUT)
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.lists = {}
+        self.hashes = {}
+        self.zsets = {}
+        self.values = {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+
+    def lpush(self, key, *values):
+        for value in values:
+            self.lists.setdefault(key, []).insert(0, value)
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def lmove(self, source, destination, src_side, dest_side):
+        items = self.lists.get(source, [])
+        if not items:
+            return None
+        value = items.pop(0 if src_side == "LEFT" else -1)
+        target = self.lists.setdefault(destination, [])
+        target.insert(0, value) if dest_side == "LEFT" else target.append(value)
+        return value
+
+    def lrem(self, key, count, value):
+        items = self.lists.get(key, [])
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    def expire(self, key, seconds):
+        return True
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def zadd(self, key, mapping, xx=False):
+        target = self.zsets.setdefault(key, {})
+        target.update({member: score for member, score in mapping.items() if not xx or member in target})
+
+    def zrem(self, key, member):
+        return 1 if self.zsets.get(key, {}).pop(member, None) is not None else 0
+
+    def zrange(self, key, start, end):
+        return sorted(self.zsets.get(key, {}), key=self.zsets[key].get) if key in self.zsets else []
+
+    def zrangebyscore(self, key, low, high):
+        return [member for member, score in self.zsets.get(key, {}).items() if low <= score <= high]
+
+
+def queue_uploads(redis_client, count):
+    return [enqueue_upload(redis_client, "123", f"blob{index}", f"FR_{index}.xml")[0] for index in range(count)]
+
+
+def test_take_batch_keeps_entries_until_completed():
+    redis_client = FakeRedis()
+    queue_uploads(redis_client, 3)
+    flush_id, entries, remaining = take_batch(redis_client, "123", limit=2)
+    assert [entry["blob_key"] for entry in entries] == ["blob0", "blob1"]
+    assert remaining == 1
+    assert has_inflight(redis_client, "123")
+    for entry in entries:
+        complete_upload(redis_client, "123", flush_id, entry)
+    finish_batch(redis_client, "123", flush_id)
+    assert not has_inflight(redis_client, "123")
+    assert redis_client.llen(f"{PENDING_KEY}:123") == 1
+
+
+def test_crashed_flush_is_reclaimed_in_order():
+    redis_client = FakeRedis()
+    queue_uploads(redis_client, 3)
+    flush_id, entries, _ = take_batch(redis_client, "123", limit=2)
+    complete_upload(redis_client, "123", flush_id, entries[0])
+    # Worker morre aqui: ainda dentro do prazo, nada é devolvido
+    assert reclaim_stale_batches(redis_client, "123") == {}
+    assert reclaim_stale_batches(redis_client, "123", now=time.time() + UPLOAD_INFLIGHT_TIMEOUT + 1) == {"123": 1}
+    _, retaken, _ = take_batch(redis_client, "123")
+    assert [entry["blob_key"] for entry in retaken] == ["blob1", "blob2"]
+
+
+def test_requeue_returns_failed_uploads_to_the_front():
+    redis_client = FakeRedis()
+    queue_uploads(redis_client, 2)
+    flush_id, entries, _ = take_batch(redis_client, "123", limit=1)
+    requeue_uploads(redis_client, "123", flush_id, [{**entries[0], "attempts": 1}])
+    finish_batch(redis_client, "123", flush_id)
+    _, retaken, _ = take_batch(redis_client, "123")
+    assert [(entry["blob_key"], entry["attempts"]) for entry in retaken] == [("blob0", 1), ("blob1", 0)]
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Instrumentação das chamadas PostgREST (supabase.table(...).execute())
+# Cada chamada é registada por operação ("tabela.metodo") e, se houver um
+# ficheiro em processamento (file_scope), também no resumo desse ficheiro.
+
+DB_LATENCY = Histogram(
+    "db_operation_seconds",
+    "Latência das chamadas PostgREST por operação",
+    ["operation"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+DB_ROWS = Histogram(
+    "db_operation_rows",
+    "Linhas devolvidas pelas chamadas PostgREST por operação",
+    ["operation"],
+    buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000),
+)
+DB_PAYLOAD_BYTES = Histogram(
+    "db_operation_payload_bytes",
+    "Bytes enviados/recebidos pelas chamadas PostgREST por operação",
+    ["operation", "direction"],
+    buckets=(0, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+)
+DB_ERRORS = Counter(
+    "db_operation_errors_total",
+    "Chamadas PostgREST que terminaram em exceção",
+    ["operation"],
+)
+DB_FILE_ROUND_TRIPS = Counter(
+    "db_file_round_trips_total",
+    "Total de chamadas PostgREST feitas durante o processamento de ficheiros",
+    ["doc_type"],
+)
+DB_ROUND_TRIPS_PER_FILE = Histogram(
+    "db_round_trips_per_file",
+    "Chamadas PostgREST por ficheiro processado",
+    ["doc_type"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+
+_current_scope = contextvars.ContextVar("db_metrics_file_scope", default=None)
+
+
+class FileDBStats:
+    """Acumula as chamadas PostgREST de um ficheiro (ou de uma tarefa)"""
+
+    def __init__(self, name: str, doc_type: str = "UNKNOWN", on_record=None):
+        self.name = name
+        self.doc_type = doc_type
+        self.on_record = on_record
+        self.round_trips = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.operations = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "rows": 0, "bytes_sent": 0, "bytes_received": 0})
+
+    def record(self, operation: str, seconds: float, rows: int, bytes_sent: int, bytes_received: int, error: bool = False):
+        self.round_trips += 1
+        self.seconds += seconds
+        self.rows += rows
+        if error:
+            self.errors += 1
+        op = self.operations[operation]
+        op["calls"] += 1
+        op["seconds"] += seconds
+        op["rows"] += rows
+        op["bytes_sent"] += bytes_sent
+        op["bytes_received"] += bytes_received
+        if self.on_record is not None:
+            self.on_record(self)
+
+    def summary(self) -> dict:
+        """Resumo serializável em JSON para anexar ao resultado da tarefa Celery"""
+        return {
+            "round_trips": self.round_trips,
+            "errors": self.errors,
+            "rows": self.rows,
+            "seconds": round(self.seconds, 4),
+            "operations": {
+                name: {**op, "seconds": round(op["seconds"], 4)}
+                for name, op in sorted(self.operations.items())
+            },
+        }
+
+
+def _payload_size(payload) -> int:
+    if payload is None:
+        return 0
+    try:
+        return len(json.dumps(payload, default=str, ensure_ascii=False).encode("utf-8"))
+    except (TypeError, ValueError):
+        return 0
+
+
+def execute_query(query, operation: str):
+    """Executa query.execute() registando latência, linhas e bytes da operação"""
+    bytes_sent = _payload_size(getattr(query, "json", None))
+    start = time.perf_counter()
+    try:
+        response = query.execute()
+    except Exception:
+        elapsed = time.perf_counter() - start
+        DB_ERRORS.labels(operation).inc()
+        DB_LATENCY.labels(operation).observe(elapsed)
+        scope = _current_scope.get()
+        if scope is not None:
+            scope.record(operation, elapsed, 0, bytes_sent, 0, error=True)
+        raise
+
+    elapsed = time.perf_counter() - start
+    data = getattr(response, "data", None)
+    if isinstance(data, list):
+        rows = len(data)
+    else:
+        rows = 1 if data else 0
+    bytes_received = _payload_size(data)
+
+    DB_LATENCY.labels(operation).observe(elapsed)
+    DB_ROWS.labels(operation).observe(rows)
+    DB_PAYLOAD_BYTES.labels(operation, "sent").observe(bytes_sent)
+    DB_PAYLOAD_BYTES.labels(operation, "received").observe(bytes_received)
+
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.record(operation, elapsed, rows, bytes_sent, bytes_received)
+
+    return response
+
+
+@contextmanager
+def file_scope(name: str, doc_type: str = "UNKNOWN", on_record=None):
+    """Conta as chamadas PostgREST feitas enquanto um ficheiro é processado.
+    on_record(stats) é chamado após cada chamada (ex.: para reportar progresso)"""
+    stats = FileDBStats(name, doc_type, on_record)
+    token = _current_scope.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_scope.reset(token)
+        DB_FILE_ROUND_TRIPS.labels(doc_type).inc(stats.round_trips)
+        DB_ROUND_TRIPS_PER_FILE.labels(doc_type).observe(stats.round_trips)
+        logger.info(f"📊 {name}: {stats.round_trips} chamadas à DB em {stats.seconds:.3f}s")
+
+
+def metrics_payload():
+    """Conteúdo e content-type para um endpoint /metrics (suporta modo multiprocesso)"""
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, REGISTRY, generate_latest
+
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_worker_metrics_server(port: int):
+    """Expõe as métricas dos processos filhos do worker Celery numa porta HTTP"""
+    from prometheus_client import CollectorRegistry, REGISTRY, start_http_server
+
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    start_http_server(port, registry=registry)
+    logger.info(f"📈 Métricas Prometheus do worker disponíveis na porta {port}")
+
+
+def mark_process_dead(pid: int):
+    """Liberta os ficheiros de métricas de um processo filho que terminou"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
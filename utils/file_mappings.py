@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Mapeamentos ficheiro local -> ficheiro remoto (FR, NC e OpenGCs) num hash Redis
+# indexado pelo caminho local: consulta e remoção O(1), seguras entre workers, e um
+# novo ciclo de download junta os seus mapeamentos sem apagar os dos ciclos anteriores.
+# Substitui os downloads/file_mappings.json e opengcs_file_mappings.json.
+
+FILE_MAPPINGS_KEY = "sftp:mappings"
+# Idade máxima de cada mapeamento (renovada quando o ficheiro volta a ser descarregado);
+# limita mapeamentos de ficheiros que nunca chegaram a ser excluídos
+FILE_MAPPINGS_TTL = int(os.getenv("FILE_MAPPINGS_TTL", "86400"))
+
+
+class FileMappingStore:
+    """Mapeamentos (local_path, remote_path, filename, nif_folder, download_seconds) por caminho local.
+    A hora de escrita de cada mapeamento fica num sorted set ao lado, para expirar campo a campo"""
+
+    def __init__(self, redis_client, key: str = FILE_MAPPINGS_KEY, ttl: int = FILE_MAPPINGS_TTL):
+        self.redis = redis_client
+        self.key = key
+        self.times_key = f"{key}:at"
+        self.ttl = ttl
+
+    def put_many(self, mappings: list, now: float = None):
+        if not mappings:
+            return
+        now = time.time() if now is None else now
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key, mapping={mapping["local_path"]: json.dumps(mapping) for mapping in mappings})
+        pipe.zadd(self.times_key, {mapping["local_path"]: now for mapping in mappings})
+        # O hash já não expira como um todo (versões anteriores punham EXPIRE na chave)
+        pipe.persist(self.key)
+        pipe.execute()
+        self.prune(now)
+
+    def prune(self, now: float = None) -> int:
+        """Remove os mapeamentos escritos há mais de ttl segundos"""
+        now = time.time() if now is None else now
+        expired = self.redis.zrangebyscore(self.times_key, 0, now - self.ttl)
+        if not expired:
+            return 0
+        pipe = self.redis.pipeline()
+        pipe.hdel(self.key, *expired)
+        pipe.zrem(self.times_key, *expired)
+        pipe.execute()
+        logger.info(f"🧹 {len(expired)} mapeamento(s) SFTP expirado(s) removido(s)")
+        return len(expired)
+
+    def get(self, local_path: str):
+        value = self.redis.hget(self.key, local_path)
+        return json.loads(value) if value else None
+
+    def get_many(self, local_paths: list) -> dict:
+        local_paths = list(local_paths)
+        if not local_paths:
+            return {}
+        values = self.redis.hmget(self.key, local_paths)
+        return {local_path: json.loads(value) for local_path, value in zip(local_paths, values) if value}
+
+    def delete(self, *local_paths) -> int:
+        if not local_paths:
+            return 0
+        pipe = self.redis.pipeline()
+        pipe.hdel(self.key, *local_paths)
+        pipe.zrem(self.times_key, *local_paths)
+        return pipe.execute()[0]
+
+
+_store = None
+
+
+def get_file_mappings() -> FileMappingStore:
+    """Store de mapeamentos partilhado (um por processo)"""
+    global _store
+    if _store is None:
+        from utils.redisUtil import get_redis
+        _store = FileMappingStore(get_redis())
+    return _store
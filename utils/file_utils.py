@@ -27,6 +27,14 @@ def strip_nif_prefix(filename):
         return match.group(1)
     return filename
 
+def nif_from_local_filename(filename):
+    """Extrai o NIF (pasta de origem) do prefixo do ficheiro local (ex: '514151900_FR...' -> '514151900')"""
+    import re
+    match = re.match(r'^([A-Z]?\d+)_.+$', filename)
+    if match:
+        return match.group(1)
+    return ""
+
 def invoice_fr_or_nc(filename):
     """Detecta se o ficheiro é FR ou NC, mesmo com prefixo NIF"""
     clean_name = strip_nif_prefix(filename)
@@ -0,0 +1,74 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from prometheus_client import Counter
+
+from .db_metrics import execute_query
+from .supabaseUtil import get_supabase_read, READ_HTTP_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Limites do caminho de leitura analítica (independentes da ingestão)
+READ_MAX_CONCURRENCY = int(os.getenv("READ_MAX_CONCURRENCY", "4"))
+READ_QUERY_TIMEOUT = float(os.getenv("READ_QUERY_TIMEOUT", "15"))
+
+READ_TIMEOUTS = Counter(
+    "db_read_timeouts_total",
+    "Consultas analíticas abandonadas por exceder o timeout",
+    ["operation"],
+)
+
+
+class ReadQueryTimeout(Exception):
+    """Consulta analítica excedeu o tempo limite (resultado abandonado)"""
+
+
+class ReadClient:
+    """
+    Cliente de leitura para consultas analíticas.
+
+    Usa uma ligação própria (réplica de leitura se SUPABASE_READ_URL estiver
+    definido) e um pool de threads limitado, para que consultas pesadas de
+    dashboards não concorram com os workers de ingestão. Cada consulta tem um
+    timeout que inclui o tempo em fila; ao expirar, o resultado é abandonado.
+    Uma consulta ainda em fila não chega a correr; uma já em curso não pode ser
+    interrompida daqui e mantém a thread até ao timeout HTTP do cliente (nunca
+    maior do que o da consulta). O statement_timeout do papel de leitura
+    (banco.sql) faz o servidor cancelá-la do seu lado.
+    """
+
+    def __init__(self, client=None, max_concurrency: int = READ_MAX_CONCURRENCY, timeout: float = READ_QUERY_TIMEOUT):
+        self.client = client or get_supabase_read(http_timeout=min(READ_HTTP_TIMEOUT, timeout))
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="analytics-read")
+
+    def table(self, name: str):
+        return self.client.table(name)
+
+    def rpc(self, fn: str, params: dict):
+        return self.client.rpc(fn, params)
+
+    def execute(self, query, operation: str, timeout: float = None):
+        """Executa a consulta no pool de leitura, respeitando o timeout por consulta"""
+        timeout = self.timeout if timeout is None else timeout
+        future = self._executor.submit(execute_query, query, operation)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # Só tem efeito se a consulta ainda estiver em fila
+            future.cancel()
+            READ_TIMEOUTS.labels(operation).inc()
+            logger.warning(f"⏱️ Consulta analítica {operation} abandonada após {timeout}s")
+            raise ReadQueryTimeout(f"Consulta {operation} excedeu {timeout}s")
+
+
+_read_client = None
+
+
+def get_read_client() -> ReadClient:
+    """Instância partilhada (por processo) do cliente de leitura"""
+    global _read_client
+    if _read_client is None:
+        _read_client = ReadClient()
+    return _read_client
@@ -0,0 +1,17 @@
+import redis
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+_client = None
+
+
+def get_redis():
+    """Cliente Redis partilhado (por processo) para estado de coordenação"""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(redis_url, decode_responses=True)
+    return _client
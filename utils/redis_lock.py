@@ -0,0 +1,67 @@
+import uuid
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Só o dono (token) pode renovar ou libertar o lease
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LeaseLock:
+    """Lock distribuído em Redis com lease (TTL) e renovação periódica (heartbeat).
+    Se o processo morrer o lease expira sozinho; o token permite passar o lock a outra tarefa."""
+
+    def __init__(self, redis_client, name: str, ttl: int, token: str = None):
+        self.redis = redis_client
+        self.name = name
+        self.ttl = ttl
+        self.token = token or uuid.uuid4().hex
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+        self._renew = redis_client.register_script(RENEW_SCRIPT)
+
+    def acquire(self) -> bool:
+        return bool(self.redis.set(self.name, self.token, nx=True, px=int(self.ttl * 1000)))
+
+    def renew(self, ttl: int = None) -> bool:
+        ttl = ttl or self.ttl
+        return bool(self._renew(keys=[self.name], args=[self.token, int(ttl * 1000)]))
+
+    def release(self) -> bool:
+        return bool(self._release(keys=[self.name], args=[self.token]))
+
+    def _heartbeat(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                if not self.renew():
+                    self.lost = True
+                    logger.error(f"🔓 Lease {self.name} perdido (expirou ou foi tomado por outro processo)")
+                    return
+            except Exception as e:
+                logger.warning(f"⚠️ Falha ao renovar lease {self.name}: {str(e)}")
+
+    def start_heartbeat(self, interval: float = None):
+        """Renova o lease a cada ttl/3 segundos numa thread em segundo plano"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat, args=(interval or self.ttl / 3,), daemon=True)
+        self._thread.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
@@ -0,0 +1,457 @@
+import os
+import gzip
+import json
+import time
+import uuid
+import socket
+import hashlib
+import logging
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Spool partilhado entre workers: os ficheiros baixados do SFTP são guardados por
+# hash do conteúdo e as tarefas recebem a chave em vez de um caminho local.
+# Qualquer worker (em qualquer máquina) reclama a chave com um lease, materializa
+# o ficheiro na sua pasta local e apaga-o do spool depois de ingerido.
+
+SPOOL_BACKEND = os.getenv("SPOOL_BACKEND", "local")  # local | storage
+SPOOL_DIR = os.getenv("SPOOL_DIR", "./spool")
+SPOOL_BUCKET = os.getenv("SPOOL_BUCKET", "spool")
+SPOOL_CLAIM_TTL = int(os.getenv("SPOOL_CLAIM_TTL", "600"))
+# Entradas não reescritas há mais do que isto (worker morreu, tarefa perdida) são apagadas pelo GC;
+# os ficheiros continuam no SFTP e o scan volta a pô-los no spool
+SPOOL_TTL = int(os.getenv("SPOOL_TTL", "86400"))
+SPOOL_WORK_DIR = os.getenv("SPOOL_WORK_DIR", "./downloads")
+
+# Blobs recebidos pela API (/receive-file): o XML é escrito uma vez, comprimido, e a
+# tarefa de upload recebe só a chave, em vez de levar até 2MB por mensagem no Redis.
+BLOB_SPOOL_DIR = os.getenv("BLOB_SPOOL_DIR", os.path.join(SPOOL_DIR, "blobs"))
+BLOB_SPOOL_TTL = int(os.getenv("BLOB_SPOOL_TTL", "86400"))
+BLOB_SPOOL_MAX_BYTES = int(os.getenv("BLOB_SPOOL_MAX_BYTES", str(512 * 1024 * 1024)))
+BLOB_SPOOL_USAGE_KEY = "blob_spool:usage"
+
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_content_key(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return content_key(f.read())
+
+
+def spool_key(data: bytes, meta: dict = None) -> str:
+    """Chave no spool: o hash do conteúdo e, para ficheiros do SFTP, o do caminho remoto.
+    O mesmo conteúdo em dois caminhos remotos dá duas entradas, cada uma com o seu remote_path"""
+    key = content_key(data)
+    remote_path = (meta or {}).get("remote_path")
+    if remote_path:
+        key = f"{key}-{hashlib.sha256(remote_path.encode('utf-8')).hexdigest()[:16]}"
+    return key
+
+
+def key_content_hash(key: str) -> str:
+    """Hash do conteúdo de uma chave do spool"""
+    return key.split("-", 1)[0]
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _atomic_write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class BaseSpool:
+    """Operações comuns; os backends implementam put/get/meta/delete/claim/release"""
+
+    claim_ttl = SPOOL_CLAIM_TTL
+
+    def put_file(self, file_path: str, meta: dict = None) -> str:
+        with open(file_path, "rb") as f:
+            data = f.read()
+        meta = {"filename": os.path.basename(file_path), **(meta or {})}
+        return self.put(data, meta)
+
+    def materialize(self, key: str, filename: str = None, work_dir: str = SPOOL_WORK_DIR) -> str:
+        """Escreve o conteúdo da chave na pasta local do worker e devolve o caminho"""
+        filename = filename or self.meta(key).get("filename") or f"{key}.xml"
+        local_path = os.path.join(work_dir, filename)
+        if os.path.exists(local_path):
+            with open(local_path, "rb") as f:
+                if content_key(f.read()) == key_content_hash(key):
+                    return local_path
+        _atomic_write(local_path, self.get(key))
+        return local_path
+
+    def _expired_keys(self, cutoff: float):
+        raise NotImplementedError
+
+    def gc(self, now: float = None, ttl: int = SPOOL_TTL) -> dict:
+        """Apaga entradas não reescritas há mais de `ttl` segundos e sem claim ativo.
+        As entradas diretas (única cópia do ficheiro) ficam para a reconciliação da ingestão direta"""
+        removed = 0
+        for key in self._expired_keys((now or time.time()) - ttl):
+            if self.meta(key).get("direct"):
+                continue
+            token = self.claim(key)
+            if token is None:
+                continue
+            self.delete(key)
+            self.release(key, token)
+            removed += 1
+        if removed:
+            logger.info(f"🧹 GC do spool: {removed} entrada(s) expirada(s) removida(s)")
+        return {"removed": removed}
+
+
+class LocalSpool(BaseSpool):
+    """Spool numa pasta (local ou volume partilhado). Claims são ficheiros criados com
+    O_EXCL contendo token e validade; um claim expirado pode ser retomado por outro worker."""
+
+    def __init__(self, root: str = SPOOL_DIR, claim_ttl: int = SPOOL_CLAIM_TTL):
+        self.root = root
+        self.claim_ttl = claim_ttl
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "claims"), exist_ok=True)
+
+    def _object_path(self, key: str) -> str:
+        return os.path.join(self.root, "objects", key[:2], key)
+
+    def _meta_path(self, key: str) -> str:
+        return f"{self._object_path(key)}.json"
+
+    def _claim_path(self, key: str) -> str:
+        return os.path.join(self.root, "claims", key)
+
+    def put(self, data: bytes, meta: dict = None) -> str:
+        key = spool_key(data, meta)
+        if not os.path.exists(self._object_path(key)):
+            _atomic_write(self._object_path(key), data)
+        _atomic_write(self._meta_path(key), json.dumps({**(meta or {}), "size": len(data), "stored_at": time.time()}).encode("utf-8"))
+        return key
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._object_path(key))
+
+    def get(self, key: str) -> bytes:
+        with open(self._object_path(key), "rb") as f:
+            return f.read()
+
+    def meta(self, key: str) -> dict:
+        try:
+            with open(self._meta_path(key), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def delete(self, key: str):
+        for path in (self._object_path(key), self._meta_path(key), self._claim_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _expired_keys(self, cutoff: float):
+        # O mtime dos metadados é renovado a cada put (o scan volta a guardar o ficheiro)
+        objects_dir = os.path.join(self.root, "objects")
+        for prefix in os.listdir(objects_dir):
+            prefix_dir = os.path.join(objects_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if name.endswith(".json") or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(prefix_dir, name)
+                meta_path = f"{path}.json"
+                try:
+                    stored_at = os.stat(meta_path if os.path.exists(meta_path) else path).st_mtime
+                except FileNotFoundError:
+                    continue
+                if stored_at < cutoff:
+                    yield name
+
+    def _read_claim(self, path: str) -> dict:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            # Claim a meio de ser escrito: tratar como válido
+            return {"expires_at": time.time() + 1}
+
+    def claim(self, key: str, owner: str = None, ttl: int = None):
+        """Reclama a chave; devolve o token do claim ou None se outro worker a tem"""
+        path = self._claim_path(key)
+        token = uuid.uuid4().hex
+        payload = json.dumps({"token": token, "owner": owner or default_owner(),
+                              "expires_at": time.time() + (ttl or self.claim_ttl)})
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                current = self._read_claim(path)
+                if current.get("expires_at", 0) > time.time():
+                    return None
+                # Lease expirado: só um processo consegue renomear o claim antigo
+                stale_path = f"{path}.{token}.stale"
+                try:
+                    os.rename(path, stale_path)
+                except FileNotFoundError:
+                    return None
+                if self._read_claim(stale_path).get("token") != current.get("token"):
+                    # Renomeámos um claim novo de outro worker: repor e desistir
+                    try:
+                        os.link(stale_path, path)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale_path)
+                    return None
+                os.remove(stale_path)
+                logger.warning(f"♻️ Claim expirado de {current.get('owner')} retomado: {key[:12]}")
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(payload)
+            return token
+        return None
+
+    def release(self, key: str, token: str):
+        path = self._claim_path(key)
+        if self._read_claim(path).get("token") == token:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class StorageSpool(BaseSpool):
+    """Spool num bucket do Supabase Storage (compatível com S3). Os claims usam um
+    lease em Redis, já que o storage não tem criação exclusiva."""
+
+    def __init__(self, bucket: str = SPOOL_BUCKET, claim_ttl: int = SPOOL_CLAIM_TTL):
+        from utils.supabaseUtil import get_supabase
+        self.bucket = get_supabase().storage.from_(bucket)
+        self.claim_ttl = claim_ttl
+
+    def put(self, data: bytes, meta: dict = None) -> str:
+        key = spool_key(data, meta)
+        self.bucket.upload(f"objects/{key}", data, {"upsert": "true", "content-type": "application/xml"})
+        meta_data = json.dumps({**(meta or {}), "size": len(data), "stored_at": time.time()}).encode("utf-8")
+        self.bucket.upload(f"meta/{key}.json", meta_data, {"upsert": "true", "content-type": "application/json"})
+        return key
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.bucket.download(f"meta/{key}.json")
+            return True
+        except Exception:
+            return False
+
+    def get(self, key: str) -> bytes:
+        return self.bucket.download(f"objects/{key}")
+
+    def meta(self, key: str) -> dict:
+        try:
+            return json.loads(self.bucket.download(f"meta/{key}.json"))
+        except Exception:
+            return {}
+
+    def delete(self, key: str):
+        self.bucket.remove([f"objects/{key}", f"meta/{key}.json"])
+
+    def _expired_keys(self, cutoff: float, page_size: int = 1000):
+        expired, offset = [], 0
+        while True:
+            page = self.bucket.list("meta", {"limit": page_size, "offset": offset}) or []
+            for item in page:
+                updated_at = item.get("updated_at") or item.get("created_at")
+                if not updated_at or not item["name"].endswith(".json"):
+                    continue
+                if datetime.fromisoformat(updated_at.replace("Z", "+00:00")).timestamp() < cutoff:
+                    expired.append(item["name"][:-len(".json")])
+            if len(page) < page_size:
+                # Apagar só depois da listagem, para não saltar entradas entre páginas
+                return expired
+            offset += page_size
+
+    def _lock(self, key: str, token: str = None, ttl: int = None):
+        from utils.redisUtil import get_redis
+        from utils.redis_lock import LeaseLock
+        return LeaseLock(get_redis(), f"spool:claim:{key}", ttl or self.claim_ttl, token=token)
+
+    def claim(self, key: str, owner: str = None, ttl: int = None):
+        lock = self._lock(key, ttl=ttl)
+        return lock.token if lock.acquire() else None
+
+    def release(self, key: str, token: str):
+        self._lock(key, token=token).release()
+
+
+class BlobSpoolFull(Exception):
+    """O spool de blobs atingiu BLOB_SPOOL_MAX_BYTES"""
+
+
+class BlobSpool:
+    """Blobs comprimidos (gzip) numa pasta partilhada entre a API e os workers.
+    O mtime do ficheiro marca a idade para o GC. A ocupação é um contador em Redis
+    atualizado em put/delete e acertado pelo GC, para que /receive-file não percorra
+    a pasta a cada pedido."""
+
+    def __init__(self, root: str = BLOB_SPOOL_DIR, ttl: int = BLOB_SPOOL_TTL, max_bytes: int = BLOB_SPOOL_MAX_BYTES,
+                 redis_client=None):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.redis = redis_client
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.gz")
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                # .tmp: escritas interrompidas, que também ocupam espaço e expiram
+                if name.endswith((".gz", ".tmp")):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        yield path, os.stat(path)
+                    except FileNotFoundError:
+                        continue
+
+    def _scan(self) -> dict:
+        blobs, size = 0, 0
+        for _, stat in self._entries():
+            blobs += 1
+            size += stat.st_size
+        return {"blobs": blobs, "bytes": size}
+
+    def _resync(self) -> dict:
+        """Percorre a pasta e acerta o contador"""
+        usage = self._scan()
+        if self.redis is not None:
+            self.redis.hset(BLOB_SPOOL_USAGE_KEY, mapping=usage)
+        return usage
+
+    def _account(self, blobs: int, size: int) -> int:
+        """Atualiza o contador; devolve os bytes ocupados depois da alteração"""
+        if not self.redis.exists(BLOB_SPOOL_USAGE_KEY):
+            self._resync()
+        pipe = self.redis.pipeline()
+        pipe.hincrby(BLOB_SPOOL_USAGE_KEY, "blobs", blobs)
+        pipe.hincrby(BLOB_SPOOL_USAGE_KEY, "bytes", size)
+        return pipe.execute()[1]
+
+    def usage(self) -> dict:
+        """Número de blobs e bytes ocupados (comprimidos) face ao limite"""
+        usage = None
+        if self.redis is not None:
+            try:
+                counters = self.redis.hgetall(BLOB_SPOOL_USAGE_KEY)
+                usage = {"blobs": int(counters["blobs"]), "bytes": int(counters["bytes"])} if counters else self._resync()
+            except Exception as e:
+                logger.warning(f"⚠️ Contador do spool de blobs indisponível: {str(e)}")
+        return {**(usage or self._scan()), "max_bytes": self.max_bytes}
+
+    def put(self, data: bytes) -> str:
+        # Chave por pedido (não por conteúdo): o mesmo XML recebido duas vezes tem dois
+        # uploads e cada tarefa apaga só o seu blob
+        key = uuid.uuid4().hex
+        path = self._path(key)
+        compressed = gzip.compress(data, compresslevel=6)
+        size = len(compressed)
+        # Reservar o espaço antes de escrever: pedidos simultâneos não passam o limite
+        counted = False
+        if self.redis is not None:
+            try:
+                used = self._account(1, size)
+                counted = True
+            except Exception as e:
+                logger.warning(f"⚠️ Contador do spool de blobs indisponível: {str(e)}")
+        if not counted:
+            used = self._scan()["bytes"] + size
+        if used > self.max_bytes:
+            if counted:
+                self._account(-1, -size)
+            raise BlobSpoolFull(f"Spool de blobs cheio ({used - size} de {self.max_bytes} bytes)")
+        try:
+            _atomic_write(path, compressed)
+        except Exception:
+            if counted:
+                self._account(-1, -size)
+            raise
+        logger.info(f"📦 Blob {key[:12]} guardado: {len(data)} → {size} bytes")
+        return key
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> bytes:
+        with open(self._path(key), "rb") as f:
+            return gzip.decompress(f.read())
+
+    def delete(self, key: str):
+        path = self._path(key)
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        if self.redis is not None:
+            try:
+                self._account(-1, -size)
+            except Exception as e:
+                # O próximo GC acerta o contador
+                logger.warning(f"⚠️ Contador do spool de blobs indisponível: {str(e)}")
+
+    def gc(self, now: float = None) -> dict:
+        """Apaga blobs mais antigos que o TTL (uploads que esgotaram as tentativas)"""
+        cutoff = (now or time.time()) - self.ttl
+        removed, freed = 0, 0
+        for path, stat in self._entries():
+            if stat.st_mtime < cutoff:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                freed += stat.st_size
+        if removed:
+            logger.info(f"🧹 GC do spool de blobs: {removed} blob(s) expirado(s), {freed} bytes libertados")
+        # Acertar o contador (deletes perdidos, processos interrompidos entre reserva e escrita)
+        try:
+            usage = self._resync()
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao acertar o contador do spool de blobs: {str(e)}")
+            usage = self._scan()
+        return {"removed": removed, "freed_bytes": freed, **usage, "max_bytes": self.max_bytes}
+
+
+_spool = None
+_blob_spool = None
+
+
+def get_spool():
+    """Spool configurado por SPOOL_BACKEND (um por processo)"""
+    global _spool
+    if _spool is None:
+        _spool = StorageSpool() if SPOOL_BACKEND == "storage" else LocalSpool()
+    return _spool
+
+
+def get_blob_spool():
+    """Spool de blobs da API (um por processo)"""
+    global _blob_spool
+    if _blob_spool is None:
+        from utils.redisUtil import get_redis
+        _blob_spool = BlobSpool(redis_client=get_redis())
+    return _blob_spool
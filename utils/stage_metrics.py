@@ -0,0 +1,75 @@
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+
+from prometheus_client import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Tempo por etapa do pipeline de ingestão (download, encoding, parse, mapping,
+# fases de escrita na DB, desativações NC, exclusão SFTP, limpeza local).
+# As etapas são medidas onde acontecem com `stage(...)`; o `stage_scope` do ficheiro
+# junta-as para o resultado da tarefa e exporta-as para o Prometheus.
+
+INGEST_STAGE_SECONDS = Histogram(
+    "ingest_stage_seconds",
+    "Duração de cada etapa da ingestão por ficheiro",
+    ["stage", "doc_type", "nif_bucket"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+
+_current_timer = contextvars.ContextVar("ingest_stage_timer", default=None)
+
+
+def nif_bucket(nif) -> str:
+    """Primeiro dígito do NIF (tipo de entidade), para manter a cardinalidade baixa"""
+    digits = "".join(ch for ch in str(nif or "") if ch.isdigit())
+    return digits[0] if digits else "unknown"
+
+
+class StageTimer:
+    """Acumula a duração de cada etapa de um ficheiro (ou micro-lote)"""
+
+    def __init__(self, doc_type: str = "UNKNOWN", nif: str = None):
+        self.doc_type = doc_type
+        self.nif_bucket = nif_bucket(nif)
+        self.stages = {}
+
+    def add(self, name: str, seconds: float):
+        if seconds is None:
+            return
+        self.stages[name] = self.stages.get(name, 0.0) + float(seconds)
+
+    def summary(self) -> dict:
+        return {name: round(seconds, 4) for name, seconds in self.stages.items()}
+
+
+def record_stage(name: str, seconds: float):
+    """Regista uma duração já medida (ex.: download feito no scan) no ficheiro atual"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    """Mede um bloco como etapa do ficheiro atual; sem stage_scope ativo não faz nada"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+@contextmanager
+def stage_scope(doc_type: str = "UNKNOWN", nif: str = None):
+    """Abre o registo de etapas de um ficheiro e exporta-as no fim"""
+    timer = StageTimer(doc_type, nif)
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+        for name, seconds in timer.stages.items():
+            INGEST_STAGE_SECONDS.labels(name, doc_type, timer.nif_bucket).observe(seconds)
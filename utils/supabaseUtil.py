@@ -1,4 +1,4 @@
-from supabase import create_client
+from supabase import create_client, ClientOptions
 import os
 from dotenv import load_dotenv
 
@@ -7,9 +7,20 @@ load_dotenv()
 url = os.getenv("SUPABASE_URL")
 key = os.getenv("SUPABASE_KEY")
 
+# Caminho de leitura (dashboards/IA): pode apontar para uma réplica de leitura
+read_url = os.getenv("SUPABASE_READ_URL") or url
+read_key = os.getenv("SUPABASE_READ_KEY") or key
+READ_HTTP_TIMEOUT = float(os.getenv("SUPABASE_READ_HTTP_TIMEOUT", "15"))
+
 
 
 def get_supabase():
 
     supabase = create_client(url, key)
-    return supabase
\ No newline at end of file
+    return supabase
+
+
+def get_supabase_read(http_timeout=None):
+    """Cliente dedicado às leituras analíticas, com timeout HTTP próprio"""
+    options = ClientOptions(postgrest_client_timeout=http_timeout or READ_HTTP_TIMEOUT)
+    return create_client(read_url, read_key, options=options)
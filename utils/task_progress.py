@@ -0,0 +1,55 @@
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Intervalo mínimo entre escritas de progresso no result backend (segundos)
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "1.0"))
+
+
+class TaskProgress:
+    """Publica o estado PROGRESS de uma tarefa bind=True para /api/task-status.
+    As escritas são limitadas a uma por PROGRESS_MIN_INTERVAL; chamadas diretas
+    (sem request.id, fora de um worker) não escrevem nada."""
+
+    def __init__(self, task, total: int = 1, stage: str = "", min_interval: float = PROGRESS_MIN_INTERVAL):
+        self.task = task
+        self.enabled = task is not None and getattr(task.request, "id", None) is not None
+        self.min_interval = min_interval
+        self.meta = {"current": 0, "total": total, "status": "", "stage": stage}
+        self._last_write = 0.0
+        self._dirty = False
+
+    def update(self, current: int = None, total: int = None, stage: str = None, status: str = None,
+               force: bool = False, **extra):
+        if current is not None:
+            self.meta["current"] = current
+        if total is not None:
+            self.meta["total"] = total
+        if stage is not None:
+            self.meta["stage"] = stage
+        if status is not None:
+            self.meta["status"] = status
+        self.meta.update(extra)
+        self._dirty = True
+
+        now = time.monotonic()
+        if force or now - self._last_write >= self.min_interval:
+            self._publish(now)
+
+    def flush(self):
+        """Escreve a última atualização pendente (ex.: antes de devolver o resultado)"""
+        if self._dirty:
+            self._publish(time.monotonic())
+
+    def _publish(self, now: float):
+        self._dirty = False
+        self._last_write = now
+        if not self.enabled:
+            return
+        try:
+            self.task.update_state(state="PROGRESS", meta=dict(self.meta))
+        except Exception as e:
+            # Progresso é informativo: nunca falhar a tarefa por causa dele
+            logger.warning(f"⚠️ Não foi possível publicar progresso: {str(e)}")
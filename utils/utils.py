@@ -2,20 +2,21 @@
 
 from collections import defaultdict
 from typing import Optional
-from .supabaseUtil import get_supabase
+from .read_client import get_read_client, ReadQueryTimeout
 
-supabase = get_supabase()
+# Leituras analíticas usam um cliente/pool próprio, isolado da ingestão
+leitura = get_read_client()
 
 def is_valid_nif(nif):
     return nif and nif.isdigit()
 
 # Funções para buscar faturas por data e NIF
 def buscar_faturas_por_data(nif, data_obj):
-    response = supabase.table("faturas_fatura") \
+    query = leitura.table("faturas_fatura") \
         .select("*, itens:faturas_itemfatura(*)") \
         .eq("data", data_obj.isoformat()) \
-        .eq("nif", nif) \
-        .execute()
+        .eq("nif", nif)
+    response = leitura.execute(query, "faturas_fatura.select")
     return response.data or []
 
 
@@ -176,7 +177,7 @@ def buscar_faturas_periodo(nif, data_ini, data_fim, filial=None):
     """
     try:
         # Construir query base
-        query = supabase.table('faturas_fatura') \
+        query = leitura.table('faturas_fatura') \
             .select('id, data, total, numero_fatura, hora, nif_cliente, filial, faturas_itemfatura(id, nome, quantidade, preco_unitario, total)') \
             .eq('nif', nif) \
             .gte('data', data_ini.isoformat()) \
@@ -187,15 +188,149 @@ def buscar_faturas_periodo(nif, data_ini, data_fim, filial=None):
             query = query.eq('filial', filial)
 
         # Executar consulta
-        res = query.execute()
+        res = leitura.execute(query, "faturas_fatura.select")
         return res.data or []
         
+    except ReadQueryTimeout:
+        # Não devolver vazio: um resultado sem faturas acabaria em cache
+        raise
     except Exception as e:
         # Log do erro para debug
         print(f"Erro ao buscar faturas: {str(e)}")
         return []
 
 
+ROLLUPS_PAGE_SIZE = 1000
+
+
+def buscar_rollups_periodo(nif, data_ini, data_fim, filial=None):
+    """
+    Busca os agregados horários (sales_rollup_hourly) de um período.
+    Um ano inteiro são poucos milhares de linhas, lidas em páginas para
+    não esbarrar no limite de linhas do PostgREST.
+    """
+    try:
+        rollups = []
+        offset = 0
+        while True:
+            query = leitura.table('sales_rollup_hourly') \
+                .select('filial, sale_date, sale_hour, total, receipts, items') \
+                .eq('company_id', nif) \
+                .gte('sale_date', data_ini.isoformat()) \
+                .lte('sale_date', data_fim.isoformat())
+
+            if filial:
+                query = query.eq('filial', filial)
+
+            query = query.order('sale_date').order('filial').order('sale_hour') \
+                .range(offset, offset + ROLLUPS_PAGE_SIZE - 1)
+            res = leitura.execute(query, "sales_rollup_hourly.select")
+            pagina = res.data or []
+            rollups.extend(pagina)
+
+            if len(pagina) < ROLLUPS_PAGE_SIZE:
+                break
+            offset += ROLLUPS_PAGE_SIZE
+
+        return rollups
+
+    except ReadQueryTimeout:
+        # Não devolver vazio: um resumo a zeros acabaria em cache
+        raise
+    except Exception as e:
+        print(f"Erro ao buscar agregados de vendas: {str(e)}")
+        return []
+
+
+def processar_rollups_otimizado(rollups, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior):
+    """
+    Equivalente a processar_faturas_otimizado, mas a partir dos agregados horários.
+    Retorna um dicionário com estatísticas, vendas por hora e volume por filial.
+    """
+    from datetime import datetime
+
+    total_atual = total_anterior = 0.0
+    recibos_atual = recibos_anterior = 0
+    itens_atual = itens_anterior = 0.0
+    vendas_por_hora_atual = defaultdict(float)
+    vendas_por_hora_anterior = defaultdict(float)
+    vendas_por_filial_atual = defaultdict(float)
+
+    for rollup in rollups:
+        data_rollup = rollup.get('sale_date')
+        if not data_rollup:
+            continue
+        if isinstance(data_rollup, str):
+            data_rollup = datetime.strptime(data_rollup[:10], '%Y-%m-%d').date()
+
+        hora = int(rollup.get('sale_hour') or 0)
+        total = float(rollup.get('total') or 0)
+        recibos = int(rollup.get('receipts') or 0)
+        itens = float(rollup.get('items') or 0)
+
+        if data_inicio <= data_rollup <= data_fim:
+            total_atual += total
+            recibos_atual += recibos
+            itens_atual += itens
+            vendas_por_hora_atual[hora] += total
+            vendas_por_filial_atual[rollup.get('filial') or 'Sem Filial'] += total
+        elif data_inicio_anterior <= data_rollup <= data_fim_anterior:
+            total_anterior += total
+            recibos_anterior += recibos
+            itens_anterior += itens
+            vendas_por_hora_anterior[hora] += total
+
+    ticket_atual = round(total_atual / recibos_atual, 2) if recibos_atual else 0.0
+    ticket_anterior = round(total_anterior / recibos_anterior, 2) if recibos_anterior else 0.0
+
+    vendas_por_hora_atual = dict(vendas_por_hora_atual)
+    vendas_por_hora_anterior = dict(vendas_por_hora_anterior)
+
+    return {
+        'stats_atual': (total_atual, recibos_atual, itens_atual, ticket_atual),
+        'stats_anterior': (total_anterior, recibos_anterior, itens_anterior, ticket_anterior),
+        'vendas_por_hora_atual': vendas_por_hora_atual,
+        'vendas_por_hora_anterior': vendas_por_hora_anterior,
+        'comparativo_por_hora': gerar_comparativo_por_hora(vendas_por_hora_atual, vendas_por_hora_anterior),
+        'vendas_por_filial_atual': dict(vendas_por_filial_atual)
+    }
+
+
+def buscar_top_produtos(nif, data_ini, data_fim, filial=None, limite=10):
+    """
+    Top-N de produtos por faturamento a partir de product_rollup_daily.
+    O ORDER BY ... LIMIT corre no servidor, por isso o custo não depende do período.
+    Retorna: (produtos, total_produtos_unicos)
+    """
+    try:
+        res = leitura.execute(leitura.rpc('top_produtos_periodo', {
+            'p_company_id': nif,
+            'p_filial': filial,
+            'p_inicio': data_ini.isoformat(),
+            'p_fim': data_fim.isoformat(),
+            'p_limite': limite
+        }), "rpc.top_produtos_periodo")
+        linhas = res.data or []
+
+        produtos = [
+            {
+                'produto': linha.get('description') or linha.get('product_code') or 'Produto Desconhecido',
+                'codigo': linha.get('product_code'),
+                'quantidade': float(linha.get('quantidade') or 0),
+                'faturamento': round(float(linha.get('faturamento') or 0), 2)
+            }
+            for linha in linhas
+        ]
+        total_unicos = int(linhas[0].get('total_produtos') or 0) if linhas else 0
+        return produtos, total_unicos
+
+    except ReadQueryTimeout:
+        raise
+    except Exception as e:
+        print(f"Erro ao buscar top produtos: {str(e)}")
+        return [], 0
+
+
 def limpar_cache_dados_ia(nif: str, periodo: Optional[int] = None, filial: Optional[str] = None):
     """
     Limpa cache específico da função gerar_dados_resumo_ia
@@ -271,6 +406,8 @@ def buscar_faturas_multiplos_periodos(nif, periodos_datas, filial=None):
         
         return resultado
         
+    except ReadQueryTimeout:
+        raise
     except Exception as e:
         print(f"Erro ao buscar faturas múltiplos períodos: {str(e)}")
         return {}
@@ -281,7 +418,8 @@ def gerar_dados_resumo_ia(nif: str, periodo: int, filial: Optional[str] = None)
     Gera dados estruturados e otimizados para análise de IA.
     Busca dados reais do banco de dados e calcula métricas comparativas.
     Implementa cache Redis para melhorar performance.
-    OTIMIZAÇÃO: Uma única chamada ao banco para ambos os períodos.
+    OTIMIZAÇÃO: Métricas, comparativo por hora e filiais vêm dos agregados
+    horários (sales_rollup_hourly) em vez das faturas em bruto.
     """
     from datetime import datetime
     from typing import Optional
@@ -305,67 +443,27 @@ def gerar_dados_resumo_ia(nif: str, periodo: int, filial: Optional[str] = None)
         # Obter datas do período
         data_inicio, data_fim, data_inicio_anterior, data_fim_anterior = get_periodo_datas(periodo)
 
-        # OTIMIZAÇÃO: Uma única chamada ao banco para ambos os períodos
-        # Buscar faturas do período mais amplo (anterior + atual)
+        # OTIMIZAÇÃO: Ler os agregados horários mantidos na ingestão (sales_rollup_hourly)
+        # em vez de todas as faturas e itens do período mais amplo (anterior + atual)
         data_mais_antiga = min(data_inicio_anterior, data_inicio)
         data_mais_recente = max(data_fim_anterior, data_fim)
-        
-        # Uma única consulta ao banco
-        faturas_completas = buscar_faturas_periodo(nif, data_mais_antiga, data_mais_recente, filial=filial)
-        
-        # Filtrar faturas por período no código
-        faturas_atual = []
-        faturas_anterior = []
-        
-        for fatura in faturas_completas:
-            data_fatura = fatura.get('data')
-            if data_fatura:
-                # Converter string para date se necessário
-                if isinstance(data_fatura, str):
-                    from datetime import datetime
-                    data_fatura = datetime.strptime(data_fatura, '%Y-%m-%d').date()
-                
-                # Filtrar por período
-                if data_inicio <= data_fatura <= data_fim:
-                    faturas_atual.append(fatura)
-                elif data_inicio_anterior <= data_fatura <= data_fim_anterior:
-                    faturas_anterior.append(fatura)
-
-        # Processar todas as faturas de uma vez usando a função otimizada
-        dados_processados = processar_faturas_otimizado(faturas_completas, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior)
-        
+
+        rollups = buscar_rollups_periodo(nif, data_mais_antiga, data_mais_recente, filial=filial)
+        dados_processados = processar_rollups_otimizado(rollups, data_inicio, data_fim, data_inicio_anterior, data_fim_anterior)
+
         # Extrair dados processados
         total_at, rec_at, it_at, tk_at = dados_processados['stats_atual']
         total_bt, rec_bt, it_bt, tk_bt = dados_processados['stats_anterior']
         comparativo_hora = dados_processados['comparativo_por_hora']
-        faturas_atual = dados_processados['faturas_atual']
         vendas_por_hora_atual = dados_processados['vendas_por_hora_atual']
 
-        # Análise de produtos
-        produtos_mais_vendidos = []
-        if faturas_atual:
-            produtos = defaultdict(lambda: {'quantidade': 0, 'faturamento': 0.0})
-            for fatura in faturas_atual:
-                for item in fatura.get('faturas_itemfatura', []):
-                    nome_produto = item.get('nome', 'Produto Desconhecido')
-                    quantidade = item.get('quantidade', 0)
-                    total_item = item.get('total', 0)
-                    
-                    produtos[nome_produto]['quantidade'] += quantidade
-                    produtos[nome_produto]['faturamento'] += float(total_item)
-            
-            produtos_mais_vendidos = sorted(
-                [{'produto': k, 'quantidade': v['quantidade'], 'faturamento': round(v['faturamento'], 2)} for k, v in produtos.items()],
-                key=lambda x: x['faturamento'],
-                reverse=True
-            )[:10]
+        # Análise de produtos (top 10 agregado e ordenado no servidor)
+        produtos_mais_vendidos, total_produtos_unicos = buscar_top_produtos(nif, data_inicio, data_fim, filial=filial, limite=10)
 
         # Análise por filiais
         analise_filiais = {}
         if not filial:
-            filiais_agg = defaultdict(float)
-            for fatura in faturas_atual:
-                filiais_agg[fatura.get('filial', 'Sem Filial')] += float(fatura.get('total', 0))
+            filiais_agg = dados_processados['vendas_por_filial_atual']
             
             if filiais_agg:
                 analise_filiais['volume_por_filial'] = sorted(
@@ -389,7 +487,7 @@ def gerar_dados_resumo_ia(nif: str, periodo: int, filial: Optional[str] = None)
                     "fim_anterior": data_fim_anterior.isoformat()
                 },
                 "timestamp_geracao": datetime.now().isoformat(),
-                "otimizacao": "chamada_unica_banco"
+                "otimizacao": "agregados_ingestao"
             },
             "resumo_geral": {
                 "faturas_processadas_atual": rec_at,
@@ -407,7 +505,7 @@ def gerar_dados_resumo_ia(nif: str, periodo: int, filial: Optional[str] = None)
             },
             "analise_produtos": {
                 "top_10_mais_vendidos": produtos_mais_vendidos,
-                "total_produtos_unicos": len(produtos)
+                "total_produtos_unicos": total_produtos_unicos
             },
             "analise_filiais": analise_filiais if not filial else None,
         }
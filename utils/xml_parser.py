@@ -1,11 +1,14 @@
 import os
 import re
+import time
 import logging
 from datetime import datetime
 import pytz
 from typing import Optional
 import xmltodict
 
+from utils.stage_metrics import stage, record_stage
+
 logger = logging.getLogger(__name__)
 
 def read_xml_file_with_encoding(xml_file_path: str, file_type: str = "XML") -> Optional[str]:
@@ -55,13 +58,16 @@ def parse_xml_to_json(xml_file_path: str) -> Optional[dict]:
         logger.info(f"🔄 Processando XML: {xml_file_path}")
         
         # Ler arquivo com codificação adequada
-        xml_content = read_xml_file_with_encoding(xml_file_path, "XML")
+        with stage("encoding"):
+            xml_content = read_xml_file_with_encoding(xml_file_path, "XML")
         if xml_content is None:
             return None
         
         # Converter XML para dict
-        xml_dict = xmltodict.parse(xml_content)
+        with stage("parse"):
+            xml_dict = xmltodict.parse(xml_content)
         logger.info(f"✅ XML convertido para dict com sucesso")
+        mapping_started = time.perf_counter()
         
         saft_data = {
             "arquivo_origem": os.path.basename(xml_file_path),
@@ -336,6 +342,7 @@ def parse_xml_to_json(xml_file_path: str) -> Optional[dict]:
             
         saft_data["total_faturas"] = len(saft_data["invoices_batch"])
         logger.info(f"✅ Processamento concluído: {saft_data['total_faturas']} faturas mapeadas para DB")
+        record_stage("mapping", time.perf_counter() - mapping_started)
        
         return saft_data
         
@@ -350,12 +357,14 @@ def extract_references_from_nc_xml(xml_file_path: str) -> list:
         logger.info(f"🔍 Extraindo referências do arquivo NC: {xml_file_path}")
         
         # Ler arquivo com codificação adequada
-        xml_content = read_xml_file_with_encoding(xml_file_path, "NC XML")
+        with stage("encoding"):
+            xml_content = read_xml_file_with_encoding(xml_file_path, "NC XML")
         if xml_content is None:
             return []
         
         # Converter XML para dict
-        xml_dict = xmltodict.parse(xml_content)
+        with stage("parse"):
+            xml_dict = xmltodict.parse(xml_content)
         
         references = []
         
@@ -436,12 +445,14 @@ def parse_opengcs_xml_to_json(xml_file_path: str) -> Optional[dict]:
         logger.info(f"🔄 Processando XML OpenGCs: {xml_file_path}")
         
         # Ler arquivo com codificação adequada
-        xml_content = read_xml_file_with_encoding(xml_file_path, "OpenGCs XML")
+        with stage("encoding"):
+            xml_content = read_xml_file_with_encoding(xml_file_path, "OpenGCs XML")
         if xml_content is None:
             return None
         
         # Converter XML para dict
-        xml_dict = xmltodict.parse(xml_content)
+        with stage("parse"):
+            xml_dict = xmltodict.parse(xml_content)
         logger.info(f"✅ XML OpenGCs convertido para dict com sucesso")
         
         # Extrair dados do OpenGCs